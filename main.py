@@ -2,14 +2,28 @@ import streamlit as st
 import pandas as pd
 from datetime import datetime, date, timedelta
 import time as pytime
-from pymongo import MongoClient
-from pymongo.errors import AutoReconnect, ConnectionFailure, ServerSelectionTimeoutError
+from pymongo import MongoClient, IndexModel, UpdateOne, ReturnDocument, ReadPreference, ASCENDING, DESCENDING
+from pymongo.errors import AutoReconnect, ConnectionFailure, ServerSelectionTimeoutError, DuplicateKeyError
 import certifi
+import bson
 from bson.objectid import ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from bson.errors import InvalidId
 import hashlib
+import re
+import random
+import unicodedata
 import base64
 from io import BytesIO
+from collections import OrderedDict
 import os
+import sys
+import statistics
+import json
+import pickle
+import argparse
+import threading
 import time
 from pymongo.errors import OperationFailure
 from datetime import time
@@ -21,12 +35,15 @@ import time as module_time
 
 MONGO_URI = st.secrets["MONGO_URI"]
 
-def get_database(max_retries=3):
-    """Função segura para obter conexão com o MongoDB"""
-    
-    # =============================================
-    # VERIFICAÇÕES DE SEGURANÇA (adicionar esta parte)
-    # =============================================
+# Esquema dos itens: embutidos em vendas.itens (true) ou na coleção itens_venda.
+# A leitura aceita os dois durante a transição (ver itens_da_venda e migrar-itens).
+ITENS_EMBUTIDOS = bool(st.secrets.get("ITENS_EMBUTIDOS", False))
+
+# Intervalo mínimo (segundos) entre verificações de saúde do cliente compartilhado
+INTERVALO_VERIFICACAO_CONEXAO = 30
+
+def validar_uri():
+    """Verificações de segurança da string de conexão"""
     if not MONGO_URI:
         raise ValueError("❌ String de conexão não configurada. Verifique seu arquivo .env ou variáveis de ambiente")
     
@@ -38,45 +55,1127 @@ def get_database(max_retries=3):
     
     if len(MONGO_URI.split('@')[0].split(':')[1]) < 8:
         raise ValueError("❌ Senha muito curta (mínimo 8 caracteres)")
+
+@st.cache_resource(show_spinner=False)
+def pool_conexao():
+    """Estado compartilhado por todas as sessões do processo: um único MongoClient"""
+    return {
+        "lock": threading.Lock(),
+        "client": None,
+        "ultima_verificacao": 0.0,
+        "clientes_criados": 0,
+        "handshakes": 0,
+        "reconexoes": 0
+    }
+
+def estatisticas_conexao():
+    pool = pool_conexao()
+    return {
+        "clientes_criados": pool["clientes_criados"],
+        "handshakes": pool["handshakes"],
+        "reconexoes": pool["reconexoes"],
+        "conectado": pool["client"] is not None
+    }
+
+def get_database(max_retries=3):
+    """Função segura para obter conexão com o MongoDB (cliente único por processo)"""
+    validar_uri()
     
-    # =============================================
-    # CONEXÃO COM TRATAMENTO DE ERROS (mantenha o existente)
-    # =============================================
-    for attempt in range(max_retries):
-        try:
-            client = MongoClient(
-                MONGO_URI,
-                tlsCAFile=certifi.where(),  # Sempre use SSL
-                connectTimeoutMS=15000,
-                socketTimeoutMS=30000,
-                serverSelectionTimeoutMS=15000,
-                appname="SariDulcesApp",
-                retryWrites=True,
-                retryReads=True,
-                readPreference='primaryPreferred',
-                maxPoolSize=50,  # Limite de conexões
-               # socketKeepAlive=True
-            )
-            
-            # Teste de conexão seguro
-            client.admin.command('ping')
-            db = client.get_database('saridulces')
-            
-            # Verificação adicional de permissões
-            if db.command('connectionStatus').get('authInfo', {}).get('authenticatedUsers', []) == []:
-                raise ValueError("❌ Falha na autenticação com o banco de dados")
-            
-            return db
+    pool = pool_conexao()
+    with pool["lock"]:
+        client = pool["client"]
+        
+        # Reaproveita o cliente existente; o ping só é enviado a cada INTERVALO_VERIFICACAO_CONEXAO
+        if client is not None:
+            if pytime.monotonic() - pool["ultima_verificacao"] < INTERVALO_VERIFICACAO_CONEXAO:
+                return client.get_database('saridulces')
+            try:
+                client.admin.command('ping')
+                pool["ultima_verificacao"] = pytime.monotonic()
+                return client.get_database('saridulces')
+            except (AutoReconnect, ConnectionFailure, ServerSelectionTimeoutError):
+                # Cliente inutilizável: descarta e reconecta abaixo
+                client.close()
+                pool["client"] = None
+                pool["reconexoes"] += 1
+        
+        # =============================================
+        # CONEXÃO COM TRATAMENTO DE ERROS
+        # =============================================
+        for attempt in range(max_retries):
+            client = None
+            try:
+                client = MongoClient(
+                    MONGO_URI,
+                    tlsCAFile=certifi.where(),  # Sempre use SSL
+                    connectTimeoutMS=15000,
+                    socketTimeoutMS=30000,
+                    serverSelectionTimeoutMS=15000,
+                    appname="SariDulcesApp",
+                    retryWrites=True,
+                    retryReads=True,
+                    readPreference='primaryPreferred',
+                    maxPoolSize=50,  # Limite de conexões
+                   # socketKeepAlive=True
+                )
+                pool["clientes_criados"] += 1
+                
+                # Teste de conexão seguro
+                client.admin.command('ping')
+                db = client.get_database('saridulces')
+                
+                # Verificação adicional de permissões
+                if db.command('connectionStatus').get('authInfo', {}).get('authenticatedUsers', []) == []:
+                    raise ValueError("❌ Falha na autenticação com o banco de dados")
+                pool["handshakes"] += 1
+                
+                pool["client"] = client
+                pool["ultima_verificacao"] = pytime.monotonic()
+                return db
+                
+            except OperationFailure as e:
+                if client is not None:
+                    client.close()
+                raise Exception(f"Erro de operação: {str(e)}")
+                
+            except Exception as e:
+                if client is not None:
+                    client.close()
+                if attempt == max_retries - 1:
+                    st.error(f"🔒 Falha crítica de conexão: {str(e)}")
+                    st.error("⚠️ Verifique: 1) Sua conexão com a internet 2) Credenciais no .env 3) Acesso IP no MongoDB Atlas")
+                    st.stop()
+                pytime.sleep(2 ** attempt)  # Backoff exponencial
+
+def executar_transacao(db, funcao):
+    """Executa funcao(session) numa transação e retorna o seu resultado.
+    
+    O cliente lê com primaryPreferred, mas leituras dentro de transação
+    exigem o primário; por isso a preferência é fixada aqui.
+    """
+    with db.client.start_session() as session:
+        return session.with_transaction(funcao, read_preference=ReadPreference.PRIMARY)
+
+# =============================================
+# ÍNDICES DO BANCO DE DADOS
+# =============================================
+
+# Índices compostos exigidos pelas consultas de cada módulo
+INDICES = {
+    "usuarios": [
+        IndexModel([("username", ASCENDING), ("ativo", ASCENDING)], name="username_ativo"),
+        IndexModel([("nome", ASCENDING)], name="nome")
+    ],
+    "clientes": [
+        IndexModel([("status", ASCENDING), ("nome", ASCENDING), ("_id", ASCENDING)], name="status_nome_id"),
+        IndexModel([("nome", ASCENDING), ("_id", ASCENDING)], name="nome_id"),
+        IndexModel([("tokens_busca", ASCENDING)], name="tokens_busca"),
+        IndexModel(
+            [("status", ASCENDING), ("estatisticas.ultima_compra", ASCENDING)],
+            name="status_estatisticas_ultima_compra"
+        ),
+        IndexModel([("estatisticas.total_gasto", DESCENDING)], name="estatisticas_total_gasto")
+    ],
+    "produtos": [
+        IndexModel([("ativo", ASCENDING), ("estoque", ASCENDING), ("nome", ASCENDING)], name="ativo_estoque_nome"),
+        IndexModel([("ativo", ASCENDING), ("nome", ASCENDING)], name="ativo_nome"),
+        IndexModel([("nome", ASCENDING), ("_id", ASCENDING)], name="nome_id"),
+        IndexModel([("tokens_busca", ASCENDING)], name="tokens_busca"),
+        IndexModel(
+            [("codigo", ASCENDING)],
+            name="codigo",
+            unique=True,
+            partialFilterExpression={"codigo": {"$type": "string"}}
+        )
+    ],
+    "vendas": [
+        IndexModel([("status", ASCENDING), ("data_venda", ASCENDING)], name="status_data_venda"),
+        IndexModel([("data_venda", DESCENDING), ("_id", DESCENDING)], name="data_venda_id"),
+        IndexModel(
+            [("status", ASCENDING), ("data_venda", DESCENDING), ("_id", DESCENDING)],
+            name="status_data_venda_id"
+        ),
+        IndexModel(
+            [("metodo_pagamento", ASCENDING), ("data_venda", DESCENDING), ("_id", DESCENDING)],
+            name="pagamento_data_venda_id"
+        ),
+        IndexModel([("cliente_id", ASCENDING), ("data_venda", ASCENDING)], name="cliente_data_venda"),
+        IndexModel([("itens.produto_id", ASCENDING)], name="itens_produto_id"),
+        IndexModel(
+            [("entrega_agendada", ASCENDING), ("data_venda", DESCENDING)],
+            name="entrega_pendente_data_venda",
+            partialFilterExpression={"entrega_agendada": False}
+        )
+    ],
+    "itens_venda": [
+        IndexModel([("venda_id", ASCENDING)], name="venda_id"),
+        IndexModel([("produto_id", ASCENDING)], name="produto_id")
+    ],
+    "movimentacoes_estoque": [
+        IndexModel([("produto_id", ASCENDING), ("data", DESCENDING), ("_id", DESCENDING)], name="produto_data")
+    ],
+    "vendas_diarias": [
+        IndexModel(
+            [("dia", ASCENDING), ("metodo_pagamento", ASCENDING), ("tipo_cliente", ASCENDING)],
+            name="dia_pagamento_tipo",
+            unique=True
+        )
+    ],
+    "entregas": [
+        IndexModel([("status", ASCENDING), ("data_entrega", ASCENDING)], name="status_data_entrega"),
+        IndexModel([("data_entrega", ASCENDING)], name="data_entrega"),
+        IndexModel([("venda_id", ASCENDING)], name="venda_id")
+    ]
+}
+
+def consultas_monitoradas():
+    """Formatos de consulta usados pelos módulos (coleção, descrição, filtro, ordenação)"""
+    agora = datetime.now()
+    periodo = {"$gte": agora - timedelta(days=30), "$lte": agora}
+    return [
+        ("usuarios", "login", {"username": "", "ativo": True}, None),
+        ("usuarios", "lista de usuários", {}, [("nome", ASCENDING)]),
+        ("clientes", "lista por status", {"status": "ativo"}, [("nome", ASCENDING), ("_id", ASCENDING)]),
+        ("clientes", "lista completa", {}, [("nome", ASCENDING), ("_id", ASCENDING)]),
+        ("clientes", "busca por nome", filtro_busca("mar"), [("nome", ASCENDING), ("_id", ASCENDING)]),
+        ("clientes", "sem compras recentes", {"status": "ativo", "$or": [
+            {"estatisticas.ultima_compra": {"$lt": agora - timedelta(days=90)}}, {"estatisticas.ultima_compra": None}
+        ]}, [("estatisticas.ultima_compra", ASCENDING)]),
+        ("clientes", "maiores clientes", {}, [("estatisticas.total_gasto", DESCENDING)]),
+        ("clientes", "sugestões no checkout", {"status": "ativo", **filtro_busca("119")}, None),
+        ("produtos", "lista de produtos", {}, [("nome", ASCENDING), ("_id", ASCENDING)]),
+        ("produtos", "leitura de código", {**filtro_codigo("SKU"), "ativo": True}, None),
+        ("produtos", "busca por nome", filtro_busca("bri"), [("nome", ASCENDING), ("_id", ASCENDING)]),
+        ("produtos", "produtos ativos", {"ativo": True}, [("nome", ASCENDING)]),
+        ("produtos", "disponíveis para venda", {"ativo": True, "estoque": {"$gt": 0}}, [("nome", ASCENDING)]),
+        ("movimentacoes_estoque", "histórico do produto", {"produto_id": ""}, [("data", DESCENDING), ("_id", DESCENDING)]),
+        ("vendas", "vendas do período", {"data_venda": periodo, "status": "concluída"}, None),
+        ("vendas", "vendas por cliente", {"cliente_id": ""}, None),
+        ("vendas", "histórico", {"data_venda": periodo}, [("data_venda", DESCENDING), ("_id", DESCENDING)]),
+        ("vendas", "histórico por status", {"data_venda": periodo, "status": "cancelada"}, [("data_venda", DESCENDING), ("_id", DESCENDING)]),
+        ("vendas", "histórico por pagamento", {"data_venda": periodo, "metodo_pagamento": "pix"}, [("data_venda", DESCENDING), ("_id", DESCENDING)]),
+        ("vendas_diarias", "consolidado do período", {"dia": periodo}, None),
+        ("itens_venda", "itens por venda", {"venda_id": ""}, None),
+        ("itens_venda", "itens por produto", {"produto_id": ""}, None),
+        ("vendas", "itens embutidos por produto", {"itens.produto_id": ""}, None),
+        ("vendas", "vendas sem entrega", filtro_vendas_sem_entrega(), [("data_venda", DESCENDING)]),
+        ("entregas", "agenda de entregas", {"data_entrega": periodo, "status": "agendada"}, [("data_entrega", ASCENDING)]),
+        ("entregas", "entregas pendentes", {"status": {"$in": ["agendada", "em_rota"]}}, [("data_entrega", ASCENDING)]),
+        ("entregas", "entregas do período", {"data_entrega": periodo}, [("data_entrega", DESCENDING)]),
+        ("entregas", "entrega por venda", {"venda_id": ""}, None)
+    ]
+
+def _normalizar_chaves(chaves):
+    return [(campo, int(direcao) if isinstance(direcao, (int, float)) else direcao) for campo, direcao in chaves]
+
+def _como_dict(valor):
+    if isinstance(valor, dict):
+        return {k: _como_dict(v) for k, v in valor.items()}
+    return valor
+
+def _opcoes_indice(info):
+    """Opções que mudam o significado do índice (unicidade e filtro parcial)"""
+    return {
+        "unique": bool(info.get("unique", False)),
+        "partialFilterExpression": _como_dict(info.get("partialFilterExpression"))
+    }
+
+def garantir_indices(db, recriar=False):
+    """Cria os índices declarados que ainda não existem (idempotente).
+    
+    Um índice com as mesmas chaves mas outras opções (unique,
+    partialFilterExpression) é listado em "divergentes"; com recriar=True
+    ele é removido e criado de novo conforme a declaração.
+    """
+    relatorio = {"criados": [], "existentes": [], "divergentes": [], "recriados": [], "erros": []}
+    
+    for colecao, modelos in INDICES.items():
+        existentes = {
+            tuple(_normalizar_chaves(info["key"])): (nome, info)
+            for nome, info in db[colecao].index_information().items()
+        }
+        
+        faltantes = []
+        for modelo in modelos:
+            doc = modelo.document
+            chaves = tuple(_normalizar_chaves(doc["key"].items()))
+            if chaves not in existentes:
+                faltantes.append(modelo)
+                continue
+            nome_existente, info = existentes[chaves]
+            esperado, encontrado = _opcoes_indice(doc), _opcoes_indice(info)
+            if esperado == encontrado:
+                relatorio["existentes"].append(f"{colecao}.{doc['name']}")
+            elif recriar:
+                try:
+                    db[colecao].drop_index(nome_existente)
+                    faltantes.append(modelo)
+                    relatorio["recriados"].append(f"{colecao}.{doc['name']}")
+                except OperationFailure as e:
+                    relatorio["erros"].append(f"{colecao}.{nome_existente}: {str(e)}")
+            else:
+                relatorio["divergentes"].append(
+                    f"{colecao}.{nome_existente}: esperado {esperado}, encontrado {encontrado}"
+                )
+        
+        if faltantes:
+            try:
+                criados = db[colecao].create_indexes(faltantes)
+                relatorio["criados"].extend(f"{colecao}.{nome}" for nome in criados)
+            except OperationFailure as e:
+                relatorio["erros"].append(f"{colecao}: {str(e)}")
+    
+    return relatorio
+
+@st.cache_resource(show_spinner=False)
+def inicializar_indices(_db):
+    """Executa garantir_indices uma única vez por processo"""
+    try:
+        return garantir_indices(_db)
+    except Exception as e:
+        return {"criados": [], "existentes": [], "divergentes": [], "recriados": [], "erros": [str(e)]}
+
+def _plano_usa_collscan(plano):
+    if isinstance(plano, dict):
+        if plano.get("stage") == "COLLSCAN":
+            return True
+        return any(_plano_usa_collscan(v) for v in plano.values())
+    if isinstance(plano, list):
+        return any(_plano_usa_collscan(v) for v in plano)
+    return False
+
+def consultas_sem_indice(db):
+    """Lista os formatos de consulta cujo plano vencedor ainda é COLLSCAN"""
+    sem_indice = []
+    for colecao, descricao, filtro, ordenacao in consultas_monitoradas():
+        cursor = db[colecao].find(filtro)
+        if ordenacao:
+            cursor = cursor.sort(ordenacao)
+        plano = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        if _plano_usa_collscan(plano):
+            sem_indice.append(f"{colecao}: {descricao} {filtro}")
+    return sem_indice
+
+# =============================================
+# MIGRAÇÃO DE CHAVES ESTRANGEIRAS (string -> ObjectId)
+# =============================================
+
+# (coleção, campo, coleção referenciada)
+CHAVES_ESTRANGEIRAS = [
+    ("vendas", "cliente_id", "clientes"),
+    ("itens_venda", "venda_id", "vendas"),
+    ("itens_venda", "produto_id", "produtos"),
+    ("entregas", "venda_id", "vendas")
+]
+
+# Junções ($lookup) usadas nos relatórios: (origem, localField, destino, foreignField)
+JUNCOES_RELATORIOS = [
+    ("itens_venda", "venda_id", "vendas", "_id"),
+    ("clientes", "_id", "vendas", "cliente_id"),
+    ("vendas", "_id", "itens_venda", "venda_id")
+]
+
+def migrar_chaves_estrangeiras(db, tamanho_lote=500):
+    """Converte as chaves gravadas como string em ObjectId, em lotes.
+    
+    Pode ser interrompida e executada novamente: só documentos cujo campo
+    ainda é string são selecionados.
+    """
+    resumo = {}
+    for colecao, campo, _ in CHAVES_ESTRANGEIRAS:
+        convertidos, invalidos = 0, 0
+        ultimo_id = None
+        
+        while True:
+            filtro = {campo: {"$type": "string"}}
+            if ultimo_id is not None:
+                filtro["_id"] = {"$gt": ultimo_id}
+            lote = list(db[colecao].find(filtro, {campo: 1}).sort("_id", 1).limit(tamanho_lote))
+            if not lote:
+                break
+            ultimo_id = lote[-1]["_id"]
             
-        except Exception as e:
-            if attempt == max_retries - 1:
-                st.error(f"🔒 Falha crítica de conexão: {str(e)}")
-                st.error("⚠️ Verifique: 1) Sua conexão com a internet 2) Credenciais no .env 3) Acesso IP no MongoDB Atlas")
-                st.stop()
-            time.sleep(2 ** attempt)  # Backoff exponencial
+            operacoes = []
+            for doc in lote:
+                novo_valor = como_object_id(doc[campo])
+                if novo_valor is None:
+                    invalidos += 1
+                    continue
+                operacoes.append(UpdateOne(
+                    {"_id": doc["_id"], campo: doc[campo]},
+                    {"$set": {campo: novo_valor}}
+                ))
             
-        except OperationFailure as e:
-            raise Exception(f"Erro de operação: {str(e)}")
+            if operacoes:
+                convertidos += db[colecao].bulk_write(operacoes, ordered=False).modified_count
+            print(f"  {colecao}.{campo}: {convertidos} convertidos")
+        
+        resumo[f"{colecao}.{campo}"] = {"convertidos": convertidos, "invalidos": invalidos}
+    invalidar_colecoes(db, *{colecao for colecao, _, _ in CHAVES_ESTRANGEIRAS})
+    return resumo
+
+def verificar_chaves_estrangeiras(db):
+    """Confere tipos, referências órfãs e índices das junções"""
+    problemas = []
+    
+    for colecao, campo, referenciada in CHAVES_ESTRANGEIRAS:
+        restantes = db[colecao].count_documents({campo: {"$type": "string"}})
+        if restantes:
+            problemas.append(f"{colecao}.{campo}: {restantes} documentos ainda com string")
+        
+        orfaos = next(db[colecao].aggregate([
+            {"$match": {campo: {"$type": "objectId"}}},
+            {"$lookup": {
+                "from": referenciada,
+                "localField": campo,
+                "foreignField": "_id",
+                "as": "referencia"
+            }},
+            {"$match": {"referencia": {"$size": 0}}},
+            {"$count": "total"}
+        ]), {"total": 0})["total"]
+        if orfaos:
+            problemas.append(f"{colecao}.{campo}: {orfaos} referências sem documento em {referenciada}")
+    
+    for origem, campo_local, destino, campo_destino in JUNCOES_RELATORIOS:
+        primeiros_campos = [
+            info["key"][0][0] for info in db[destino].index_information().values()
+        ]
+        if campo_destino not in primeiros_campos:
+            problemas.append(f"$lookup {origem}.{campo_local} -> {destino}.{campo_destino} sem índice")
+    
+    return problemas
+
+# =============================================
+# CONSOLIDADO DIÁRIO DE VENDAS (vendas_diarias)
+# =============================================
+
+def inicio_do_dia(momento):
+    return datetime.combine(momento.date() if isinstance(momento, datetime) else momento, datetime.min.time())
+
+def registrar_venda_diaria(db, data_venda, metodo_pagamento, tipo_cliente, valor_total, lucro_total, quantidade=1, session=None):
+    """Atualiza atomicamente o consolidado (dia, pagamento, tipo de cliente).
+    
+    Use quantidade=-1 com valores negativos para estornar uma venda cancelada.
+    """
+    db.vendas_diarias.update_one(
+        {
+            "dia": inicio_do_dia(data_venda),
+            "metodo_pagamento": metodo_pagamento,
+            "tipo_cliente": tipo_cliente or "desconhecido"
+        },
+        {"$inc": {
+            "vendas": quantidade,
+            "faturamento": valor_total,
+            "lucro": lucro_total
+        }},
+        upsert=True,
+        session=session
+    )
+
+def _limites_rollup(db, data_inicio, data_fim):
+    """Período a reconstruir: o informado ou o coberto por vendas e pelo consolidado atual"""
+    if data_inicio is None or data_fim is None:
+        extremos = []
+        for colecao, campo, filtro in [("vendas", "data_venda", {"status": "concluída"}), ("vendas_diarias", "dia", {})]:
+            for direcao in (ASCENDING, DESCENDING):
+                doc = db[colecao].find_one(filtro, {campo: 1}, sort=[(campo, direcao)])
+                if doc and doc.get(campo):
+                    extremos.append(doc[campo].date())
+        if not extremos:
+            return None, None
+        data_inicio = data_inicio or min(extremos)
+        data_fim = data_fim or max(extremos)
+    return data_inicio, data_fim
+
+def _reconstruir_periodo(db, inicio, fim, session):
+    filtro_vendas = {"status": "concluída", "data_venda": {
+        "$gte": datetime.combine(inicio, datetime.min.time()),
+        "$lte": datetime.combine(fim, datetime.max.time())
+    }}
+    filtro_dias = {"dia": {
+        "$gte": datetime.combine(inicio, datetime.min.time()),
+        "$lte": datetime.combine(fim, datetime.min.time())
+    }}
+    documentos = list(db.vendas.aggregate([
+        {"$match": filtro_vendas},
+        {"$lookup": {
+            "from": "clientes",
+            "localField": "cliente_id",
+            "foreignField": "_id",
+            "as": "cliente"
+        }},
+        {"$group": {
+            "_id": {
+                "dia": {"$dateTrunc": {"date": "$data_venda", "unit": "day"}},
+                "metodo_pagamento": "$metodo_pagamento",
+                "tipo_cliente": {"$ifNull": ["$tipo_cliente", {"$first": "$cliente.tipo"}, "desconhecido"]}
+            },
+            "vendas": {"$sum": 1},
+            "faturamento": {"$sum": "$valor_total"},
+            "lucro": {"$sum": "$lucro_total"}
+        }},
+        {"$project": {
+            "_id": 0,
+            "dia": "$_id.dia",
+            "metodo_pagamento": "$_id.metodo_pagamento",
+            "tipo_cliente": "$_id.tipo_cliente",
+            "vendas": 1,
+            "faturamento": 1,
+            "lucro": 1
+        }}
+    ], session=session))
+    removidos = db.vendas_diarias.delete_many(filtro_dias, session=session).deleted_count
+    if documentos:
+        db.vendas_diarias.insert_many(documentos, session=session)
+    return removidos, len(documentos)
+
+def reconstruir_vendas_diarias(db, data_inicio=None, data_fim=None):
+    """Recalcula o consolidado a partir de `vendas` (backfill do histórico).
+    
+    Cada mês é lido, removido e regravado numa única transação: um checkout
+    concorrente que toque o mesmo documento gera conflito de escrita e a
+    transação é repetida, em vez de a venda se perder ou ser contada duas vezes.
+    """
+    data_inicio, data_fim = _limites_rollup(db, data_inicio, data_fim)
+    removidos, gerados = 0, 0
+    inicio = data_inicio
+    while inicio is not None and inicio <= data_fim:
+        proximo_mes = (inicio.replace(day=28) + timedelta(days=4)).replace(day=1)
+        fim = min(proximo_mes - timedelta(days=1), data_fim)
+        
+        def _transacao(session):
+            return _reconstruir_periodo(db, inicio, fim, session)
+        
+        removidos_mes, gerados_mes = executar_transacao(db, _transacao)
+        removidos += removidos_mes
+        gerados += gerados_mes
+        inicio = proximo_mes
+    
+    invalidar_colecoes(db, "vendas_diarias")
+    return {"removidos": removidos, "gerados": gerados}
+
+# =============================================
+# ESTATÍSTICAS DE CLIENTES
+# =============================================
+
+# clientes.estatisticas: primeira/última compra, compras, gasto, ticket e
+# intervalo médio (dias) das vendas concluídas; os campos de topo
+# compras_realizadas, total_gasto e ultima_compra espelham o bloco
+
+def estatisticas_cliente(compras=0, total_gasto=0.0, primeira_compra=None, ultima_compra=None):
+    """Bloco estatisticas a partir dos contadores, com os campos derivados"""
+    intervalo = None
+    if compras > 1 and primeira_compra and ultima_compra:
+        intervalo = (ultima_compra - primeira_compra).total_seconds() / 86400 / (compras - 1)
+    return {
+        "primeira_compra": primeira_compra,
+        "ultima_compra": ultima_compra,
+        "compras": compras,
+        "total_gasto": total_gasto,
+        "ticket_medio": total_gasto / compras if compras else 0.0,
+        "intervalo_medio_dias": intervalo
+    }
+
+def campos_estatisticas(estatisticas):
+    """$set do bloco e dos campos de topo que o espelham"""
+    return {
+        "estatisticas": estatisticas,
+        "compras_realizadas": estatisticas["compras"],
+        "total_gasto": estatisticas["total_gasto"],
+        "ultima_compra": estatisticas["ultima_compra"]
+    }
+
+def atualizacao_estatisticas_venda(valor_total, data_venda):
+    """Pipeline de update do checkout: contadores com $min/$max/$add, depois os derivados.
+    
+    Clientes ainda sem o bloco partem dos campos de topo (compras_realizadas,
+    total_gasto, ultima_compra); a primeira compra fica nula até o
+    reconciliar-clientes quando o histórico anterior não é conhecido.
+    """
+    compras_anteriores = {"$ifNull": ["$estatisticas.compras", {"$ifNull": ["$compras_realizadas", 0]}]}
+    primeira_anterior = {"$ifNull": ["$estatisticas.primeira_compra", None]}
+    return [
+        {"$set": {
+            "estatisticas.primeira_compra": {"$cond": [
+                {"$eq": [compras_anteriores, 0]},
+                data_venda,
+                {"$cond": [{"$eq": [primeira_anterior, None]}, None, {"$min": [primeira_anterior, data_venda]}]}
+            ]},
+            "estatisticas.ultima_compra": {"$max": [
+                {"$ifNull": ["$estatisticas.ultima_compra", "$ultima_compra"]}, data_venda
+            ]},
+            "estatisticas.compras": {"$add": [compras_anteriores, 1]},
+            "estatisticas.total_gasto": {"$add": [
+                {"$ifNull": ["$estatisticas.total_gasto", {"$ifNull": ["$total_gasto", 0]}]}, valor_total
+            ]}
+        }},
+        {"$set": {
+            "estatisticas.ticket_medio": {"$divide": ["$estatisticas.total_gasto", "$estatisticas.compras"]},
+            "estatisticas.intervalo_medio_dias": {"$cond": [
+                {"$and": [
+                    {"$gt": ["$estatisticas.compras", 1]},
+                    {"$ne": [{"$ifNull": ["$estatisticas.primeira_compra", None]}, None]}
+                ]},
+                {"$divide": [
+                    {"$subtract": ["$estatisticas.ultima_compra", "$estatisticas.primeira_compra"]},
+                    {"$multiply": [86_400_000, {"$subtract": ["$estatisticas.compras", 1]}]}
+                ]},
+                None
+            ]},
+            "compras_realizadas": "$estatisticas.compras",
+            "total_gasto": "$estatisticas.total_gasto",
+            "ultima_compra": "$estatisticas.ultima_compra"
+        }}
+    ]
+
+def recalcular_estatisticas(db, ids_clientes, session=None):
+    """Estatísticas de cada cliente calculadas das vendas concluídas (índice cliente_data_venda).
+    
+    Clientes sem vendas concluídas recebem o bloco zerado.
+    """
+    ids = list({como_object_id(i) for i in ids_clientes} - {None})
+    grupos = {
+        grupo["_id"]: grupo for grupo in db.vendas.aggregate([
+            {"$match": {"cliente_id": {"$in": ids}, "status": "concluída"}},
+            {"$group": {
+                "_id": "$cliente_id",
+                "primeira_compra": {"$min": "$data_venda"},
+                "ultima_compra": {"$max": "$data_venda"},
+                "compras": {"$sum": 1},
+                "total_gasto": {"$sum": "$valor_total"}
+            }}
+        ], session=session)
+    } if ids else {}
+    return {
+        cliente_id: estatisticas_cliente(**{k: v for k, v in grupos.get(cliente_id, {}).items() if k != "_id"})
+        for cliente_id in ids
+    }
+
+def _estatisticas_divergem(atual, esperado):
+    """Compara blocos tolerando o arredondamento das somas em ponto flutuante"""
+    if not atual:
+        return True
+    for campo, valor in esperado.items():
+        armazenado = atual.get(campo)
+        if isinstance(valor, float) or isinstance(armazenado, float):
+            if valor is None or armazenado is None or abs(valor - armazenado) > 0.005:
+                return True
+        elif armazenado != valor:
+            return True
+    return False
+
+def reconciliar_estatisticas_clientes(db, tamanho_lote=500):
+    """Recalcula as estatísticas de todos os clientes em lotes por _id e corrige divergências.
+    
+    Cada lote faz uma agregação em vendas e um bulk_write só com os clientes
+    divergentes; pode ser interrompida e executada novamente.
+    """
+    verificados, corrigidos = 0, 0
+    ultimo_id = None
+    while True:
+        consulta = {} if ultimo_id is None else {"_id": {"$gt": ultimo_id}}
+        clientes = list(
+            db.clientes.find(consulta, {"estatisticas": 1, "compras_realizadas": 1, "total_gasto": 1, "ultima_compra": 1})
+            .sort("_id", ASCENDING)
+            .limit(tamanho_lote)
+        )
+        if not clientes:
+            break
+        ultimo_id = clientes[-1]["_id"]
+        
+        esperadas = recalcular_estatisticas(db, [c["_id"] for c in clientes])
+        correcoes = []
+        for cliente in clientes:
+            esperado = campos_estatisticas(esperadas[cliente["_id"]])
+            topo = {k: v for k, v in esperado.items() if k != "estatisticas"}
+            if (_estatisticas_divergem(cliente.get("estatisticas"), esperado["estatisticas"])
+                    or _estatisticas_divergem({k: cliente.get(k) for k in topo}, topo)):
+                correcoes.append(UpdateOne({"_id": cliente["_id"]}, {"$set": esperado}))
+        if correcoes:
+            db.clientes.bulk_write(correcoes, ordered=False)
+        
+        verificados += len(clientes)
+        corrigidos += len(correcoes)
+        print(f"  {verificados} clientes verificados, {corrigidos} corrigidos")
+    
+    invalidar_colecoes(db, "clientes")
+    return {"verificados": verificados, "corrigidos": corrigidos}
+
+# =============================================
+# SERVIÇO DE VENDAS
+# =============================================
+
+def registrar_venda(db, nova_venda, itens, tipo_cliente, embutir=None):
+    """Grava a venda numa única transação multi-documento.
+    
+    Itens vão embutidos na venda (ITENS_EMBUTIDOS) ou num insert_many em
+    itens_venda; a baixa de estoque vai num bulk_write condicionado a
+    `estoque >= quantidade`. Se algum produto não tiver saldo a transação
+    inteira é desfeita e um ValueError é lançado.
+    """
+    embutir = ITENS_EMBUTIDOS if embutir is None else embutir
+    nova_venda["_id"] = ObjectId()
+    nova_venda["tipo_cliente"] = tipo_cliente  # chave do consolidado, usada no estorno
+    if nova_venda.get("tipo_entrega") == "entrega_ao_cliente":
+        nova_venda["entrega_agendada"] = False  # entra no índice de vendas sem entrega
+    documentos_itens = [
+        {
+            "venda_id": nova_venda["_id"],
+            "produto_id": ObjectId(item['produto_id']),
+            "quantidade": item['quantidade'],
+            "preco_unitario": item['preco_unitario'],
+            "custo_unitario": item['custo_unitario'],
+            "subtotal": item['subtotal']
+        }
+        for item in itens
+    ]
+    baixas_estoque = [
+        UpdateOne(
+            {"_id": doc["produto_id"], "estoque": {"$gte": doc["quantidade"]}},
+            {"$inc": {"estoque": -doc["quantidade"]}}
+        )
+        for doc in documentos_itens
+    ]
+    if embutir:
+        # Nome e custo congelados na venda: o detalhe não depende do cadastro atual
+        nova_venda["itens"] = [
+            {**{k: v for k, v in doc.items() if k != "venda_id"}, "nome": item.get('nome')}
+            for doc, item in zip(documentos_itens, itens)
+        ]
+    
+    def _transacao(session):
+        db.vendas.insert_one(nova_venda, session=session)
+        if not embutir:
+            db.itens_venda.insert_many(documentos_itens, session=session)
+        
+        resultado = db.produtos.bulk_write(baixas_estoque, ordered=False, session=session)
+        if resultado.matched_count != len(baixas_estoque):
+            raise ValueError("Estoque insuficiente")
+        
+        # Atualiza estatísticas do cliente
+        db.clientes.update_one(
+            {"_id": nova_venda["cliente_id"]},
+            atualizacao_estatisticas_venda(nova_venda["valor_total"], nova_venda["data_venda"]),
+            session=session
+        )
+        
+        # Atualiza o consolidado diário usado no painel estratégico
+        registrar_venda_diaria(
+            db,
+            nova_venda["data_venda"],
+            nova_venda["metodo_pagamento"],
+            tipo_cliente,
+            nova_venda["valor_total"],
+            nova_venda["lucro_total"],
+            session=session
+        )
+    
+    try:
+        executar_transacao(db, _transacao)
+    except ValueError:
+        # Identifica os produtos sem saldo para a mensagem ao operador
+        saldos = {
+            p["_id"]: p for p in db.produtos.find(
+                {"_id": {"$in": [doc["produto_id"] for doc in documentos_itens]}},
+                {"nome": 1, "estoque": 1}
+            )
+        }
+        sem_saldo = [
+            f"{saldos[doc['produto_id']]['nome']} (disponível: {saldos[doc['produto_id']]['estoque']})"
+            for doc in documentos_itens
+            if doc["produto_id"] in saldos and saldos[doc["produto_id"]]["estoque"] < doc["quantidade"]
+        ]
+        raise ValueError(f"Estoque insuficiente: {', '.join(sem_saldo) or 'produto indisponível'}")
+    
+    invalidar_colecoes(db, "vendas", "itens_venda", "produtos", "clientes", "vendas_diarias")
+    return nova_venda
+
+def cancelar_vendas(db, ids_vendas):
+    """Cancela vendas concluídas numa única transação, qualquer que seja a quantidade.
+    
+    Devoluções de estoque são somadas por produto e estornos por cliente, cada
+    grupo num único bulk_write; o consolidado diário recebe os valores negativos.
+    Retorna um resumo com as contagens e a duração em ms.
+    """
+    inicio = pytime.perf_counter()
+    ids = [ObjectId(i) for i in ids_vendas]
+    agora = datetime.now()
+    
+    def _transacao(session):
+        vendas = list(db.vendas.find(
+            {"_id": {"$in": ids}, "status": "concluída"},
+            {"cliente_id": 1, "valor_total": 1, "lucro_total": 1, "data_venda": 1,
+             "metodo_pagamento": 1, "tipo_cliente": 1, "itens.produto_id": 1, "itens.quantidade": 1},
+            session=session
+        ))
+        if not vendas:
+            return {"canceladas": 0, "produtos": 0, "clientes": 0}
+        ids_canceladas = [v["_id"] for v in vendas]
+        
+        # Itens nos dois esquemas: embutidos na venda ou em itens_venda
+        itens = [item for venda in vendas for item in venda.get("itens", [])]
+        legado = [v["_id"] for v in vendas if "itens" not in v]
+        if legado:
+            itens += db.itens_venda.find(
+                {"venda_id": {"$in": legado}}, {"produto_id": 1, "quantidade": 1}, session=session
+            )
+        
+        devolucoes = {}
+        for item in itens:
+            produto_id = como_object_id(item["produto_id"])
+            devolucoes[produto_id] = devolucoes.get(produto_id, 0) + item["quantidade"]
+        
+        ids_clientes = {como_object_id(v.get("cliente_id")) for v in vendas} - {None}
+        tipos_clientes = {}
+        sem_tipo = {como_object_id(v.get("cliente_id")) for v in vendas if not v.get("tipo_cliente")} - {None}
+        if sem_tipo:
+            # Vendas anteriores ao campo tipo_cliente: usa o tipo atual, como o rollup-vendas
+            tipos_clientes = {
+                c["_id"]: c.get("tipo") for c in db.clientes.find(
+                    {"_id": {"$in": list(sem_tipo)}}, {"tipo": 1}, session=session
+                )
+            }
+        
+        estornos_diarios = {}
+        for venda in vendas:
+            tipo = venda.get("tipo_cliente") or tipos_clientes.get(como_object_id(venda.get("cliente_id")))
+            chave = (inicio_do_dia(venda["data_venda"]), venda.get("metodo_pagamento"), tipo or "desconhecido")
+            quantidade, faturamento, lucro = estornos_diarios.get(chave, (0, 0.0, 0.0))
+            estornos_diarios[chave] = (
+                quantidade + 1,
+                faturamento + venda.get("valor_total", 0),
+                lucro + venda.get("lucro_total", 0)
+            )
+        
+        db.vendas.update_many(
+            {"_id": {"$in": ids_canceladas}, "status": "concluída"},
+            {"$set": {"status": "cancelada", "data_cancelamento": agora}, "$unset": {"entrega_agendada": ""}},
+            session=session
+        )
+        if devolucoes:
+            db.produtos.bulk_write([
+                UpdateOne({"_id": produto_id}, {"$inc": {"estoque": quantidade}})
+                for produto_id, quantidade in devolucoes.items()
+            ], ordered=False, session=session)
+        # Primeira/última compra não se desfazem com $inc: recalcula os clientes afetados
+        if ids_clientes:
+            db.clientes.bulk_write([
+                UpdateOne({"_id": cliente_id}, {"$set": campos_estatisticas(estatisticas)})
+                for cliente_id, estatisticas in recalcular_estatisticas(db, ids_clientes, session=session).items()
+            ], ordered=False, session=session)
+        db.vendas_diarias.bulk_write([
+            UpdateOne(
+                {"dia": dia, "metodo_pagamento": metodo, "tipo_cliente": tipo},
+                {"$inc": {"vendas": -quantidade, "faturamento": -faturamento, "lucro": -lucro}},
+                upsert=True
+            )
+            for (dia, metodo, tipo), (quantidade, faturamento, lucro) in estornos_diarios.items()
+        ], ordered=False, session=session)
+        # Entregas ainda pendentes dessas vendas deixam de ser feitas
+        db.entregas.update_many(
+            {"venda_id": {"$in": ids_canceladas}, "status": {"$in": ["agendada", "em_rota"]}},
+            {"$set": {"status": "cancelada"}},
+            session=session
+        )
+        return {"canceladas": len(vendas), "produtos": len(devolucoes), "clientes": len(ids_clientes)}
+    
+    resumo = executar_transacao(db, _transacao)
+    
+    if resumo["canceladas"]:
+        invalidar_colecoes(db, "vendas", "produtos", "clientes", "vendas_diarias", "entregas")
+    resumo["duracao_ms"] = (pytime.perf_counter() - inicio) * 1000
+    return resumo
+
+def itens_da_venda(db, venda):
+    """Itens de uma venda em qualquer dos dois esquemas (leitura dupla da transição)"""
+    if "itens" in venda:
+        return venda["itens"]
+    itens = list(db.itens_venda.find({"venda_id": venda["_id"]}, {"venda_id": 0}))
+    ids_produtos = {item["produto_id"] for item in itens}
+    nomes = {
+        p["_id"]: p["nome"] for p in db.produtos.find({"_id": {"$in": list(ids_produtos)}}, {"nome": 1})
+    } if ids_produtos else {}
+    for item in itens:
+        item.setdefault("nome", nomes.get(item["produto_id"], "Produto removido"))
+    return itens
+
+def migrar_itens_embutidos(db, tamanho_lote=500):
+    """Copia itens_venda para vendas.itens (com nome do produto) e remove os originais.
+    
+    Cada lote de vendas é gravado e limpo na mesma transação; pode ser
+    interrompida e executada novamente, pois só vendas sem `itens` são lidas.
+    Lança ValueError se ainda houver itens com venda_id string: o lote
+    busca por ObjectId e gravaria `itens: []` nessas vendas.
+    """
+    pendentes = db.itens_venda.count_documents({"venda_id": {"$type": "string"}})
+    if pendentes:
+        raise ValueError(f"{pendentes} itens_venda com venda_id string: execute migrar-chaves antes")
+    vendas_migradas, itens_migrados = 0, 0
+    ultimo_id = None
+    while True:
+        filtro = {"itens": {"$exists": False}}
+        if ultimo_id is not None:
+            filtro["_id"] = {"$gt": ultimo_id}
+        ids_vendas = [v["_id"] for v in db.vendas.find(filtro, {"_id": 1}).sort("_id", 1).limit(tamanho_lote)]
+        if not ids_vendas:
+            break
+        ultimo_id = ids_vendas[-1]
+        
+        itens_por_venda = {venda_id: [] for venda_id in ids_vendas}
+        itens = list(db.itens_venda.find({"venda_id": {"$in": ids_vendas}}))
+        ids_produtos = {item["produto_id"] for item in itens}
+        nomes = {
+            p["_id"]: p["nome"] for p in db.produtos.find({"_id": {"$in": list(ids_produtos)}}, {"nome": 1})
+        } if ids_produtos else {}
+        for item in itens:
+            itens_por_venda[item["venda_id"]].append({
+                "produto_id": item["produto_id"],
+                "nome": nomes.get(item["produto_id"], "Produto removido"),
+                "quantidade": item.get("quantidade", 0),
+                "preco_unitario": item.get("preco_unitario", 0),
+                "custo_unitario": item.get("custo_unitario", 0),
+                "subtotal": item.get("subtotal", 0)
+            })
+        
+        def _transacao(session):
+            db.vendas.bulk_write([
+                UpdateOne({"_id": venda_id, "itens": {"$exists": False}}, {"$set": {"itens": lista}})
+                for venda_id, lista in itens_por_venda.items()
+            ], ordered=False, session=session)
+            db.itens_venda.delete_many({"venda_id": {"$in": ids_vendas}}, session=session)
+        
+        executar_transacao(db, _transacao)
+        
+        vendas_migradas += len(ids_vendas)
+        itens_migrados += len(itens)
+        print(f"  {vendas_migradas} vendas, {itens_migrados} itens embutidos")
+    
+    invalidar_colecoes(db, "vendas", "itens_venda")
+    return {"vendas": vendas_migradas, "itens": itens_migrados}
+
+# =============================================
+# SERVIÇO DE ENTREGAS
+# =============================================
+
+# vendas.entrega_agendada: False enquanto a venda concluída com entrega ao
+# cliente não tiver entrega ativa, True quando tiver, ausente nas demais
+LIMITE_VENDAS_SEM_ENTREGA = 50
+
+def filtro_vendas_sem_entrega():
+    """Vendas concluídas com entrega ao cliente ainda sem entrega (índice parcial)"""
+    return {"entrega_agendada": False, "status": "concluída", "tipo_entrega": "entrega_ao_cliente"}
+
+def filtro_venda_id(ids):
+    """venda_id em qualquer das formas gravadas: ObjectId ou string legada (pré migrar-chaves)"""
+    return {"$in": list(ids) + [str(i) for i in ids]}
+
+def sincronizar_entrega_agendada(db, ids_vendas, session=None):
+    """Recalcula vendas.entrega_agendada a partir das entregas não canceladas.
+    
+    Uma agregação para as vendas com entrega ativa e um único bulk_write;
+    vendas canceladas não são alteradas.
+    """
+    ids = list({como_object_id(i) for i in ids_vendas} - {None})
+    if not ids:
+        return
+    ativas = {
+        como_object_id(grupo["_id"]) for grupo in db.entregas.aggregate([
+            {"$match": {"venda_id": filtro_venda_id(ids), "status": {"$ne": "cancelada"}}},
+            {"$group": {"_id": "$venda_id"}}
+        ], session=session)
+    }
+    db.vendas.bulk_write([
+        UpdateOne({"_id": venda_id, "status": "concluída"}, {"$set": {"entrega_agendada": venda_id in ativas}})
+        for venda_id in ids
+    ], ordered=False, session=session)
+
+def agendar_entrega(db, nova_entrega):
+    """Grava a entrega e marca a venda como agendada na mesma transação.
+    
+    Lança ValueError se a venda não estiver concluída ou já tiver entrega ativa.
+    A flag pode ainda não ter sido preenchida (backfill-entregas), então as
+    entregas da venda também são consultadas, incluindo venda_id string.
+    """
+    nova_entrega["venda_id"] = ObjectId(nova_entrega["venda_id"])
+    
+    def _transacao(session):
+        ativa = db.entregas.count_documents(
+            {"venda_id": filtro_venda_id([nova_entrega["venda_id"]]), "status": {"$ne": "cancelada"}},
+            limit=1, session=session
+        )
+        if ativa:
+            raise ValueError("Venda já possui entrega agendada ou não está concluída")
+        resultado = db.vendas.update_one(
+            {"_id": nova_entrega["venda_id"], "status": "concluída", "entrega_agendada": {"$ne": True}},
+            {"$set": {"entrega_agendada": True, "custo_entrega": nova_entrega.get("custo_entrega", 0)}},
+            session=session
+        )
+        if not resultado.matched_count:
+            raise ValueError("Venda já possui entrega agendada ou não está concluída")
+        db.entregas.insert_one(nova_entrega, session=session)
+    
+    executar_transacao(db, _transacao)
+    
+    invalidar_colecoes(db, "entregas", "vendas")
+    return nova_entrega
+
+def atualizar_status_entregas(db, ids_entregas, alteracoes):
+    """Aplica `alteracoes` às entregas e ressincroniza a flag das vendas afetadas.
+    
+    Retorna (encontrados, modificados), como atualizar_em_massa.
+    """
+    ids = [ObjectId(i) for i in ids_entregas]
+    
+    def _transacao(session):
+        resultado = db.entregas.update_many({"_id": {"$in": ids}}, {"$set": alteracoes}, session=session)
+        # Só status afeta a flag; cancelar (ou reativar) muda a elegibilidade da venda
+        if "status" in alteracoes:
+            ids_vendas = db.entregas.distinct("venda_id", {"_id": {"$in": ids}}, session=session)
+            sincronizar_entrega_agendada(db, ids_vendas, session=session)
+        return resultado.matched_count, resultado.modified_count
+    
+    contagens = executar_transacao(db, _transacao)
+    
+    invalidar_colecoes(db, "entregas", "vendas")
+    return contagens
+
+def preencher_entrega_agendada(db, tamanho_lote=1000, recalcular=False):
+    """Grava entrega_agendada nas vendas com entrega ao cliente existentes, em lotes por _id"""
+    filtro = {"status": "concluída", "tipo_entrega": "entrega_ao_cliente"}
+    if not recalcular:
+        filtro["entrega_agendada"] = {"$exists": False}
+    atualizadas = 0
+    ultimo_id = None
+    while True:
+        consulta = dict(filtro)
+        if ultimo_id is not None:
+            consulta["_id"] = {"$gt": ultimo_id}
+        ids_vendas = [v["_id"] for v in db.vendas.find(consulta, {"_id": 1}).sort("_id", ASCENDING).limit(tamanho_lote)]
+        if not ids_vendas:
+            break
+        sincronizar_entrega_agendada(db, ids_vendas)
+        atualizadas += len(ids_vendas)
+        ultimo_id = ids_vendas[-1]
+    invalidar_colecoes(db, "vendas")
+    return atualizadas
+
+# =============================================
+# LIVRO DE MOVIMENTAÇÕES DE ESTOQUE
+# =============================================
+
+TAMANHO_PAGINA_MOVIMENTACOES = 20
+
+def registrar_movimentacao(db, produto_id, tipo, quantidade, motivo, responsavel):
+    """Aplica a entrada/saída ao estoque e grava no livro na mesma transação.
+    
+    Retorna o novo estoque; lança ValueError se a saída deixaria o estoque negativo.
+    """
+    delta = quantidade if tipo == "entrada" else -quantidade
+    filtro = {"_id": produto_id}
+    if delta < 0:
+        filtro["estoque"] = {"$gte": quantidade}
+    agora = datetime.now()
+    
+    def _transacao(session):
+        produto = db.produtos.find_one_and_update(
+            filtro,
+            {"$inc": {"estoque": delta}, "$set": {"ultima_atualizacao": agora}},
+            projection={"estoque": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if produto is None:
+            raise ValueError("Estoque insuficiente para registrar a saída!")
+        
+        db.movimentacoes_estoque.insert_one({
+            "produto_id": produto_id,
+            "tipo": tipo,
+            "quantidade": quantidade,
+            "data": agora,
+            "motivo": motivo if motivo else None,
+            "responsavel": responsavel,
+            "estoque_resultante": produto["estoque"]
+        }, session=session)
+        return produto["estoque"]
+    
+    novo_estoque = executar_transacao(db, _transacao)
+    
+    invalidar_colecoes(db, "produtos", "movimentacoes_estoque")
+    return novo_estoque
+
+# Registros legados sem data/tipo: ficam no fim do histórico e são exibidos como desconhecidos
+DATA_MOVIMENTACAO_DESCONHECIDA = datetime(1970, 1, 1)
+TIPO_MOVIMENTACAO_DESCONHECIDO = "desconhecido"
+
+def historico_movimentacoes(db, produto_id, antes_de=None, limite=TAMANHO_PAGINA_MOVIMENTACOES):
+    """Movimentações mais recentes primeiro, paginadas pelo cursor (data, _id).
+    
+    Busca um documento a mais que `limite` para indicar se há próxima página.
+    """
+    filtro = {"produto_id": produto_id}
+    if antes_de:
+        data, mov_id = antes_de
+        filtro["$or"] = [
+            {"data": {"$lt": data}},
+            {"data": data, "_id": {"$lt": mov_id}}
+        ]
+    return list(
+        db.movimentacoes_estoque.find(filtro)
+        .sort([("data", DESCENDING), ("_id", DESCENDING)])
+        .limit(limite + 1)
+    )
+
+def migrar_movimentacoes(db, tamanho_lote=100):
+    """Move os arrays produtos.movimentacoes para movimentacoes_estoque.
+    
+    Cada lote é copiado e removido do produto na mesma transação, então a
+    migração pode ser interrompida e executada novamente sem duplicar registros.
+    """
+    produtos_migrados, registros = 0, 0
+    while True:
+        lote = list(db.produtos.find(
+            {"movimentacoes": {"$exists": True}},
+            {"movimentacoes": 1}
+        ).limit(tamanho_lote))
+        if not lote:
+            break
+        
+        documentos = [
+            {
+                "produto_id": produto["_id"],
+                "tipo": mov.get("tipo") or TIPO_MOVIMENTACAO_DESCONHECIDO,
+                "quantidade": mov.get("quantidade") or 0,
+                "data": mov.get("data") or DATA_MOVIMENTACAO_DESCONHECIDA,
+                "motivo": mov.get("motivo"),
+                "responsavel": mov.get("responsavel")
+            }
+            for produto in lote
+            for mov in (produto.get("movimentacoes") or [])
+        ]
+        
+        def _transacao(session):
+            if documentos:
+                db.movimentacoes_estoque.insert_many(documentos, session=session)
+            db.produtos.update_many(
+                {"_id": {"$in": [produto["_id"] for produto in lote]}},
+                {"$unset": {"movimentacoes": ""}},
+                session=session
+            )
+        
+        executar_transacao(db, _transacao)
+        
+        produtos_migrados += len(lote)
+        registros += len(documentos)
+        print(f"  {produtos_migrados} produtos, {registros} movimentações migradas")
+    
+    # Registros migrados antes dos valores padrão: data nula quebraria o cursor (data, _id)
+    db.movimentacoes_estoque.update_many({"data": None}, {"$set": {"data": DATA_MOVIMENTACAO_DESCONHECIDA}})
+    db.movimentacoes_estoque.update_many({"tipo": None}, {"$set": {"tipo": TIPO_MOVIMENTACAO_DESCONHECIDO}})
+    
+    invalidar_colecoes(db, "produtos", "movimentacoes_estoque")
+    return {"produtos": produtos_migrados, "movimentacoes": registros}
+
 # =============================================
 # SISTEMA DE AUTENTICAÇÃO
 # =============================================
@@ -92,7 +1191,7 @@ def inicializar_autenticacao():
         st.session_state.pagina_atual = "menu"
 
 def verificar_credenciais(db, username, password):
-    usuario = db.usuarios.find_one({"username": username, "ativo": True})
+    usuario = db.usuarios.find_one({"username": username, "ativo": True}, PROJECAO_SESSAO_USUARIO)
     if usuario:
         password_hash = hashlib.sha256(password.encode()).hexdigest()
         if usuario['password_hash'] == password_hash:
@@ -208,7 +1307,7 @@ def modulo_usuarios(db):
     with tab1:
         st.subheader("Usuários Cadastrados")
         
-        usuarios = list(db.usuarios.find().sort("nome", 1))
+        usuarios = list(db.usuarios.find({}, PROJECAO_LISTA_USUARIOS).sort("nome", 1))
         
         if not usuarios:
             st.info("Nenhum usuário cadastrado.")
@@ -228,7 +1327,8 @@ def modulo_usuarios(db):
 
             df = pd.DataFrame(dados)
             
-            edited_df = st.data_editor(
+            chave_editor = f"editor_usuarios_{st.session_state.get('versao_editor_usuarios', 0)}"
+            st.data_editor(
                 df,
                 column_config={
                     "ID": st.column_config.Column(disabled=True),
@@ -240,18 +1340,19 @@ def modulo_usuarios(db):
                 },
                 hide_index=True,
                 use_container_width=True,
-                key="editor_usuarios"
+                key=chave_editor
             )
+            acoes = acoes_editadas(chave_editor, df)
             
-            if not edited_df[edited_df['Ações'] == "Inativar"].empty:
+            if "Inativar" in acoes:
                 st.warning("⚠️ Atenção: Esta ação desativará o acesso do usuário!")
                 if st.button("Confirmar Inativação", type="primary"):
-                    for idx, row in edited_df[edited_df['Ações'] == "Inativar"].iterrows():
-                        db.usuarios.update_one(
-                            {"_id": ObjectId(row['ID'])},
-                            {"$set": {"ativo": False}}
-                        )
-                    st.success("Usuários inativados com sucesso!")
+                    encontrados, modificados = atualizar_em_massa(
+                        db.usuarios, acoes["Inativar"], {"ativo": False}
+                    )
+                    st.success(f"Usuários inativados com sucesso! ({modificados} de {encontrados} alterados)")
+                    # descarta as marcações já aplicadas
+                    st.session_state.versao_editor_usuarios = st.session_state.get('versao_editor_usuarios', 0) + 1
                     st.rerun()
     
     with tab2:
@@ -308,6 +1409,21 @@ def modulo_usuarios(db):
 # FUNÇÕES AUXILIARES
 # =============================================
 
+# Projeções: cada tela declara apenas os campos que exibe
+PROJECAO_SESSAO_USUARIO = {"nome": 1, "username": 1, "password_hash": 1, "nivel_acesso": 1}
+PROJECAO_LISTA_USUARIOS = {"nome": 1, "username": 1, "email": 1, "nivel_acesso": 1, "ultimo_login": 1, "ativo": 1}
+PROJECAO_LISTA_CLIENTES = {
+    "nome": 1, "contato.celular": 1, "contato.email": 1, "tipo": 1,
+    "status": 1, "compras_realizadas": 1, "total_gasto": 1
+}
+PROJECAO_LISTA_PRODUTOS = {"nome": 1, "codigo": 1, "categoria": 1, "preco_venda": 1, "estoque": 1, "ativo": 1}
+PROJECAO_CLIENTES_VENDA = {"nome": 1, "tipo": 1, "contato.celular": 1}
+PROJECAO_PRODUTOS_VENDA = {"nome": 1, "estoque": 1, "preco_venda": 1, "custo_producao": 1}
+PROJECAO_HISTORICO_VENDAS = {
+    "data_venda": 1, "cliente_id": 1, "valor_total": 1,
+    "metodo_pagamento": 1, "status": 1, "itens_count": 1
+}
+
 def format_date(dt):
     return dt.strftime("%d/%m/%Y %H:%M") if dt else "Não informado"
 
@@ -317,6 +1433,45 @@ def format_currency(value):
 def date_to_datetime(date_obj):
     return datetime.combine(date_obj, datetime.min.time())
 
+def como_object_id(valor):
+    """Converte ids gravados como string para ObjectId (None se inválido)"""
+    if isinstance(valor, ObjectId):
+        return valor
+    try:
+        return ObjectId(valor)
+    except (InvalidId, TypeError):
+        return None
+
+def filtro_codigo(codigo):
+    """Produto pelo SKU. O $type repete o filtro do índice parcial "codigo"
+    (produtos sem código gravam None), condição para o planejador usá-lo."""
+    return {"codigo": {"$eq": codigo, "$type": "string"}}
+
+def juntar_vendas_clientes(db, entregas):
+    """Associa cada entrega à sua venda e cliente com duas consultas em lote ($in)"""
+    ids_vendas = {como_object_id(e.get("venda_id")) for e in entregas} - {None}
+    vendas = {
+        v["_id"]: v for v in db.vendas.find(
+            {"_id": {"$in": list(ids_vendas)}},
+            {"cliente_id": 1, "valor_total": 1}
+        )
+    } if ids_vendas else {}
+    
+    ids_clientes = {como_object_id(v.get("cliente_id")) for v in vendas.values()} - {None}
+    clientes = {
+        c["_id"]: c for c in db.clientes.find(
+            {"_id": {"$in": list(ids_clientes)}},
+            {"nome": 1}
+        )
+    } if ids_clientes else {}
+    
+    resultado = []
+    for entrega in entregas:
+        venda = vendas.get(como_object_id(entrega.get("venda_id")))
+        cliente = clientes.get(como_object_id(venda.get("cliente_id"))) if venda else None
+        resultado.append((entrega, venda, cliente))
+    return resultado
+
 def generate_excel(df):
     output = BytesIO()
     writer = pd.ExcelWriter(output, engine='xlsxwriter')
@@ -325,6 +1480,215 @@ def generate_excel(df):
     processed_data = output.getvalue()
     return processed_data
 
+# =============================================
+# PAGINAÇÃO POR CHAVE ((nome, _id) e (data, _id))
+# =============================================
+
+TAMANHOS_PAGINA = [25, 50, 100, 200]
+LIMITE_CONTAGEM = 10000
+
+def estado_paginacao(chave, assinatura):
+    """Pilha de cursores da grade na sessão; reinicia quando filtros ou tamanho mudam.
+    
+    `versao` muda a cada navegação e compõe a chave do data_editor, para que
+    edições de uma página não sejam aplicadas às linhas de outra.
+    """
+    estado = st.session_state.get(chave)
+    if estado is None or estado["assinatura"] != assinatura:
+        versao = estado["versao"] + 1 if estado else 0
+        estado = {"assinatura": assinatura, "cursores": [None], "versao": versao}
+        st.session_state[chave] = estado
+    return estado
+
+def pagina_por_nome(colecao, filtro, projecao, cursor, tamanho):
+    """Uma página ordenada por (nome, _id) começando após o cursor (nome, _id)"""
+    consulta = filtro
+    if cursor:
+        nome, doc_id = cursor
+        consulta = {"$and": [filtro, {"$or": [
+            {"nome": {"$gt": nome}},
+            {"nome": nome, "_id": {"$gt": doc_id}}
+        ]}]}
+    documentos = list(
+        colecao.find(consulta, projecao)
+        .sort([("nome", ASCENDING), ("_id", ASCENDING)])
+        .limit(tamanho + 1)
+    )
+    return documentos[:tamanho], len(documentos) > tamanho
+
+def pagina_por_data(colecao, filtro, projecao, cursor, tamanho, campo="data_venda"):
+    """Uma página da mais recente para a mais antiga por (campo, _id), após o cursor"""
+    consulta = filtro
+    if cursor:
+        data, doc_id = cursor
+        consulta = {"$and": [filtro, {"$or": [
+            {campo: {"$lt": data}},
+            {campo: data, "_id": {"$lt": doc_id}}
+        ]}]}
+    documentos = list(
+        colecao.find(consulta, projecao)
+        .sort([(campo, DESCENDING), ("_id", DESCENDING)])
+        .limit(tamanho + 1)
+    )
+    return documentos[:tamanho], len(documentos) > tamanho
+
+def contagem_aproximada(colecao, filtro):
+    """Total estimado: metadados da coleção sem filtro, contagem limitada com filtro"""
+    if not filtro:
+        return f"~{colecao.estimated_document_count():,}".replace(",", ".")
+    total = colecao.count_documents(filtro, limit=LIMITE_CONTAGEM)
+    return f"{LIMITE_CONTAGEM:,}+".replace(",", ".") if total >= LIMITE_CONTAGEM else str(total)
+
+def navegacao_paginas(estado, documentos, tem_proxima, total, chave, campo="nome"):
+    """Botões anterior/próxima e indicador de página"""
+    col_nav1, col_nav2, col_nav3 = st.columns([1, 2, 1])
+    with col_nav1:
+        if len(estado["cursores"]) > 1 and st.button("⬅️ Anterior", key=f"{chave}_anterior", use_container_width=True):
+            estado["cursores"].pop()
+            estado["versao"] += 1
+            st.rerun()
+    with col_nav2:
+        st.caption(f"Página {len(estado['cursores'])} · {total} registros")
+    with col_nav3:
+        if tem_proxima and st.button("Próxima ➡️", key=f"{chave}_proxima", use_container_width=True):
+            estado["cursores"].append((documentos[-1][campo], documentos[-1]["_id"]))
+            estado["versao"] += 1
+            st.rerun()
+
+# =============================================
+# BUSCA NORMALIZADA (sem acentos, por prefixo de palavra)
+# =============================================
+
+COLECOES_BUSCA = ("clientes", "produtos")
+LIMITE_SUGESTOES = 10
+
+def normalizar_texto(texto):
+    """Minúsculas e sem acentos: 'Conceição' -> 'conceicao'"""
+    decomposto = unicodedata.normalize("NFKD", texto or "")
+    return "".join(c for c in decomposto if not unicodedata.combining(c)).lower()
+
+def palavras_busca(texto):
+    return re.findall(r"[a-z0-9]+", normalizar_texto(texto))
+
+def campos_busca(nome, celular=None, cpf=None):
+    """Campos gravados junto do documento para a busca indexada.
+    
+    Celular e CPF entram só com dígitos; o celular entra também sem o DDD,
+    para que a busca funcione digitando apenas o número.
+    """
+    tokens = set(palavras_busca(nome))
+    digitos_celular = re.sub(r"\D", "", celular or "")
+    digitos_cpf = re.sub(r"\D", "", cpf or "")
+    if len(digitos_celular) >= 10:
+        tokens.add(digitos_celular[2:])
+    tokens.update(d for d in (digitos_celular, digitos_cpf) if d)
+    return {"tokens_busca": sorted(tokens)}
+
+def campos_busca_documento(documento):
+    return campos_busca(
+        documento.get("nome"),
+        (documento.get("contato") or {}).get("celular"),
+        documento.get("cpf")
+    )
+
+def filtro_busca(termo):
+    """Cada palavra digitada deve ser prefixo de uma palavra do nome.
+    
+    Expressões ancoradas (^) sobre tokens_busca usam o índice como faixa;
+    o termo é escapado, então nunca é interpretado como regex do usuário.
+    """
+    palavras = palavras_busca(termo)
+    if palavras and not re.search(r"[a-z]", normalizar_texto(termo)):
+        # Só números e pontuação: celular ou CPF formatado vira um único prefixo
+        palavras = ["".join(palavras)]
+    if not palavras:
+        return {}
+    return {"$and": [{"tokens_busca": {"$regex": "^" + re.escape(palavra)}} for palavra in palavras]}
+
+def preencher_campos_busca(db, tamanho_lote=1000, recalcular=False):
+    """Grava tokens_busca nos documentos existentes, em lotes por _id"""
+    resultado = {}
+    for nome_colecao in COLECOES_BUSCA:
+        colecao = db[nome_colecao]
+        filtro = {} if recalcular else {"tokens_busca": {"$exists": False}}
+        atualizados = 0
+        ultimo_id = None
+        while True:
+            consulta = dict(filtro)
+            if ultimo_id is not None:
+                consulta["_id"] = {"$gt": ultimo_id}
+            lote = list(
+                colecao.find(consulta, {"nome": 1, "contato.celular": 1, "cpf": 1})
+                .sort("_id", ASCENDING)
+                .limit(tamanho_lote)
+            )
+            if not lote:
+                break
+            colecao.bulk_write([
+                UpdateOne({"_id": doc["_id"]}, {"$set": campos_busca_documento(doc)})
+                for doc in lote
+            ], ordered=False)
+            atualizados += len(lote)
+            ultimo_id = lote[-1]["_id"]
+        resultado[nome_colecao] = atualizados
+    invalidar_colecoes(db, *COLECOES_BUSCA)
+    return resultado
+
+def sugestoes_busca(colecao, termo, filtro, projecao, limite=LIMITE_SUGESTOES):
+    """Primeiras `limite` correspondências lidas do índice tokens_busca, ordenadas por nome.
+    
+    Sem ordenação no servidor: a leitura para após `limite` documentos,
+    então a latência não depende do tamanho da coleção.
+    """
+    busca = filtro_busca(termo)
+    if not busca:
+        return []
+    documentos = colecao.find({**filtro, **busca}, projecao).hint("tokens_busca").limit(limite)
+    return sorted(documentos, key=lambda d: normalizar_texto(d.get("nome")))
+
+# =============================================
+# AÇÕES EM MASSA DAS GRADES
+# =============================================
+
+def linhas_editadas(chave):
+    """Delta que o data_editor guarda na sessão: {posição da linha: {coluna: novo valor}}"""
+    return st.session_state.get(chave, {}).get("edited_rows", {})
+
+def acoes_editadas(chave, df):
+    """IDs por ação marcada na coluna 'Ações', lidos só das linhas alteradas"""
+    acoes = {}
+    for linha, alteracoes in linhas_editadas(chave).items():
+        acao = alteracoes.get("Ações", "Manter")
+        if acao != "Manter":
+            acoes.setdefault(acao, []).append(df["ID"].iat[int(linha)])
+    return acoes
+
+def atualizar_em_massa(colecao, ids, alteracoes):
+    """Aplica $set a todos os ids num único update_many; retorna (encontrados, modificados)"""
+    resultado = colecao.update_many(
+        {"_id": {"$in": [ObjectId(i) for i in ids]}},
+        {"$set": alteracoes}
+    )
+    return resultado.matched_count, resultado.modified_count
+
+def excluir_em_massa(colecao, ids):
+    """Remove todos os ids num único delete_many; retorna a quantidade removida"""
+    return colecao.delete_many({"_id": {"$in": [ObjectId(i) for i in ids]}}).deleted_count
+
+def ids_referenciados(colecao, campo, ids):
+    """Quais ids aparecem em colecao.campo, numa única agregação.
+    
+    $sort + $group pelo campo indexado vira DISTINCT_SCAN: uma entrada de
+    índice por id, por mais vendas ou itens que cada um tenha.
+    """
+    candidatos = [ObjectId(i) for i in ids] + list(ids)  # chaves legadas gravadas como string
+    pipeline = [{"$match": {campo: {"$in": candidatos}}}]
+    if "." in campo:
+        # Campo dentro de um array (vendas.itens): um documento por elemento antes de agrupar
+        pipeline += [{"$unwind": "$" + campo.split(".")[0]}, {"$match": {campo: {"$in": candidatos}}}]
+    pipeline += [{"$sort": {campo: 1}}, {"$group": {"_id": f"${campo}"}}]
+    return {str(doc["_id"]) for doc in colecao.aggregate(pipeline)}
+
 # =============================================
 # MÓDULO DE CLIENTES
 # =============================================
@@ -382,11 +1746,12 @@ def modulo_clientes(db):
                             "ultima_atualizacao": datetime.now(),
                             "status": "ativo",
                             "tipo": tipo_cliente.lower().replace(" ", "_"),
-                            "compras_realizadas": 0,
-                            "total_gasto": 0.0
+                            **campos_estatisticas(estatisticas_cliente()),
+                            **campos_busca(nome, celular, cpf)
                         }
 
                         clientes_col.insert_one(novo_cliente)
+                        invalidar_colecoes(db, "clientes")
                         st.success("Cliente cadastrado com sucesso!")
                         st.balloons()
                         pytime.sleep(1.5)
@@ -398,23 +1763,28 @@ def modulo_clientes(db):
         st.subheader("Clientes Cadastrados")
         
         with st.expander("🔍 Filtros", expanded=True):
-            col_f1, col_f2 = st.columns(2)
+            col_f1, col_f2, col_f3 = st.columns([2, 1, 1])
             with col_f1:
-                filtro_nome = st.text_input("Buscar por nome")
+                filtro_nome = st.text_input("Buscar por nome", help="Início de qualquer palavra do nome, com ou sem acento")
             with col_f2:
                 filtro_status = st.selectbox(
                     "Status",
                     ["Ativos", "Inativos", "Todos"],
                     index=0
                 )
+            with col_f3:
+                tamanho_pagina = st.selectbox("Por página", TAMANHOS_PAGINA, index=1, key="clientes_por_pagina")
         
         query = {}
         if filtro_nome:
-            query["nome"] = {"$regex": filtro_nome, "$options": "i"}
+            query.update(filtro_busca(filtro_nome))
         if filtro_status != "Todos":
             query["status"] = "ativo" if filtro_status == "Ativos" else "inativo"
             
-        clientes = list(clientes_col.find(query).sort("nome", 1))
+        paginacao = estado_paginacao("paginacao_clientes", (filtro_nome, filtro_status, tamanho_pagina))
+        clientes, tem_proxima = pagina_por_nome(
+            clientes_col, query, PROJECAO_LISTA_CLIENTES, paginacao["cursores"][-1], tamanho_pagina
+        )
         
         if not clientes:
             st.info("Nenhum cliente encontrado com os critérios selecionados.")
@@ -438,7 +1808,8 @@ def modulo_clientes(db):
 
             df = pd.DataFrame(dados)
             
-            edited_df = st.data_editor(
+            chave_editor = f"editor_clientes_{paginacao['versao']}"
+            st.data_editor(
                 df,
                 column_config={
                     "ID": st.column_config.Column(disabled=True),
@@ -451,48 +1822,47 @@ def modulo_clientes(db):
                 },
                 hide_index=True,
                 use_container_width=True,
-                key="editor_clientes"
+                key=chave_editor
+            )
+            acoes = acoes_editadas(chave_editor, df)
+            
+            navegacao_paginas(
+                paginacao, clientes, tem_proxima, contagem_aproximada(clientes_col, query), "pag_clientes"
             )
             
             # Processar ações selecionadas
-            if not edited_df[edited_df['Ações'] != "Manter"].empty:
+            if acoes:
                 st.warning("⚠️ Atenção: Ações em massa serão aplicadas!")
                 
                 col1, col2 = st.columns(2)
                 
                 # Ação de inativar
-                if not edited_df[edited_df['Ações'] == "Inativar"].empty:
+                if "Inativar" in acoes:
                     with col1:
                         if st.button("Confirmar Inativação", key="btn_inativar_clientes"):
-                            for idx, row in edited_df[edited_df['Ações'] == "Inativar"].iterrows():
-                                clientes_col.update_one(
-                                    {"_id": ObjectId(row['ID'])},
-                                    {"$set": {"status": "inativo"}}
-                                )
-                            st.success("Clientes inativados com sucesso!")
+                            encontrados, modificados = atualizar_em_massa(
+                                clientes_col, acoes["Inativar"], {"status": "inativo"}
+                            )
+                            invalidar_colecoes(db, "clientes")
+                            st.success(f"Clientes inativados com sucesso! ({modificados} de {encontrados} alterados)")
+                            paginacao["versao"] += 1  # descarta as marcações já aplicadas
                             st.rerun()
                 
                 # Ação de excluir
-                if not edited_df[edited_df['Ações'] == "Excluir"].empty:
+                if "Excluir" in acoes:
                     with col2:
                         if st.button("Confirmar Exclusão", type="primary", key="btn_excluir_clientes"):
                             # Verificar se há vendas associadas aos clientes
-                            clientes_para_excluir = edited_df[edited_df['Ações'] == "Excluir"]
-                            tem_vendas = False
+                            clientes_para_excluir = acoes["Excluir"]
+                            com_vendas = ids_referenciados(db['vendas'], "cliente_id", clientes_para_excluir)
                             
-                            for idx, row in clientes_para_excluir.iterrows():
-                                cliente_id = row['ID']
-                                # Verificar se existem vendas associadas
-                                if db['vendas'].count_documents({"cliente_id": cliente_id}) > 0:
-                                    tem_vendas = True
-                                    break
-                            
-                            if tem_vendas:
-                                st.error("Alguns clientes possuem vendas associadas e não podem ser excluídos!")
+                            if com_vendas:
+                                st.error(f"{len(com_vendas)} cliente(s) possuem vendas associadas e não podem ser excluídos!")
                             else:
-                                for idx, row in clientes_para_excluir.iterrows():
-                                    clientes_col.delete_one({"_id": ObjectId(row['ID'])})
-                                st.success("Clientes excluídos com sucesso!")
+                                excluidos = excluir_em_massa(clientes_col, clientes_para_excluir)
+                                invalidar_colecoes(db, "clientes")
+                                st.success(f"Clientes excluídos com sucesso! ({excluidos} removidos)")
+                                paginacao["versao"] += 1  # descarta as marcações já aplicadas
                                 st.rerun()
 
 # =============================================
@@ -510,9 +1880,9 @@ def modulo_produtos(db):
         st.subheader("Produtos Cadastrados")
         
         with st.expander("🔍 Filtros", expanded=True):
-            col_f1, col_f2, col_f3 = st.columns(3)
+            col_f1, col_f2, col_f3, col_f4 = st.columns(4)
             with col_f1:
-                filtro_nome = st.text_input("Buscar por nome")
+                filtro_nome = st.text_input("Buscar por nome", help="Início de qualquer palavra do nome, com ou sem acento")
             with col_f2:
                 filtro_categoria = st.selectbox(
                     "Categoria",
@@ -525,10 +1895,12 @@ def modulo_produtos(db):
                     ["Todos", "Disponível", "Estoque Baixo", "Esgotado"],
                     index=0
                 )
+            with col_f4:
+                tamanho_pagina = st.selectbox("Por página", TAMANHOS_PAGINA, index=1, key="produtos_por_pagina")
         
         query = {}
         if filtro_nome:
-            query["nome"] = {"$regex": filtro_nome, "$options": "i"}
+            query.update(filtro_busca(filtro_nome))
         if filtro_categoria != "Todas":
             query["categoria"] = filtro_categoria
         if filtro_estoque == "Disponível":
@@ -538,7 +1910,12 @@ def modulo_produtos(db):
         elif filtro_estoque == "Esgotado":
             query["estoque"] = 0
             
-        produtos = list(produtos_col.find(query).sort("nome", 1))
+        paginacao = estado_paginacao(
+            "paginacao_produtos", (filtro_nome, filtro_categoria, filtro_estoque, tamanho_pagina)
+        )
+        produtos, tem_proxima = pagina_por_nome(
+            produtos_col, query, PROJECAO_LISTA_PRODUTOS, paginacao["cursores"][-1], tamanho_pagina
+        )
         
         if not produtos:
             st.info("Nenhum produto encontrado com os filtros selecionados.")
@@ -558,7 +1935,8 @@ def modulo_produtos(db):
 
             df = pd.DataFrame(dados)
             
-            edited_df = st.data_editor(
+            chave_editor = f"editor_produtos_{paginacao['versao']}"
+            st.data_editor(
                 df,
                 column_config={
                     "ID": st.column_config.Column(disabled=True),
@@ -577,48 +1955,48 @@ def modulo_produtos(db):
                 },
                 hide_index=True,
                 use_container_width=True,
-                key="editor_produtos"
+                key=chave_editor
+            )
+            acoes = acoes_editadas(chave_editor, df)
+            
+            navegacao_paginas(
+                paginacao, produtos, tem_proxima, contagem_aproximada(produtos_col, query), "pag_produtos"
             )
             
             # Processar ações selecionadas
-            if not edited_df[edited_df['Ações'] != "Manter"].empty:
+            if acoes:
                 st.warning("⚠️ Atenção: Ações em massa serão aplicadas!")
                 
                 col1, col2 = st.columns(2)
                 
                 # Ação de inativar
-                if not edited_df[edited_df['Ações'] == "Inativar"].empty:
+                if "Inativar" in acoes:
                     with col1:
                         if st.button("Confirmar Inativação", key="btn_inativar_produtos"):
-                            for idx, row in edited_df[edited_df['Ações'] == "Inativar"].iterrows():
-                                produtos_col.update_one(
-                                    {"_id": ObjectId(row['ID'])},
-                                    {"$set": {"ativo": False}}
-                                )
-                            st.success("Produtos inativados com sucesso!")
+                            encontrados, modificados = atualizar_em_massa(
+                                produtos_col, acoes["Inativar"], {"ativo": False}
+                            )
+                            invalidar_colecoes(db, "produtos")
+                            st.success(f"Produtos inativados com sucesso! ({modificados} de {encontrados} alterados)")
+                            paginacao["versao"] += 1  # descarta as marcações já aplicadas
                             st.rerun()
                 
                 # Ação de excluir
-                if not edited_df[edited_df['Ações'] == "Excluir"].empty:
+                if "Excluir" in acoes:
                     with col2:
                         if st.button("Confirmar Exclusão", type="primary", key="btn_excluir_produtos"):
-                            # Verificar se há vendas associadas aos produtos
-                            produtos_para_excluir = edited_df[edited_df['Ações'] == "Excluir"]
-                            tem_vendas = False
-                            
-                            for idx, row in produtos_para_excluir.iterrows():
-                                produto_id = row['ID']
-                                # Verificar se existem itens de venda associados
-                                if db['itens_venda'].count_documents({"produto_id": produto_id}) > 0:
-                                    tem_vendas = True
-                                    break
+                            # Verificar se há itens de venda associados aos produtos
+                            produtos_para_excluir = acoes["Excluir"]
+                            com_vendas = ids_referenciados(db['itens_venda'], "produto_id", produtos_para_excluir)
+                            com_vendas |= ids_referenciados(db['vendas'], "itens.produto_id", produtos_para_excluir)
                             
-                            if tem_vendas:
-                                st.error("Alguns produtos possuem vendas associadas e não podem ser excluídos!")
+                            if com_vendas:
+                                st.error(f"{len(com_vendas)} produto(s) possuem vendas associadas e não podem ser excluídos!")
                             else:
-                                for idx, row in produtos_para_excluir.iterrows():
-                                    produtos_col.delete_one({"_id": ObjectId(row['ID'])})
-                                st.success("Produtos excluídos com sucesso!")
+                                excluidos = excluir_em_massa(produtos_col, produtos_para_excluir)
+                                invalidar_colecoes(db, "produtos")
+                                st.success(f"Produtos excluídos com sucesso! ({excluidos} removidos)")
+                                paginacao["versao"] += 1  # descarta as marcações já aplicadas
                                 st.rerun()
 
     with tab2:
@@ -650,7 +2028,7 @@ def modulo_produtos(db):
                     try:
                         novo_produto = {
                             "nome": nome,
-                            "codigo": codigo if codigo else None,
+                            "codigo": codigo.strip() or None,
                             "categoria": categoria,
                             "descricao": descricao,
                             "ingredientes": ingredientes,
@@ -660,33 +2038,47 @@ def modulo_produtos(db):
                             "data_cadastro": datetime.now(),
                             "ultima_atualizacao": datetime.now(),
                             "ativo": True,
-                            "destaque": False
+                            "destaque": False,
+                            **campos_busca(nome)
                         }
                         
                         produtos_col.insert_one(novo_produto)
+                        invalidar_colecoes(db, "produtos")
                         st.success("Produto cadastrado com sucesso!")
                         st.balloons()
                         pytime.sleep(1.5)
                         st.rerun()
+                    except DuplicateKeyError:
+                        st.error(f"Já existe um produto com o código {codigo.strip()}!")
                     except Exception as e:
                         st.error(f"Erro ao cadastrar produto: {str(e)}")
 
     with tab3:
         st.subheader("Gerenciamento de Estoque")
         
-        produtos_estoque = list(produtos_col.find({"ativo": True}).sort("nome", 1))
+        opcoes_estoque = mapa_opcoes(
+            db, "produtos_estoque", "produtos", {"ativo": True}, {"nome": 1, "estoque": 1},
+            lambda p: f"{p['nome']} (Estoque: {p['estoque']})"
+        )
         
-        if not produtos_estoque:
+        if not opcoes_estoque:
             st.info("Nenhum produto ativo disponível para gerenciamento de estoque.")
         else:
-            produto_selecionado = st.selectbox(
+            selecao = st.selectbox(
                 "Selecione o produto",
-                [p["_id"] for p in produtos_estoque],
-                format_func=lambda x: next(f"{p['nome']} (Estoque: {p['estoque']})" for p in produtos_estoque if p["_id"] == x)
+                list(opcoes_estoque),
+                format_func=opcoes_estoque.get
             )
+            produto_selecionado = ObjectId(selecao) if selecao else None
+            # Leitura pontual: o rótulo em cache pode ser de um produto já excluído ou inativado
+            produto = produtos_col.find_one(
+                {"_id": produto_selecionado, "ativo": True}, {"nome": 1, "estoque": 1}
+            ) if produto_selecionado else None
             
-            if produto_selecionado:
-                produto = produtos_col.find_one({"_id": produto_selecionado})
+            if produto_selecionado and not produto:
+                descartar_mapa_opcoes(db, "produtos_estoque")
+                st.warning("Este produto não está mais disponível. Selecione outro.")
+            elif produto_selecionado:
                 st.write(f"**Produto selecionado:** {produto['nome']}")
                 st.write(f"**Estoque atual:** {produto['estoque']} unidades")
                 
@@ -703,23 +2095,12 @@ def modulo_produtos(db):
                         motivo_entrada = st.text_input("Motivo da entrada (opcional)")
                         
                         if st.form_submit_button("Registrar Entrada"):
-                            novo_estoque = produto["estoque"] + entrada
-                            produtos_col.update_one(
-                                {"_id": produto_selecionado},
-                                {
-                                    "$set": {"estoque": novo_estoque},
-                                    "$push": {
-                                        "movimentacoes": {
-                                            "tipo": "entrada",
-                                            "quantidade": entrada,
-                                            "data": datetime.now(),
-                                            "motivo": motivo_entrada if motivo_entrada else None,
-                                            "responsavel": "Sistema"
-                                        }
-                                    }
-                                }
+                            novo_estoque = registrar_movimentacao(
+                                db, produto_selecionado, "entrada", entrada, motivo_entrada, "Sistema"
                             )
                             st.success(f"Entrada de {entrada} unidades registrada. Novo estoque: {novo_estoque}")
+                            # A nova movimentação fica na primeira página do histórico
+                            st.session_state.pop(f"paginas_mov_{produto_selecionado}", None)
                             st.rerun()
                 
                 with col_m2:
@@ -734,44 +2115,56 @@ def modulo_produtos(db):
                         motivo_saida = st.text_input("Motivo da saída (opcional)")
                         
                         if st.form_submit_button("Registrar Saída"):
-                            novo_estoque = produto["estoque"] - saida
-                            produtos_col.update_one(
-                                {"_id": produto_selecionado},
-                                {
-                                    "$set": {"estoque": novo_estoque},
-                                    "$push": {
-                                        "movimentacoes": {
-                                            "tipo": "saída",
-                                            "quantidade": saida,
-                                            "data": datetime.now(),
-                                            "motivo": motivo_saida if motivo_saida else None,
-                                            "responsavel": "Sistema"
-                                        }
-                                    }
-                                }
-                            )
-                            st.success(f"Saída de {saida} unidades registrada. Novo estoque: {novo_estoque}")
-                            st.rerun()
+                            try:
+                                novo_estoque = registrar_movimentacao(
+                                    db, produto_selecionado, "saída", saida, motivo_saida, "Sistema"
+                                )
+                                st.success(f"Saída de {saida} unidades registrada. Novo estoque: {novo_estoque}")
+                                st.session_state.pop(f"paginas_mov_{produto_selecionado}", None)
+                                st.rerun()
+                            except ValueError as e:
+                                st.error(str(e))
+                
+                # Histórico paginado por (data, _id): a pilha guarda o cursor de início de cada página
+                chave_paginas = f"paginas_mov_{produto_selecionado}"
+                if chave_paginas not in st.session_state:
+                    st.session_state[chave_paginas] = [None]
+                paginas = st.session_state[chave_paginas]
+                
+                movimentacoes = historico_movimentacoes(db, produto_selecionado, antes_de=paginas[-1])
+                tem_proxima = len(movimentacoes) > TAMANHO_PAGINA_MOVIMENTACOES
+                movimentacoes = movimentacoes[:TAMANHO_PAGINA_MOVIMENTACOES]
                 
-                if "movimentacoes" in produto and produto["movimentacoes"]:
+                if movimentacoes:
                     st.subheader("Histórico de Movimentações")
-                    historico = sorted(
-                        produto["movimentacoes"], 
-                        key=lambda x: x["data"], 
-                        reverse=True
-                    )[:20]
                     
-                    for mov in historico:
-                        cor = "green" if mov["tipo"] == "entrada" else "red"
+                    for mov in movimentacoes:
+                        tipo = mov.get("tipo") or TIPO_MOVIMENTACAO_DESCONHECIDO
+                        data = mov.get("data")
+                        cor = "green" if tipo == "entrada" else "red"
+                        quando = (
+                            data.strftime('%d/%m/%Y %H:%M')
+                            if data and data != DATA_MOVIMENTACAO_DESCONHECIDA else "Data desconhecida"
+                        )
                         st.markdown(
                             f"""
                             <div style="border-left: 4px solid {cor}; padding-left: 10px; margin: 5px 0;">
-                                <b>{mov['tipo'].upper()}</b> - {mov['quantidade']} unidades<br>
-                                <small>{mov['data'].strftime('%d/%m/%Y %H:%M')} | {mov.get('motivo', 'Sem motivo informado')}</small>
+                                <b>{tipo.upper()}</b> - {mov.get('quantidade', 0)} unidades<br>
+                                <small>{quando} | {mov.get('motivo') or 'Sem motivo informado'}</small>
                             </div>
                             """,
                             unsafe_allow_html=True
                         )
+                    
+                    col_nav1, col_nav2 = st.columns(2)
+                    with col_nav1:
+                        if len(paginas) > 1 and st.button("⬅️ Mais recentes", key="mov_anteriores"):
+                            paginas.pop()
+                            st.rerun()
+                    with col_nav2:
+                        if tem_proxima and st.button("Mais antigas ➡️", key="mov_proximas"):
+                            paginas.append((movimentacoes[-1]["data"], movimentacoes[-1]["_id"]))
+                            st.rerun()
 
 def modulo_vendas(db):
     verificar_autenticacao(db)
@@ -788,24 +2181,43 @@ def modulo_vendas(db):
     with tab1:
         st.subheader("Registrar Nova Venda")
         
-        # Seção 1: Seleção do Cliente
-        clientes_ativos = list(clientes_col.find({"status": "ativo"}).sort("nome", 1))
+        # Seção 1: Seleção do Cliente (busca indexada; a escolha fica na sessão)
+        def selecionar_cliente(cliente):
+            st.session_state.cliente_venda = cliente
+            st.session_state.busca_cliente_venda = ""
         
-        if not clientes_ativos:
-            st.warning("Nenhum cliente cadastrado. Cadastre clientes antes de registrar vendas!")
-            if st.button("Ir para Cadastro de Clientes ➡️"):
-                st.session_state.menu = "Clientes"
-                st.rerun()
-            st.stop()
-            
+        cliente_venda = st.session_state.get("cliente_venda")
         col_c1, col_c2 = st.columns([4,1])
         with col_c1:
-            cliente_id = st.selectbox(
-                "Cliente*",
-                options=[str(c["_id"]) for c in clientes_ativos],
-                format_func=lambda x: next(c["nome"] for c in clientes_ativos if str(c["_id"]) == x),
-                key="select_cliente_nova_venda"
-            )
+            if cliente_venda:
+                col_sel1, col_sel2 = st.columns([3, 1])
+                with col_sel1:
+                    st.success(f"👤 **Cliente:** {cliente_venda['nome']}")
+                with col_sel2:
+                    if st.button("🔄 Trocar", key="btn_trocar_cliente", use_container_width=True):
+                        del st.session_state.cliente_venda
+                        st.rerun()
+            else:
+                termo_cliente = st.text_input(
+                    "Cliente*",
+                    placeholder="Digite nome, celular ou CPF",
+                    key="busca_cliente_venda"
+                )
+                if len(termo_cliente.strip()) >= 2:
+                    sugestoes = sugestoes_busca(
+                        clientes_col, termo_cliente, {"status": "ativo"}, PROJECAO_CLIENTES_VENDA
+                    )
+                    if not sugestoes:
+                        st.info("Nenhum cliente ativo encontrado.")
+                    for sugestao in sugestoes:
+                        celular = (sugestao.get("contato") or {}).get("celular") or ""
+                        st.button(
+                            f"{sugestao['nome']} {celular}".strip(),
+                            key=f"sugestao_cliente_{sugestao['_id']}",
+                            on_click=selecionar_cliente,
+                            args=({"_id": sugestao["_id"], "nome": sugestao["nome"], "tipo": sugestao.get("tipo")},),
+                            use_container_width=True
+                        )
         with col_c2:
             if st.button("➕ Novo Cliente", use_container_width=True):
                 st.session_state.menu = "Clientes"
@@ -820,12 +2232,12 @@ def modulo_vendas(db):
         )
 
         # Seção 3: Seleção de Produtos
-        produtos_disponiveis = list(produtos_col.find({
-            "ativo": True,
-            "estoque": {"$gt": 0}
-        }).sort("nome", 1))
+        opcoes_produtos = mapa_opcoes(
+            db, "produtos_venda", "produtos", {"ativo": True, "estoque": {"$gt": 0}}, PROJECAO_PRODUTOS_VENDA,
+            lambda p: f"{p['nome']} | Estoque: {p['estoque']} | R$ {p['preco_venda']:.2f}"
+        )
         
-        if not produtos_disponiveis:
+        if not opcoes_produtos:
             st.warning("Nenhum produto disponível em estoque!")
             if st.button("Ir para Gestão de Produtos ➡️"):
                 st.session_state.menu = "Produtos"
@@ -835,6 +2247,52 @@ def modulo_vendas(db):
         # Inicializa os itens da venda na sessão
         if 'itens_venda' not in st.session_state:
             st.session_state.itens_venda = []
+        
+        def adicionar_item(produto, quantidade):
+            """Adiciona ao carrinho ou soma à quantidade já existente; retorna (sucesso, mensagem)"""
+            produto_id = str(produto["_id"])
+            item_existente = next(
+                (item for item in st.session_state.itens_venda
+                if item['produto_id'] == produto_id), None)
+            nova_quantidade = quantidade + (item_existente['quantidade'] if item_existente else 0)
+            
+            if nova_quantidade > produto['estoque']:
+                if item_existente:
+                    return False, f"Quantidade total excede o estoque! Disponível: {produto['estoque']}"
+                return False, f"Estoque insuficiente! Disponível: {produto['estoque']}"
+            if item_existente:
+                item_existente['quantidade'] = nova_quantidade
+                item_existente['subtotal'] = nova_quantidade * item_existente['preco_unitario']
+                return True, f"Quantidade de {produto['nome']} atualizada para {nova_quantidade}"
+            st.session_state.itens_venda.append({
+                'produto_id': produto_id,
+                'nome': produto['nome'],
+                'quantidade': quantidade,
+                'preco_unitario': produto['preco_venda'],
+                'custo_unitario': produto.get('custo_producao', 0),
+                'subtotal': quantidade * produto['preco_venda']
+            })
+            return True, f"{produto['nome']} adicionado à venda!"
+        
+        def adicionar_por_codigo():
+            """Leitor de código de barras: uma leitura indexada por SKU, uma unidade por leitura"""
+            codigo = st.session_state.codigo_nova_venda.strip()
+            st.session_state.codigo_nova_venda = ""
+            if not codigo:
+                return
+            produto = produtos_col.find_one({**filtro_codigo(codigo), "ativo": True}, PROJECAO_PRODUTOS_VENDA)
+            if not produto:
+                st.toast(f"❌ Código {codigo} não encontrado")
+                return
+            sucesso, mensagem = adicionar_item(produto, 1)
+            st.toast(f"{'✅' if sucesso else '❌'} {mensagem}")
+        
+        st.text_input(
+            "📷 Código / SKU",
+            placeholder="Escaneie ou digite o código e pressione Enter",
+            key="codigo_nova_venda",
+            on_change=adicionar_por_codigo
+        )
             
         # Interface para adicionar itens
         with st.container(border=True):
@@ -842,12 +2300,8 @@ def modulo_vendas(db):
             with col_p1:
                 produto_id = st.selectbox(
                     "Selecione o produto",
-                    options=[str(p["_id"]) for p in produtos_disponiveis],
-                    format_func=lambda x: next(
-                        f"{p['nome']} | Estoque: {p['estoque']} | R$ {p['preco_venda']:.2f}" 
-                        for p in produtos_disponiveis 
-                        if str(p["_id"]) == x
-                    ),
+                    options=list(opcoes_produtos),
+                    format_func=opcoes_produtos.get,
                     key="select_produto_nova_venda"
                 )
             with col_p2:
@@ -861,35 +2315,17 @@ def modulo_vendas(db):
                 st.write("")  # Espaçamento
                 if st.button("➕ Adicionar", key="btn_add_item", use_container_width=True):
                     try:
-                        produto = next(p for p in produtos_disponiveis if str(p["_id"]) == produto_id)
-                        
-                        if quantidade > produto['estoque']:
-                            st.error(f"Estoque insuficiente! Disponível: {produto['estoque']}")
-                        else:
-                            # Verifica se o produto já está na venda
-                            item_existente = next(
-                                (item for item in st.session_state.itens_venda 
-                                if item['produto_id'] == produto_id), None)
-                            
-                            if item_existente:
-                                nova_quantidade = item_existente['quantidade'] + quantidade
-                                if nova_quantidade > produto['estoque']:
-                                    st.error(f"Quantidade total excede o estoque! Disponível: {produto['estoque']}")
-                                else:
-                                    item_existente['quantidade'] = nova_quantidade
-                                    item_existente['subtotal'] = nova_quantidade * item_existente['preco_unitario']
-                                    st.success(f"Quantidade de {produto['nome']} atualizada para {nova_quantidade}")
-                            else:
-                                st.session_state.itens_venda.append({
-                                    'produto_id': produto_id,
-                                    'nome': produto['nome'],
-                                    'quantidade': quantidade,
-                                    'preco_unitario': produto['preco_venda'],
-                                    'custo_unitario': produto.get('custo_producao', 0),
-                                    'subtotal': quantidade * produto['preco_venda']
-                                })
-                                st.success(f"{produto['nome']} adicionado à venda!")
+                        # Leitura pontual: estoque atual, não o do rótulo em cache
+                        produto = produtos_col.find_one({"_id": ObjectId(produto_id), "ativo": True}, PROJECAO_PRODUTOS_VENDA)
+                        if not produto:
+                            descartar_mapa_opcoes(db, "produtos_venda")
+                            raise ValueError("produto não está mais disponível")
+                        sucesso, mensagem = adicionar_item(produto, quantidade)
+                        if sucesso:
+                            st.success(mensagem)
                             st.rerun()
+                        else:
+                            st.error(mensagem)
                     except Exception as e:
                         st.error(f"Erro ao adicionar produto: {str(e)}")
 
@@ -902,7 +2338,8 @@ def modulo_vendas(db):
             df_itens['Remover'] = False
             
             # Editor de dados com opção de remoção
-            edited_df = st.data_editor(
+            chave_editor = f"editor_itens_venda_{st.session_state.get('versao_itens_venda', 0)}"
+            st.data_editor(
                 df_itens[['nome', 'quantidade', 'preco_unitario', 'subtotal', 'Remover']],
                 column_config={
                     "preco_unitario": st.column_config.NumberColumn(
@@ -920,14 +2357,16 @@ def modulo_vendas(db):
                 },
                 hide_index=True,
                 use_container_width=True,
-                key="editor_itens_venda"
+                key=chave_editor
             )
             
-            # Processa remoção de itens marcados
-            if not edited_df[edited_df['Remover']].empty:
+            # Processa remoção de itens marcados (a nova chave descarta as marcações já aplicadas)
+            remover = {int(linha) for linha, alteracoes in linhas_editadas(chave_editor).items() if alteracoes.get("Remover")}
+            if remover:
                 itens_manter = [item for idx, item in enumerate(st.session_state.itens_venda) 
-                               if not edited_df.iloc[idx]['Remover']]
+                               if idx not in remover]
                 st.session_state.itens_venda = itens_manter
+                st.session_state.versao_itens_venda = st.session_state.get('versao_itens_venda', 0) + 1
                 st.rerun()
             
             # Calcula totais
@@ -996,12 +2435,14 @@ def modulo_vendas(db):
                     detalhes_pagamento["comprovante"] = "Enviado"
             
             # Finalização da venda
-            if st.button("✅ Finalizar Venda", type="primary", use_container_width=True):
+            if not cliente_venda:
+                st.warning("Selecione o cliente para finalizar a venda.")
+            if st.button("✅ Finalizar Venda", type="primary", use_container_width=True, disabled=not cliente_venda):
                 try:
                     with st.spinner("Processando venda..."):
                         # Cria a venda principal
                         nova_venda = {
-                            "cliente_id": cliente_id,
+                            "cliente_id": cliente_venda["_id"],
                             "data_venda": datetime.now(),
                             "valor_total": total_venda,
                             "lucro_total": lucro_estimado,
@@ -1013,41 +2454,9 @@ def modulo_vendas(db):
                             "custo_entrega": 0.0  # Será atualizado quando agendar a entrega
                         }
                         
-                        # Insere a venda e obtém o ID
-                        venda_id = vendas_col.insert_one(nova_venda).inserted_id
-                        st.session_state.ultima_venda = vendas_col.find_one({"_id": venda_id})
-                        
-                        # Registra os itens e atualiza estoque
-                        for item in st.session_state.itens_venda:
-                            # Item da venda
-                            itens_col.insert_one({
-                                "venda_id": str(venda_id),
-                                "produto_id": item['produto_id'],
-                                "quantidade": item['quantidade'],
-                                "preco_unitario": item['preco_unitario'],
-                                "custo_unitario": item['custo_unitario'],
-                                "subtotal": item['subtotal']
-                            })
-                            
-                            # Atualiza estoque
-                            produtos_col.update_one(
-                                {"_id": ObjectId(item['produto_id'])},
-                                {"$inc": {"estoque": -item['quantidade']}}
-                            )
-                        
-                        # Atualiza estatísticas do cliente
-                        clientes_col.update_one(
-                            {"_id": ObjectId(cliente_id)},
-                            {
-                                "$inc": {
-                                    "compras_realizadas": 1,
-                                    "total_gasto": total_venda
-                                },
-                                "$set": {
-                                    "ultima_compra": datetime.now()
-                                }
-                            }
-                        )
+                        # Grava venda, itens, estoque e estatísticas numa única transação
+                        registrar_venda(db, nova_venda, st.session_state.itens_venda, cliente_venda.get("tipo"))
+                        st.session_state.ultima_venda = nova_venda
                         
                         # Sucesso - mostra resumo e limpa a venda
                         st.success("Venda registrada com sucesso!")
@@ -1055,8 +2464,7 @@ def modulo_vendas(db):
                         
                         # Exibe resumo da venda
                         with st.expander("📝 Resumo da Venda", expanded=True):
-                            cliente = clientes_col.find_one({"_id": ObjectId(cliente_id)})
-                            st.write(f"**Cliente:** {cliente['nome']}")
+                            st.write(f"**Cliente:** {cliente_venda['nome']}")
                             st.write(f"**Data/Hora:** {datetime.now().strftime('%d/%m/%Y %H:%M')}")
                             st.write(f"**Total:** R$ {total_venda:,.2f}")
                             st.write(f"**Tipo de Entrega:** {tipo_entrega}")
@@ -1071,8 +2479,9 @@ def modulo_vendas(db):
                             for item in st.session_state.itens_venda:
                                 st.write(f"- {item['nome']} ({item['quantidade']} x R$ {item['preco_unitario']:.2f})")
                         
-                        # Limpa os itens da sessão
+                        # Limpa os itens e o cliente da sessão
                         del st.session_state.itens_venda
+                        del st.session_state.cliente_venda
                         pytime.sleep(3)
                         st.rerun()
                         
@@ -1080,7 +2489,172 @@ def modulo_vendas(db):
                     st.error(f"Erro ao registrar venda: {str(e)}")
                     st.error("Nenhuma alteração foi aplicada no banco de dados.")
 
-    # [Restante do código das outras abas (Histórico e Relatórios) permanece igual...]
+    with tab2:
+        st.subheader("Histórico de Vendas")
+        
+        # Filtros
+        with st.expander("🔎 Filtros", expanded=True):
+            col_f1, col_f2, col_f3, col_f4, col_f5 = st.columns([2, 2, 2, 2, 1])
+            with col_f1:
+                data_inicio = st.date_input(
+                    "Data inicial", 
+                    value=datetime.now() - timedelta(days=30),
+                    key="hist_data_inicio"
+                )
+            with col_f2:
+                data_fim = st.date_input(
+                    "Data final", 
+                    value=datetime.now(),
+                    key="hist_data_fim"
+                )
+            with col_f3:
+                filtro_pagamento = st.selectbox(
+                    "Forma de Pagamento",
+                    ["Todas", "Dinheiro", "Cartão de Crédito", "Cartão de Débito", "PIX", "Transferência Bancária"],
+                    index=0,
+                    key="filtro_pagamento_historico"
+                )
+            with col_f4:
+                filtro_status = st.selectbox(
+                    "Status",
+                    ["Todos", "Concluída", "Cancelada"],
+                    index=0,
+                    key="filtro_status_historico"
+                )
+            with col_f5:
+                tamanho_pagina = st.selectbox("Por página", TAMANHOS_PAGINA, index=1, key="historico_por_pagina")
+        
+        # Aplica filtros (índices data_venda_id, status_data_venda_id e pagamento_data_venda_id)
+        filtro = {
+            "data_venda": {
+                "$gte": datetime.combine(data_inicio, datetime.min.time()),
+                "$lte": datetime.combine(data_fim, datetime.max.time())
+            }
+        }
+        if filtro_pagamento != "Todas":
+            filtro["metodo_pagamento"] = filtro_pagamento.lower()
+        if filtro_status != "Todos":
+            filtro["status"] = filtro_status.lower()
+        
+        try:
+            paginacao = estado_paginacao(
+                "paginacao_historico",
+                (data_inicio, data_fim, filtro_pagamento, filtro_status, tamanho_pagina)
+            )
+            vendas, tem_proxima = pagina_por_data(
+                vendas_col, filtro, PROJECAO_HISTORICO_VENDAS, paginacao["cursores"][-1], tamanho_pagina
+            )
+            
+            if not vendas:
+                st.info("Nenhuma venda encontrada no período selecionado.")
+            else:
+                # Nomes dos clientes da página numa única consulta
+                ids_clientes = {como_object_id(v.get("cliente_id")) for v in vendas} - {None}
+                nomes_clientes = {
+                    c["_id"]: c["nome"] for c in clientes_col.find({"_id": {"$in": list(ids_clientes)}}, {"nome": 1})
+                }
+                
+                dados_vendas = []
+                for venda in vendas:
+                    dados_vendas.append({
+                        "ID": str(venda["_id"]),
+                        "Data": venda["data_venda"].strftime("%d/%m/%Y %H:%M"),
+                        "Cliente": nomes_clientes.get(como_object_id(venda.get("cliente_id")), "Cliente não encontrado"),
+                        "Valor Total": venda.get("valor_total", 0),
+                        "Pagamento": venda.get("metodo_pagamento", "-").capitalize(),
+                        "Status": venda.get("status", "-").capitalize(),
+                        "Itens": venda.get("itens_count", 0),
+                        "Ações": "Manter"
+                    })
+                
+                df_vendas = pd.DataFrame(dados_vendas)
+                chave_editor = f"editor_historico_vendas_{paginacao['versao']}"
+                st.data_editor(
+                    df_vendas,
+                    column_config={
+                        "Valor Total": st.column_config.NumberColumn(format="R$ %.2f"),
+                        "Ações": st.column_config.SelectboxColumn(
+                            "Ações",
+                            options=["Manter", "Cancelar"],
+                            required=True
+                        )
+                    },
+                    disabled=["ID", "Data", "Cliente", "Valor Total", "Pagamento", "Status", "Itens"],
+                    hide_index=True,
+                    use_container_width=True,
+                    key=chave_editor
+                )
+                acoes = acoes_editadas(chave_editor, df_vendas)
+                
+                # Processa vendas marcadas para cancelar
+                if "Cancelar" in acoes:
+                    st.warning("⚠️ Atenção: Esta ação não pode ser desfeita!")
+                    
+                    if st.button("Confirmar Cancelamento", type="primary", key="btn_cancelar_venda"):
+                        with st.spinner("Processando cancelamento..."):
+                            try:
+                                resumo = cancelar_vendas(db, acoes["Cancelar"])
+                                st.success(
+                                    f"{resumo['canceladas']} venda(s) cancelada(s): estoque devolvido para "
+                                    f"{resumo['produtos']} produto(s), {resumo['clientes']} cliente(s) atualizados "
+                                    f"em {resumo['duracao_ms']:.0f} ms."
+                                )
+                                paginacao["versao"] += 1
+                                pytime.sleep(1.5)
+                                st.rerun()
+                            except Exception as e:
+                                st.error(f"Erro ao cancelar: {str(e)}")
+                                st.error("Nenhuma alteração foi aplicada no banco de dados.")
+                
+                navegacao_paginas(
+                    paginacao, vendas, tem_proxima, contagem_aproximada(vendas_col, filtro),
+                    "pag_historico", campo="data_venda"
+                )
+                
+                # Detalhes da venda selecionada
+                rotulos_vendas = {
+                    v["ID"]: f"{v['Data']} - {v['Cliente']} - R$ {v['Valor Total']:.2f}" for v in dados_vendas
+                }
+                venda_selecionada = st.selectbox(
+                    "Selecione uma venda para detalhar",
+                    options=list(rotulos_vendas),
+                    format_func=rotulos_vendas.get,
+                    key="select_venda_detalhe"
+                )
+                
+                if venda_selecionada:
+                    try:
+                        venda = vendas_col.find_one({"_id": ObjectId(venda_selecionada)}, {"itens": 1})
+                        itens_venda = itens_da_venda(db, venda) if venda else []
+                        
+                        if itens_venda:
+                            st.dataframe(
+                                pd.DataFrame([
+                                    {
+                                        "Produto": item.get("nome", "Produto não encontrado"),
+                                        "Quantidade": item["quantidade"],
+                                        "Preço Unitário": item["preco_unitario"],
+                                        "Subtotal": item["quantidade"] * item["preco_unitario"]
+                                    }
+                                    for item in itens_venda
+                                ]),
+                                column_config={
+                                    "Preço Unitário": st.column_config.NumberColumn(
+                                        format="R$ %.2f"
+                                    ),
+                                    "Subtotal": st.column_config.NumberColumn(
+                                        format="R$ %.2f"
+                                    )
+                                },
+                                hide_index=True,
+                                use_container_width=True
+                            )
+                    except Exception as e:
+                        st.error(f"Erro ao carregar itens da venda: {str(e)}")
+        except Exception as e:
+            st.error(f"Erro ao carregar histórico de vendas: {str(e)}")
+
+    # [Restante do código da aba de Relatórios permanece igual...]
 
     with tab4:
         st.subheader("Gestão de Entregas")
@@ -1112,7 +2686,7 @@ def modulo_vendas(db):
                 if st.form_submit_button("Agendar Entrega"):
                     # Cria a entrega
                     nova_entrega = {
-                        "venda_id": str(venda_para_entrega['_id']),
+                        "venda_id": venda_para_entrega['_id'],
                         "data_entrega": datetime.combine(data_entrega, horario_entrega),
                         "status": "agendada",
                         "custo_entrega": float(custo_entrega),
@@ -1120,17 +2694,14 @@ def modulo_vendas(db):
                         "data_cadastro": datetime.now()
                     }
                     
-                    entregas_col.insert_one(nova_entrega)
-                    
-                    # Atualiza a venda com o custo
-                    vendas_col.update_one(
-                        {"_id": venda_para_entrega['_id']},
-                        {"$set": {"custo_entrega": float(custo_entrega)}}
-                    )
-                    
-                    st.success("Entrega agendada com sucesso!")
-                    del st.session_state.ultima_venda
-                    st.rerun()
+                    try:
+                        agendar_entrega(db, nova_entrega)
+                    except ValueError as e:
+                        st.error(str(e))
+                    else:
+                        st.success("Entrega agendada com sucesso!")
+                        del st.session_state.ultima_venda
+                        st.rerun()
         
         # Lista de entregas pendentes
         st.subheader("Entregas Pendentes")
@@ -1142,10 +2713,7 @@ def modulo_vendas(db):
         if not entregas_pendentes:
             st.info("Nenhuma entrega pendente no momento.")
         else:
-            for entrega in entregas_pendentes:
-                venda = vendas_col.find_one({"_id": ObjectId(entrega['venda_id'])})
-                cliente = clientes_col.find_one({"_id": ObjectId(venda['cliente_id'])}) if venda else None
-                
+            for entrega, venda, cliente in juntar_vendas_clientes(db, entregas_pendentes):
                 with st.expander(f"Entrega #{str(entrega['_id'])[-6:]} - {entrega['data_entrega'].strftime('%d/%m/%Y %H:%M')}"):
                     col1, col2 = st.columns(2)
                     with col1:
@@ -1160,24 +2728,15 @@ def modulo_vendas(db):
                     col_btn1, col_btn2, col_btn3 = st.columns(3)
                     with col_btn1:
                         if st.button(f"Marcar como Em Rota", key=f"em_rota_{entrega['_id']}"):
-                            entregas_col.update_one(
-                                {"_id": entrega['_id']},
-                                {"$set": {"status": "em_rota"}}
-                            )
+                            atualizar_status_entregas(db, [entrega['_id']], {"status": "em_rota"})
                             st.rerun()
                     with col_btn2:
                         if st.button(f"Marcar como Entregue", key=f"entregue_{entrega['_id']}"):
-                            entregas_col.update_one(
-                                {"_id": entrega['_id']},
-                                {"$set": {"status": "entregue"}}
-                            )
+                            atualizar_status_entregas(db, [entrega['_id']], {"status": "entregue"})
                             st.rerun()
                     with col_btn3:
                         if st.button(f"Cancelar Entrega", key=f"cancelar_{entrega['_id']}"):
-                            entregas_col.update_one(
-                                {"_id": entrega['_id']},
-                                {"$set": {"status": "cancelada"}}
-                            )
+                            atualizar_status_entregas(db, [entrega['_id']], {"status": "cancelada"})
                             st.rerun()
 
         # Todas as entregas agendadas
@@ -1208,10 +2767,7 @@ def modulo_vendas(db):
             st.info("Nenhuma entrega encontrada no período selecionado.")
         else:
             dados = []
-            for entrega in todas_entregas:
-                venda = vendas_col.find_one({"_id": ObjectId(entrega['venda_id'])})
-                cliente = clientes_col.find_one({"_id": ObjectId(venda['cliente_id'])}) if venda else None
-                
+            for entrega, venda, cliente in juntar_vendas_clientes(db, todas_entregas):
                 dados.append({
                     "ID": str(entrega['_id']),
                     "Venda": f"#{str(entrega['venda_id'])[-6:]}",
@@ -1241,7 +2797,7 @@ def modulo_entregas(db):
     clientes_col = db['clientes']
     entregas_col = db['entregas']
 
-    tab1, tab2 = st.tabs(["📅 Agenda de Entregas", "📊 Relatório"])
+    tab1, tab2, tab3 = st.tabs(["📅 Agenda de Entregas", "➕ Nova Entrega", "📊 Relatório"])
 
     with tab1:
         st.subheader("Agenda de Entregas")
@@ -1287,11 +2843,8 @@ def modulo_entregas(db):
         else:
             # Prepara dados para exibição
             dados_entregas = []
-            for entrega in entregas:
+            for entrega, venda, cliente in juntar_vendas_clientes(db, entregas):
                 try:
-                    venda = vendas_col.find_one({"_id": ObjectId(entrega["venda_id"])})
-                    cliente = clientes_col.find_one({"_id": ObjectId(venda["cliente_id"])}) if venda else None
-                    
                     dados_entregas.append({
                         "ID": str(entrega["_id"]),
                         "Venda": f"#{str(entrega['venda_id'])[-6:]}",
@@ -1307,7 +2860,8 @@ def modulo_entregas(db):
 
             df_entregas = pd.DataFrame(dados_entregas)
             
-            edited_df = st.data_editor(
+            chave_editor = f"editor_entregas_{st.session_state.get('versao_editor_entregas', 0)}"
+            st.data_editor(
                 df_entregas,
                 column_config={
                     "ID": st.column_config.Column(disabled=True),
@@ -1321,38 +2875,39 @@ def modulo_entregas(db):
                 },
                 hide_index=True,
                 use_container_width=True,
-                key="editor_entregas"
+                key=chave_editor
             )
+            acoes = acoes_editadas(chave_editor, df_entregas)
             
             # Processar ações selecionadas
-            if not edited_df[edited_df['Ações'] != "Manter"].empty:
+            if acoes:
                 st.warning("⚠️ Atenção: Ações em massa serão aplicadas!")
                 
                 # Ação de editar
-                if not edited_df[edited_df['Ações'] == "Editar"].empty:
-                    for idx, row in edited_df[edited_df['Ações'] == "Editar"].iterrows():
-                        st.session_state.editar_entrega_id = row['ID']
-                        st.rerun()
+                if "Editar" in acoes:
+                    st.session_state.editar_entrega_id = acoes["Editar"][0]
+                    # descarta as marcações; senão o "Editar" reabriria o formulário após salvar
+                    st.session_state.versao_editor_entregas = st.session_state.get('versao_editor_entregas', 0) + 1
+                    st.rerun()
                 
                 # Ações de status
                 for acao in ["Em Rota", "Entregue", "Cancelar"]:
-                    if not edited_df[edited_df['Ações'] == acao].empty:
+                    if acao in acoes:
                         if st.button(f"Confirmar '{acao}'", key=f"btn_{acao}"):
-                            for idx, row in edited_df[edited_df['Ações'] == acao].iterrows():
-                                novo_status = acao.lower().replace(" ", "_") if acao != "Cancelar" else "cancelada"
-                                entregas_col.update_one(
-                                    {"_id": ObjectId(row['ID'])},
-                                    {"$set": {"status": novo_status}}
-                                )
-                            st.success(f"Status atualizado para '{acao}'!")
+                            novo_status = acao.lower().replace(" ", "_") if acao != "Cancelar" else "cancelada"
+                            encontrados, modificados = atualizar_status_entregas(
+                                db, acoes[acao], {"status": novo_status}
+                            )
+                            st.success(f"Status atualizado para '{acao}'! ({modificados} de {encontrados} alterados)")
+                            st.session_state.versao_editor_entregas = st.session_state.get('versao_editor_entregas', 0) + 1
                             st.rerun()
 
     # Edição de entrega
     if 'editar_entrega_id' in st.session_state and st.session_state.editar_entrega_id:
         entrega = entregas_col.find_one({"_id": ObjectId(st.session_state.editar_entrega_id)})
         if entrega:
-            venda = vendas_col.find_one({"_id": ObjectId(entrega["venda_id"])})
-            cliente = clientes_col.find_one({"_id": ObjectId(venda["cliente_id"])}) if venda else None
+            venda = vendas_col.find_one({"_id": ObjectId(entrega["venda_id"])}, {"cliente_id": 1})
+            cliente = clientes_col.find_one({"_id": ObjectId(venda["cliente_id"])}, {"nome": 1}) if venda else None
             
             st.subheader("Editar Entrega")
             st.write(f"**Venda:** #{str(entrega['venda_id'])[-6:]}")
@@ -1402,10 +2957,7 @@ def modulo_entregas(db):
                             "ultima_atualizacao": datetime.now()
                         }
                         
-                        entregas_col.update_one(
-                            {"_id": ObjectId(st.session_state.editar_entrega_id)},
-                            {"$set": atualizacao}
-                        )
+                        atualizar_status_entregas(db, [st.session_state.editar_entrega_id], atualizacao)
                         
                         # Atualiza custo na venda associada
                         if venda:
@@ -1413,7 +2965,6 @@ def modulo_entregas(db):
                                 {"_id": ObjectId(entrega["venda_id"])},
                                 {"$set": {"custo_entrega": novo_custo}}
                             )
-                        
                         st.success("Entrega atualizada com sucesso!")
                         del st.session_state.editar_entrega_id
                         module_time.sleep(1)
@@ -1425,6 +2976,112 @@ def modulo_entregas(db):
                         st.rerun()
 
     with tab2:
+        st.subheader("Agendar Nova Entrega")
+        
+        # Vendas elegíveis lidas do índice parcial de entrega_agendada
+        vendas_para_entrega = list(
+            vendas_col.find(
+                filtro_vendas_sem_entrega(),
+                {"cliente_id": 1, "valor_total": 1, "data_venda": 1}
+            ).sort("data_venda", -1).limit(LIMITE_VENDAS_SEM_ENTREGA)
+        )
+        
+        if not vendas_para_entrega:
+            st.info("Nenhuma venda disponível para agendamento de entrega.")
+            st.write("Verifique se existem vendas concluídas com tipo 'Entrega ao Cliente' que ainda não foram agendadas.")
+        else:
+            # Nomes e endereços dos clientes num único $in
+            ids_clientes = {como_object_id(v.get("cliente_id")) for v in vendas_para_entrega} - {None}
+            clientes = {
+                c["_id"]: c for c in clientes_col.find(
+                    {"_id": {"$in": list(ids_clientes)}}, {"nome": 1, "endereco": 1}
+                )
+            }
+            vendas_por_id = {str(v["_id"]): v for v in vendas_para_entrega}
+            rotulos = {
+                venda_id: f"Venda #{venda_id[-6:]} - "
+                          f"{clientes.get(como_object_id(v.get('cliente_id')), {}).get('nome', 'Cliente não encontrado')} - "
+                          f"R$ {v['valor_total']:.2f}"
+                for venda_id, v in vendas_por_id.items()
+            }
+            
+            venda_selecionada = st.selectbox(
+                "Selecione a Venda",
+                options=list(rotulos),
+                format_func=rotulos.get,
+                key="select_venda_entrega"
+            )
+            
+            if venda_selecionada:
+                venda = vendas_por_id[venda_selecionada]
+                cliente = clientes.get(como_object_id(venda.get("cliente_id")))
+                
+                with st.form("form_nova_entrega", clear_on_submit=True):
+                    st.write(f"**Cliente:** {cliente['nome'] if cliente else 'Não encontrado'}")
+                    st.write(f"**Valor da Venda:** R$ {venda['valor_total']:.2f}")
+                    
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        data_entrega = st.date_input(
+                            "Data de Entrega*",
+                            min_value=date.today(),
+                            value=date.today() + timedelta(days=1)
+                        )
+                    with col2:
+                        horario_entrega = st.time_input(
+                            "Horário*",
+                            value=time(14, 0)
+                        )
+                    
+                    st.write("**Endereço para Entrega:**")
+                    if cliente and cliente.get("endereco"):
+                        st.write(cliente["endereco"])
+                        endereco_entrega = cliente["endereco"]
+                    else:
+                        st.warning("Cliente não possui endereço cadastrado!")
+                        endereco_entrega = st.text_input("Informe o endereço para entrega*")
+                    
+                    col_c1, col_c2 = st.columns(2)
+                    with col_c1:
+                        custo_entrega = st.number_input(
+                            "Custo da Entrega (R$)*",
+                            min_value=0.0,
+                            value=15.0,
+                            step=0.01,
+                            format="%.2f"
+                        )
+                    with col_c2:
+                        responsavel = st.text_input(
+                            "Responsável pela Entrega",
+                            value=st.session_state.usuario_atual["nome"]
+                        )
+                    
+                    observacoes = st.text_area("Observações (opcional)")
+                    
+                    if st.form_submit_button("Agendar Entrega"):
+                        if not endereco_entrega:
+                            st.error("Informe o endereço para entrega!")
+                        else:
+                            nova_entrega = {
+                                "venda_id": venda["_id"],
+                                "data_entrega": datetime.combine(data_entrega, horario_entrega),
+                                "status": "agendada",
+                                "endereco_entrega": endereco_entrega,
+                                "custo_entrega": float(custo_entrega),
+                                "responsavel": responsavel,
+                                "observacoes": observacoes if observacoes else None,
+                                "data_cadastro": datetime.now(),
+                                "ultima_atualizacao": datetime.now()
+                            }
+                            try:
+                                agendar_entrega(db, nova_entrega)
+                            except ValueError as e:
+                                st.error(str(e))
+                            else:
+                                st.success("Entrega agendada com sucesso!")
+                                st.rerun()
+
+    with tab3:
         st.subheader("Relatório de Entregas")
         
         col_r1, col_r2 = st.columns(2)
@@ -1444,50 +3101,28 @@ def modulo_entregas(db):
         if st.button("Gerar Relatório", key="btn_rel_entregas"):
             try:
                 with st.spinner("Processando relatório..."):
-                    # Filtro de período
-                    filtro = {
-                        "data_entrega": {
-                            "$gte": datetime.combine(data_inicio_rel, datetime.min.time()),
-                            "$lte": datetime.combine(data_fim_rel, datetime.max.time())
-                        }
-                    }
-                    
-                    # Busca entregas no período
-                    entregas = list(entregas_col.find(filtro).sort("data_entrega", 1))
+                    relatorio = relatorio_em_cache(
+                        db,
+                        "entregas",
+                        {"inicio": data_inicio_rel, "fim": data_fim_rel},
+                        ["entregas", "vendas", "clientes"],
+                        lambda: relatorio_entregas(db, data_inicio_rel, data_fim_rel)
+                    )
                     
-                    if not entregas:
+                    if not relatorio["total"]:
                         st.info("Nenhuma entrega encontrada no período selecionado.")
                     else:
-                        # Processa dados para o relatório
-                        dados = []
-                        for entrega in entregas:
-                            try:
-                                venda = vendas_col.find_one({"_id": ObjectId(entrega["venda_id"])})
-                                cliente = clientes_col.find_one({"_id": ObjectId(venda["cliente_id"])}) if venda else None
-                                
-                                dados.append({
-                                    "Data": entrega["data_entrega"].strftime("%d/%m/%Y %H:%M"),
-                                    "Venda": f"#{str(entrega['venda_id'])[-6:]}",
-                                    "Cliente": cliente["nome"] if cliente else "Não encontrado",
-                                    "Status": entrega["status"].replace("_", " ").title(),
-                                    "Custo": entrega.get("custo_entrega", 0),
-                                    "Responsável": entrega.get("responsavel", "Não informado")
-                                })
-                            except:
-                                continue
-                        
-                        df_relatorio = pd.DataFrame(dados)
+                        df_relatorio = pd.DataFrame(relatorio["linhas"])
                         
                         # Métricas rápidas
                         col_m1, col_m2, col_m3 = st.columns(3)
                         with col_m1:
-                            st.metric("Total de Entregas", len(entregas))
+                            st.metric("Total de Entregas", relatorio["total"])
                         with col_m2:
                             custo_total = df_relatorio["Custo"].sum()
                             st.metric("Custo Total", f"R$ {custo_total:,.2f}")
                         with col_m3:
-                            entregues = len([e for e in entregas if e["status"] == "entregue"])
-                            st.metric("Taxa de Entrega", f"{(entregues/len(entregas)*100):.1f}%")
+                            st.metric("Taxa de Entrega", f"{(relatorio['entregues']/relatorio['total']*100):.1f}%")
                         
                         # Agrupamento por status
                         st.subheader("Distribuição por Status")
@@ -1516,6 +3151,590 @@ def modulo_entregas(db):
             except Exception as e:
                 st.error(f"Erro ao gerar relatório: {str(e)}")
 
+# =============================================
+# CACHE DE RELATÓRIOS (compartilhado entre sessões)
+# =============================================
+
+CACHE_RELATORIOS_TTL = 600  # segundos
+CACHE_RELATORIOS_MAX_ENTRADAS = 64
+CACHE_VERSOES_INTERVALO = 5  # segundos entre releituras de versoes_colecoes
+CACHE_OPCOES_TTL = 30  # segundos; limita por quanto tempo um item excluído ainda aparece nas opções
+
+@st.cache_resource(show_spinner=False)
+def estado_cache_relatorios():
+    """Entradas em ordem LRU e última leitura das versões de cada banco"""
+    return {
+        "lock": threading.Lock(),
+        "entradas": OrderedDict(),
+        "versoes": {},
+        "versoes_lidas_em": {},
+        "itens_venda_vazia": {},
+        "acertos": 0,
+        "falhas": 0,
+        "despejos": 0
+    }
+
+def invalidar_colecoes(db, *colecoes):
+    """Incrementa a versão de dados das coleções alteradas por uma escrita.
+    
+    As versões ficam em versoes_colecoes, então escritas da linha de
+    comando ou de outro processo também invalidam o cache deste servidor
+    (em até CACHE_VERSOES_INTERVALO segundos).
+    """
+    db.versoes_colecoes.bulk_write([
+        UpdateOne({"_id": colecao}, {"$inc": {"versao": 1}}, upsert=True)
+        for colecao in colecoes
+    ], ordered=False)
+    estado = estado_cache_relatorios()
+    with estado["lock"]:
+        estado["versoes_lidas_em"].pop(db.name, None)  # releitura na próxima consulta
+
+def versoes_colecoes(db):
+    """Versões persistidas das coleções, relidas no máximo a cada CACHE_VERSOES_INTERVALO"""
+    estado = estado_cache_relatorios()
+    with estado["lock"]:
+        lidas_em = estado["versoes_lidas_em"].get(db.name)
+        if lidas_em is not None and pytime.monotonic() - lidas_em < CACHE_VERSOES_INTERVALO:
+            return estado["versoes"][db.name]
+    
+    versoes = {doc["_id"]: doc.get("versao", 0) for doc in db.versoes_colecoes.find()}
+    with estado["lock"]:
+        estado["versoes"][db.name] = versoes
+        estado["versoes_lidas_em"][db.name] = pytime.monotonic()
+    return versoes
+
+def itens_venda_vazia(db):
+    """Se itens_venda está vazia, guardado até a coleção mudar de versão"""
+    estado = estado_cache_relatorios()
+    versao = versoes_colecoes(db).get("itens_venda", 0)
+    with estado["lock"]:
+        guardado = estado["itens_venda_vazia"].get(db.name)
+        if guardado and guardado[0] == versao:
+            return guardado[1]
+    vazia = db.itens_venda.estimated_document_count() == 0
+    with estado["lock"]:
+        estado["itens_venda_vazia"][db.name] = (versao, vazia)
+    return vazia
+
+def relatorio_em_cache(db, nome, parametros, colecoes, calcular):
+    """Retorna o resultado de calcular() reaproveitando-o entre sessões.
+    
+    A entrada é descartada quando expira (TTL), quando sai do LRU ou quando
+    a versão persistida de alguma das coleções de origem muda.
+    """
+    estado = estado_cache_relatorios()
+    chave = (nome, json.dumps(parametros, sort_keys=True, default=str))
+    versoes_atuais = versoes_colecoes(db)
+    
+    with estado["lock"]:
+        versoes = tuple(versoes_atuais.get(c, 0) for c in colecoes)
+        entrada = estado["entradas"].get(chave)
+        if (entrada and entrada["versoes"] == versoes
+                and pytime.monotonic() - entrada["criado_em"] < CACHE_RELATORIOS_TTL):
+            estado["entradas"].move_to_end(chave)
+            estado["acertos"] += 1
+            return entrada["valor"]
+        estado["falhas"] += 1
+    
+    valor = calcular()
+    
+    with estado["lock"]:
+        estado["entradas"][chave] = {
+            "valor": valor,
+            "versoes": versoes,
+            "criado_em": pytime.monotonic(),
+            "tamanho": len(pickle.dumps(valor))
+        }
+        estado["entradas"].move_to_end(chave)
+        while len(estado["entradas"]) > CACHE_RELATORIOS_MAX_ENTRADAS:
+            estado["entradas"].popitem(last=False)
+            estado["despejos"] += 1
+    
+    return valor
+
+def estatisticas_cache_relatorios():
+    estado = estado_cache_relatorios()
+    with estado["lock"]:
+        consultas = estado["acertos"] + estado["falhas"]
+        return {
+            "acertos": estado["acertos"],
+            "falhas": estado["falhas"],
+            "despejos": estado["despejos"],
+            "taxa_acerto": estado["acertos"] / consultas * 100 if consultas else 0,
+            "entradas": [
+                {
+                    "Relatório": nome,
+                    "Parâmetros": parametros,
+                    "Tamanho (KB)": round(entrada["tamanho"] / 1024, 1),
+                    "Idade (s)": int(pytime.monotonic() - entrada["criado_em"])
+                }
+                for (nome, parametros), entrada in estado["entradas"].items()
+            ]
+        }
+
+@st.cache_resource(show_spinner=False)
+def estado_cache_opcoes():
+    """Mapas de opções dos selectbox, separados do LRU de relatórios"""
+    return {
+        "lock": threading.Lock(),
+        "entradas": {},
+        "acertos": 0,
+        "falhas": 0
+    }
+
+def mapa_opcoes(db, nome, colecao, filtro, projecao, rotulo):
+    """Mapa id -> rótulo das opções de um selectbox, em ordem de nome.
+    
+    Compartilhado entre reruns e sessões por até CACHE_OPCOES_TTL segundos
+    ou até a coleção mudar de versão; use format_func=mapa.get (busca O(1)
+    por opção). Como pode estar defasado, confirme o item escolhido com uma
+    leitura pontual e chame descartar_mapa_opcoes se ele não existir mais.
+    """
+    estado = estado_cache_opcoes()
+    chave = (db.name, nome, json.dumps(filtro, sort_keys=True, default=str))
+    versao = versoes_colecoes(db).get(colecao, 0)
+    
+    with estado["lock"]:
+        entrada = estado["entradas"].get(chave)
+        if (entrada and entrada["versao"] == versao
+                and pytime.monotonic() - entrada["criado_em"] < CACHE_OPCOES_TTL):
+            estado["acertos"] += 1
+            return entrada["valor"]
+        estado["falhas"] += 1
+    
+    documentos = db[colecao].find(filtro, projecao).sort([("nome", ASCENDING), ("_id", ASCENDING)])
+    valor = {str(doc["_id"]): rotulo(doc) for doc in documentos}
+    
+    with estado["lock"]:
+        estado["entradas"][chave] = {"valor": valor, "versao": versao, "criado_em": pytime.monotonic()}
+    return valor
+
+def descartar_mapa_opcoes(db, nome):
+    """Força a remontagem de um mapa de opções (item escolhido não existe mais)"""
+    estado = estado_cache_opcoes()
+    with estado["lock"]:
+        for chave in [c for c in estado["entradas"] if c[0] == db.name and c[1] == nome]:
+            del estado["entradas"][chave]
+
+def estatisticas_cache_opcoes():
+    estado = estado_cache_opcoes()
+    with estado["lock"]:
+        consultas = estado["acertos"] + estado["falhas"]
+        return {
+            "acertos": estado["acertos"],
+            "falhas": estado["falhas"],
+            "mapas": len(estado["entradas"]),
+            "taxa_acerto": estado["acertos"] / consultas * 100 if consultas else 0
+        }
+
+# =============================================
+# CONSULTAS DE RELATÓRIOS
+# =============================================
+
+def filtros_visao_geral(data_inicio, data_fim):
+    """Filtros do período (vendas e consolidado) e do período anterior de mesma duração"""
+    filtro_periodo = {
+        "data_venda": {
+            "$gte": datetime.combine(data_inicio, datetime.min.time()),
+            "$lte": datetime.combine(data_fim, datetime.max.time())
+        },
+        "status": "concluída"
+    }
+    filtro_dias = {
+        "dia": {
+            "$gte": datetime.combine(data_inicio, datetime.min.time()),
+            "$lte": datetime.combine(data_fim, datetime.min.time())
+        }
+    }
+    
+    # Define o período anterior com a mesma duração do período atual
+    dias_periodo = (data_fim - data_inicio).days
+    periodo_anterior = {
+        "dia": {
+            "$gte": datetime.combine(data_inicio - timedelta(days=dias_periodo), datetime.min.time()),
+            "$lte": datetime.combine(data_inicio - timedelta(days=1), datetime.min.time())
+        }
+    }
+    return filtro_periodo, filtro_dias, periodo_anterior
+
+# Estágios compartilhados pelos dois caminhos da Visão Geral
+GRUPO_TOTAIS = {"$group": {
+    "_id": None,
+    "vendas": {"$sum": "$vendas"},
+    "faturamento": {"$sum": "$faturamento"},
+    "lucro": {"$sum": "$lucro"}
+}}
+
+ESTAGIOS_DIARIO = [
+    {"$group": {
+        "_id": "$dia",
+        "total_vendas": {"$sum": "$vendas"},
+        "total_faturamento": {"$sum": "$faturamento"},
+        "total_lucro": {"$sum": "$lucro"}
+    }},
+    {"$sort": {"_id": 1}}
+]
+
+ESTAGIOS_PAGAMENTO = [
+    {"$group": {
+        "_id": "$metodo_pagamento",
+        "total_vendas": {"$sum": "$vendas"},
+        "total_faturamento": {"$sum": "$faturamento"},
+        "total_lucro": {"$sum": "$lucro"}
+    }},
+    {"$match": {"total_vendas": {"$gt": 0}}},
+    {"$sort": {"total_faturamento": -1}}
+]
+
+def estagios_itens_da_venda(db):
+    """Um documento por item de venda (campo `itens`), nos dois esquemas.
+    
+    Vendas já migradas trazem os itens embutidos; as demais buscam em
+    itens_venda. Quando itens_venda fica vazia o $lookup é omitido.
+    """
+    if itens_venda_vazia(db):
+        return [{"$unwind": "$itens"}]
+    return [
+        {"$lookup": {
+            "from": "itens_venda",
+            "localField": "_id",
+            "foreignField": "venda_id",
+            "as": "itens_legado"
+        }},
+        {"$set": {"itens": {"$ifNull": ["$itens", "$itens_legado"]}}},
+        {"$unwind": "$itens"}
+    ]
+
+def estagios_produto_top(db):
+    return estagios_itens_da_venda(db) + [
+        {"$group": {
+            "_id": "$itens.produto_id",
+            "total_vendido": {"$sum": "$itens.quantidade"}
+        }},
+        {"$sort": {"total_vendido": -1}},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": "produtos",
+            "localField": "_id",
+            "foreignField": "_id",
+            "as": "produto"
+        }},
+        {"$project": {"total_vendido": 1, "nome": {"$first": "$produto.nome"}}}
+    ]
+
+TOP_CLIENTES_PADRAO = 5
+
+def estagios_clientes_top(quantidade):
+    """Top-N clientes do período: gasto e compras dentro do intervalo já filtrado.
+    
+    $sort seguido de $limit vira uma ordenação top-k (só N documentos em memória).
+    """
+    return [
+        {"$group": {
+            "_id": "$cliente_id",
+            "total_gasto": {"$sum": "$valor_total"},
+            "compras": {"$sum": 1}
+        }},
+        {"$sort": {"total_gasto": -1, "_id": 1}},
+        {"$limit": quantidade},
+        {"$lookup": {
+            "from": "clientes",
+            "localField": "_id",
+            "foreignField": "_id",
+            "as": "cliente"
+        }},
+        {"$project": {"total_gasto": 1, "compras": 1, "nome": {"$first": "$cliente.nome"}}}
+    ]
+
+def _montar_visao_geral(totais, diario, pagamento, anterior, produto_top, clientes_top):
+    totais = totais or {"vendas": 0, "faturamento": 0, "lucro": 0}
+    return {
+        "total_vendas": totais["vendas"],
+        "faturamento_total": totais["faturamento"],
+        "lucro_total": totais["lucro"],
+        "diario": diario,
+        "pagamento": pagamento,
+        "faturamento_anterior": anterior["faturamento"] if anterior else 0,
+        "produto_top": produto_top,
+        "cliente_top": next(iter(clientes_top), None),
+        "clientes_top": clientes_top
+    }
+
+def visao_geral_original(db, data_inicio, data_fim):
+    """Caminho anterior ao consolidado: uma consulta por indicador direto em `vendas`.
+    
+    Reproduz as 9 idas ao banco do painel original (inclusive o $lookup de
+    itens_venda e o de todas as vendas por cliente); mantido só para a
+    comparação de tempo com visao_geral_facet.
+    """
+    filtro_periodo, _, _ = filtros_visao_geral(data_inicio, data_fim)
+    dias_periodo = (data_fim - data_inicio).days
+    periodo_anterior = {
+        "$gte": datetime.combine(data_inicio - timedelta(days=dias_periodo), datetime.min.time()),
+        "$lte": datetime.combine(data_inicio - timedelta(days=1), datetime.max.time())
+    }
+    
+    total_vendas = db.vendas.count_documents(filtro_periodo)
+    faturamento = next(db.vendas.aggregate([
+        {"$match": filtro_periodo}, {"$group": {"_id": None, "total": {"$sum": "$valor_total"}}}
+    ]), {"total": 0})["total"]
+    lucro = next(db.vendas.aggregate([
+        {"$match": filtro_periodo}, {"$group": {"_id": None, "total": {"$sum": "$lucro_total"}}}
+    ]), {"total": 0})["total"]
+    diario = list(db.vendas.aggregate([
+        {"$match": filtro_periodo},
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$data_venda"}},
+            "total_vendas": {"$sum": 1},
+            "total_faturamento": {"$sum": "$valor_total"},
+            "total_lucro": {"$sum": "$lucro_total"}
+        }},
+        {"$sort": {"_id": 1}}
+    ]))
+    pagamento = list(db.vendas.aggregate([
+        {"$match": filtro_periodo},
+        {"$group": {
+            "_id": "$metodo_pagamento",
+            "total_vendas": {"$sum": 1},
+            "total_faturamento": {"$sum": "$valor_total"},
+            "total_lucro": {"$sum": "$lucro_total"}
+        }},
+        {"$sort": {"total_faturamento": -1}}
+    ]))
+    anterior = next(db.vendas.aggregate([
+        {"$match": {"data_venda": periodo_anterior, "status": "concluída"}},
+        {"$group": {"_id": None, "total": {"$sum": "$valor_total"}}}
+    ]), {"total": 0})["total"]
+    produto_top = next(db.itens_venda.aggregate([
+        {"$lookup": {"from": "vendas", "localField": "venda_id", "foreignField": "_id", "as": "venda"}},
+        {"$unwind": "$venda"},
+        {"$match": {"venda.data_venda": filtro_periodo["data_venda"], "venda.status": "concluída"}},
+        {"$group": {"_id": "$produto_id", "total_vendido": {"$sum": "$quantidade"}}},
+        {"$sort": {"total_vendido": -1}},
+        {"$limit": 1}
+    ]), None)
+    if produto_top:
+        produto_top["nome"] = (db.produtos.find_one({"_id": produto_top["_id"]}, {"nome": 1}) or {}).get("nome")
+    cliente_top = next(db.clientes.aggregate([
+        {"$lookup": {"from": "vendas", "localField": "_id", "foreignField": "cliente_id", "as": "vendas"}},
+        {"$match": {"vendas.data_venda": filtro_periodo["data_venda"]}},
+        {"$project": {"nome": 1, "total_gasto": {"$sum": "$vendas.valor_total"}}},
+        {"$sort": {"total_gasto": -1}},
+        {"$limit": 1}
+    ]), None)
+    
+    return {
+        "total_vendas": total_vendas,
+        "faturamento_total": faturamento,
+        "lucro_total": lucro,
+        "diario": diario,
+        "pagamento": pagamento,
+        "faturamento_anterior": anterior,
+        "produto_top": produto_top,
+        "cliente_top": cliente_top
+    }
+
+def visao_geral_facet(db, data_inicio, data_fim, top_clientes=TOP_CLIENTES_PADRAO):
+    """Indicadores da Visão Geral em duas idas ao banco ($facet no consolidado e nas vendas)"""
+    filtro_periodo, filtro_dias, periodo_anterior = filtros_visao_geral(data_inicio, data_fim)
+    
+    # 1ª ida: consolidado diário do período atual e do anterior
+    consolidado = next(db.vendas_diarias.aggregate([
+        {"$match": {"dia": {
+            "$gte": periodo_anterior["dia"]["$gte"],
+            "$lte": filtro_dias["dia"]["$lte"]
+        }}},
+        {"$facet": {
+            "totais": [{"$match": filtro_dias}, GRUPO_TOTAIS],
+            "diario": [{"$match": filtro_dias}] + ESTAGIOS_DIARIO,
+            "pagamento": [{"$match": filtro_dias}] + ESTAGIOS_PAGAMENTO,
+            "anterior": [{"$match": periodo_anterior}, GRUPO_TOTAIS]
+        }}
+    ]))
+    
+    # 2ª ida: destaques que dependem das vendas individuais
+    destaques = next(db.vendas.aggregate([
+        {"$match": filtro_periodo},
+        {"$project": {"cliente_id": 1, "valor_total": 1, "itens": 1}},
+        {"$facet": {
+            "produto_top": estagios_produto_top(db),
+            "clientes_top": estagios_clientes_top(top_clientes)
+        }}
+    ]))
+    
+    return _montar_visao_geral(
+        next(iter(consolidado["totais"]), None),
+        consolidado["diario"],
+        consolidado["pagamento"],
+        next(iter(consolidado["anterior"]), None),
+        next(iter(destaques["produto_top"]), None),
+        destaques["clientes_top"]
+    )
+
+def relatorio_produtos(db, data_inicio, data_fim):
+    """Estoque e desempenho de vendas por produto no período"""
+    # Consultas principais
+    pipeline_estoque = [
+        {"$match": {"ativo": True}},
+        {"$group": {
+            "_id": None,
+            "total_estoque": {"$sum": "$estoque"},
+            "valor_estoque": {"$sum": {"$multiply": ["$estoque", "$preco_venda"]}},
+            "custo_estoque": {"$sum": {"$multiply": ["$estoque", "$custo_producao"]}}
+        }}
+    ]
+    
+    estoque_data = next(db.produtos.aggregate(pipeline_estoque), {
+        "total_estoque": 0,
+        "valor_estoque": 0,
+        "custo_estoque": 0
+    })
+    
+    # Vendas por produto: só as vendas do período (índice status_data_venda), itens
+    # agrupados por produto antes de juntar o cadastro. O lucro usa o custo_unitario
+    # gravado no item, não o custo_producao atual.
+    filtro_periodo, _, _ = filtros_visao_geral(data_inicio, data_fim)
+    vendas_por_produto = {
+        grupo["_id"]: grupo for grupo in db.vendas.aggregate(
+            [{"$match": filtro_periodo}, {"$project": {"itens": 1}}]
+            + estagios_itens_da_venda(db)
+            + [{"$group": {
+                "_id": "$itens.produto_id",
+                "nome": {"$first": "$itens.nome"},
+                "vendidos": {"$sum": "$itens.quantidade"},
+                "faturamento": {"$sum": {"$multiply": ["$itens.quantidade", "$itens.preco_unitario"]}},
+                "custo": {"$sum": {"$multiply": ["$itens.quantidade", {"$ifNull": ["$itens.custo_unitario", 0]}]}}
+            }}]
+        )
+    }
+    
+    produtos_data = []
+    for produto in db.produtos.find(
+        {}, {"nome": 1, "categoria": 1, "preco_venda": 1, "custo_producao": 1, "estoque": 1}
+    ):
+        vendas = vendas_por_produto.pop(produto["_id"], {})
+        produtos_data.append({
+            **produto,
+            "vendidos": vendas.get("vendidos", 0),
+            "faturamento": vendas.get("faturamento", 0),
+            "lucro": vendas.get("faturamento", 0) - vendas.get("custo", 0)
+        })
+    # Vendidos no período mas já excluídos do cadastro
+    for produto_id, vendas in vendas_por_produto.items():
+        produtos_data.append({
+            "_id": produto_id,
+            "nome": vendas.get("nome") or "Produto removido",
+            "categoria": "Removidos",
+            "preco_venda": 0,
+            "custo_producao": 0,
+            "estoque": 0,
+            "vendidos": vendas["vendidos"],
+            "faturamento": vendas["faturamento"],
+            "lucro": vendas["faturamento"] - vendas["custo"]
+        })
+    produtos_data.sort(key=lambda p: p["vendidos"], reverse=True)
+    
+    return {
+        "estoque": estoque_data,
+        "produtos": produtos_data,
+        "produtos_ativos": db.produtos.count_documents({"ativo": True})
+    }
+
+DIAS_INATIVIDADE = 90
+LIMITE_CLIENTES_INATIVOS = 200
+LIMITE_MAIORES_CLIENTES = 10
+
+def relatorio_clientes(db, filtro_periodo):
+    """Compras do período agrupadas por cliente e clientes ativos sem compras recentes"""
+    total_clientes = db.clientes.estimated_document_count()
+    clientes_ativos = db.clientes.count_documents({"status": "ativo"})
+    
+    # Só as vendas do período (índice status_data_venda): custo proporcional às vendas no intervalo
+    pipeline_clientes = [
+        {"$match": filtro_periodo},
+        {"$group": {
+            "_id": "$cliente_id",
+            "total_compras": {"$sum": 1},
+            "total_gasto": {"$sum": "$valor_total"},
+            "ultima_compra": {"$max": "$data_venda"}
+        }},
+        {"$lookup": {
+            "from": "clientes",
+            "localField": "_id",
+            "foreignField": "_id",
+            "as": "cliente"
+        }},
+        {"$project": {
+            "total_compras": 1,
+            "total_gasto": 1,
+            "ultima_compra": 1,
+            "nome": {"$ifNull": [{"$first": "$cliente.nome"}, "Cliente removido"]},
+            "tipo": {"$ifNull": [{"$first": "$cliente.tipo"}, "desconhecido"]},
+            "status": {"$first": "$cliente.status"}
+        }},
+        {"$sort": {"total_gasto": -1}}
+    ]
+    clientes_data = list(db.vendas.aggregate(pipeline_clientes))
+    
+    # Inatividade e maiores clientes lidos do bloco estatisticas (índices próprios)
+    limite = datetime.now() - timedelta(days=DIAS_INATIVIDADE)
+    filtro_inativos = {"status": "ativo", "$or": [
+        {"estatisticas.ultima_compra": {"$lt": limite}},
+        {"estatisticas.ultima_compra": None}
+    ]}
+    inativos = [
+        {"nome": c["nome"], "tipo": c.get("tipo"), "ultima_compra": c.get("estatisticas", {}).get("ultima_compra")}
+        for c in db.clientes.find(filtro_inativos, {"nome": 1, "tipo": 1, "estatisticas.ultima_compra": 1})
+        .sort("estatisticas.ultima_compra", ASCENDING)
+        .limit(LIMITE_CLIENTES_INATIVOS)
+    ]
+    maiores_clientes = [
+        {"nome": c["nome"], "tipo": c.get("tipo"), **c["estatisticas"]}
+        for c in db.clientes.find(
+            {"estatisticas.total_gasto": {"$gt": 0}},
+            {"nome": 1, "tipo": 1, "estatisticas": 1}
+        ).sort("estatisticas.total_gasto", DESCENDING).limit(LIMITE_MAIORES_CLIENTES)
+    ]
+    
+    return {
+        "total_clientes": total_clientes,
+        "clientes_ativos": clientes_ativos,
+        "clientes": clientes_data,
+        "inativos": inativos,
+        "total_inativos": db.clientes.count_documents(filtro_inativos),
+        "maiores_clientes": maiores_clientes
+    }
+
+def relatorio_entregas(db, data_inicio, data_fim):
+    """Entregas do período com venda e cliente associados"""
+    filtro = {
+        "data_entrega": {
+            "$gte": datetime.combine(data_inicio, datetime.min.time()),
+            "$lte": datetime.combine(data_fim, datetime.max.time())
+        }
+    }
+    entregas = list(db.entregas.find(filtro).sort("data_entrega", 1))
+    
+    linhas = []
+    for entrega, venda, cliente in juntar_vendas_clientes(db, entregas):
+        try:
+            linhas.append({
+                "Data": entrega["data_entrega"].strftime("%d/%m/%Y %H:%M"),
+                "Venda": f"#{str(entrega['venda_id'])[-6:]}",
+                "Cliente": cliente["nome"] if cliente else "Não encontrado",
+                "Status": entrega["status"].replace("_", " ").title(),
+                "Custo": entrega.get("custo_entrega", 0),
+                "Responsável": entrega.get("responsavel", "Não informado")
+            })
+        except:
+            continue
+    
+    return {
+        "total": len(entregas),
+        "entregues": len([e for e in entregas if e["status"] == "entregue"]),
+        "linhas": linhas
+    }
+
 # =============================================
 # MÓDULO DE RELATÓRIOS
 # =============================================
@@ -1550,34 +3769,55 @@ def modulo_relatorios(db):
                 key="geral_fim"
             )
         
+        col3, col4 = st.columns(2)
+        with col3:
+            top_clientes = st.number_input(
+                "Clientes no ranking",
+                min_value=1,
+                max_value=50,
+                value=TOP_CLIENTES_PADRAO,
+                key="geral_top_clientes"
+            )
+        with col4:
+            st.write("")  # Espaçamento
+            comparar_caminhos = st.checkbox(
+                "⏱️ Comparar tempo com o painel original (direto em vendas)",
+                value=False,
+                key="geral_comparar_tempo"
+            )
+        
         if st.button("Atualizar Relatório", key="btn_atualizar_geral"):
             try:
-                # Filtro de período
-                filtro_periodo = {
-                    "data_venda": {
-                        "$gte": datetime.combine(data_inicio, datetime.min.time()),
-                        "$lte": datetime.combine(data_fim, datetime.max.time())
-                    },
-                    "status": "concluída"
-                }
-                
-                # 1. Métricas Principais
-                st.subheader("🔍 Métricas Principais")
+                inicio_consulta = pytime.perf_counter()
+                if comparar_caminhos:
+                    visao = visao_geral_facet(db, data_inicio, data_fim, top_clientes)
+                else:
+                    visao = relatorio_em_cache(
+                        db,
+                        "visao_geral",
+                        {"inicio": data_inicio, "fim": data_fim, "top_clientes": top_clientes},
+                        ["vendas", "vendas_diarias", "itens_venda", "produtos", "clientes"],
+                        lambda: visao_geral_facet(db, data_inicio, data_fim, top_clientes)
+                    )
+                tempo_facet = (pytime.perf_counter() - inicio_consulta) * 1000
                 
-                # Consultas principais
-                total_vendas = vendas_col.count_documents(filtro_periodo)
+                if comparar_caminhos:
+                    inicio_consulta = pytime.perf_counter()
+                    visao_geral_original(db, data_inicio, data_fim)
+                    tempo_original = (pytime.perf_counter() - inicio_consulta) * 1000
+                    st.caption(
+                        f"⏱️ $facet no consolidado (2 consultas): {tempo_facet:.0f} ms | "
+                        f"painel original em vendas (9 consultas): {tempo_original:.0f} ms"
+                    )
+                else:
+                    st.caption(f"⏱️ Consulta: {tempo_facet:.0f} ms")
                 
-                faturamento_result = vendas_col.aggregate([
-                    {"$match": filtro_periodo},
-                    {"$group": {"_id": None, "total": {"$sum": "$valor_total"}}}
-                ])
-                faturamento_total = next(faturamento_result, {"total": 0})["total"]
+                total_vendas = visao["total_vendas"]
+                faturamento_total = visao["faturamento_total"]
+                lucro_total = visao["lucro_total"]
                 
-                lucro_result = vendas_col.aggregate([
-                    {"$match": filtro_periodo},
-                    {"$group": {"_id": None, "total": {"$sum": "$lucro_total"}}}
-                ])
-                lucro_total = next(lucro_result, {"total": 0})["total"]
+                # 1. Métricas Principais
+                st.subheader("🔍 Métricas Principais")
                 
                 # Clientes ativos
                 clientes_ativos = clientes_col.count_documents({"status": "ativo"})
@@ -1612,23 +3852,7 @@ def modulo_relatorios(db):
                 st.subheader("📅 Análise Temporal")
                 
                 # Vendas por dia
-                vendas_diarias = vendas_col.aggregate([
-                    {"$match": filtro_periodo},
-                    {"$project": {
-                        "data": {"$dateToString": {"format": "%Y-%m-%d", "date": "$data_venda"}},
-                        "valor_total": 1,
-                        "lucro_total": 1
-                    }},
-                    {"$group": {
-                        "_id": "$data",
-                        "total_vendas": {"$sum": 1},
-                        "total_faturamento": {"$sum": "$valor_total"},
-                        "total_lucro": {"$sum": "$lucro_total"}
-                    }},
-                    {"$sort": {"_id": 1}}
-                ])
-                
-                df_diario = pd.DataFrame(list(vendas_diarias))
+                df_diario = pd.DataFrame(visao["diario"])
                 if not df_diario.empty:
                     df_diario['_id'] = pd.to_datetime(df_diario['_id'])
                     df_diario = df_diario.set_index('_id')
@@ -1646,30 +3870,12 @@ def modulo_relatorios(db):
                 # 3. Métricas por Forma de Pagamento
                 st.subheader("💳 Análise por Forma de Pagamento")
                 
-                pagamento_analise = vendas_col.aggregate([
-                    {"$match": filtro_periodo},
-                    {"$group": {
-                        "_id": "$metodo_pagamento",
-                        "total_vendas": {"$sum": 1},
-                        "total_faturamento": {"$sum": "$valor_total"},
-                        "total_lucro": {"$sum": "$lucro_total"}
-                    }},
-                    {"$addFields": {
-                        "percentual_faturamento": {
-                            "$multiply": [
-                                {"$divide": ["$total_faturamento", faturamento_total]},
-                                100
-                            ]
-                        },
-                        "ticket_medio": {
-                            "$divide": ["$total_faturamento", "$total_vendas"]
-                        }
-                    }},
-                    {"$sort": {"total_faturamento": -1}}
-                ])
-                
-                df_pagamento = pd.DataFrame(list(pagamento_analise))
+                df_pagamento = pd.DataFrame(visao["pagamento"])
                 if not df_pagamento.empty:
+                    df_pagamento["percentual_faturamento"] = (
+                        df_pagamento["total_faturamento"] / faturamento_total * 100 if faturamento_total else 0
+                    )
+                    df_pagamento["ticket_medio"] = df_pagamento["total_faturamento"] / df_pagamento["total_vendas"]
                     df_pagamento = df_pagamento.rename(columns={
                         "_id": "Pagamento",
                         "total_vendas": "Vendas",
@@ -1698,20 +3904,7 @@ def modulo_relatorios(db):
                 st.subheader("📊 Indicadores de Desempenho")
                 
                 # Comparativo com período anterior
-                # Calcula a diferença de dias entre data_fim e data_inicio
-                dias_periodo = (data_fim - data_inicio).days
-
-                # Define o período anterior com a mesma duração do período atual
-                periodo_anterior = {
-                            "$gte": datetime.combine(data_inicio - timedelta(days=dias_periodo), datetime.min.time()),
-                        "$lte": datetime.combine(data_inicio - timedelta(days=1), datetime.max.time())
-                                        }
-                
-                faturamento_anterior = next(vendas_col.aggregate([
-                    {"$match": {"data_venda": periodo_anterior, "status": "concluída"}},
-                    {"$group": {"_id": None, "total": {"$sum": "$valor_total"}}}
-                ]), {"total": 0})["total"]
-                
+                faturamento_anterior = visao["faturamento_anterior"]
                 variacao_faturamento = ((faturamento_total - faturamento_anterior) / faturamento_anterior * 100) if faturamento_anterior > 0 else 0
                 
                 col_i1, col_i2, col_i3 = st.columns(3)
@@ -1723,134 +3916,84 @@ def modulo_relatorios(db):
                         delta_color="normal" if variacao_faturamento >= 0 else "inverse"
                     )
                 with col_i2:
-                    produtos_mais_vendidos = list(itens_col.aggregate([
-                        {"$lookup": {
-                            "from": "vendas",
-                            "localField": "venda_id",
-                            "foreignField": "_id",
-                            "as": "venda"
-                        }},
-                        {"$unwind": "$venda"},
-                        {"$match": filtro_periodo},
-                        {"$group": {
-                            "_id": "$produto_id",
-                            "total_vendido": {"$sum": "$quantidade"}
-                        }},
-                        {"$sort": {"total_vendido": -1}},
-                        {"$limit": 1}
-                    ]))
-                    
-                    if produtos_mais_vendidos:
-                        produto = produtos_col.find_one({"_id": produtos_mais_vendidos[0]["_id"]})
+                    produto_top = visao["produto_top"]
+                    if produto_top:
                         st.metric(
                             "Produto Mais Vendido",
-                            produto["nome"],
-                            delta=f"{produtos_mais_vendidos[0]['total_vendido']} unidades"
+                            produto_top.get("nome", "Produto removido"),
+                            delta=f"{produto_top['total_vendido']} unidades"
                         )
                     else:
                         st.metric("Produto Mais Vendido", "Nenhum")
                 with col_i3:
-                    cliente_top = next(clientes_col.aggregate([
-                        {"$lookup": {
-                            "from": "vendas",
-                            "localField": "_id",
-                            "foreignField": "cliente_id",
-                            "as": "vendas"
-                        }},
-                        {"$match": {"vendas.data_venda": filtro_periodo["data_venda"]}},
-                        {"$project": {
-                            "nome": 1,
-                            "total_gasto": {"$sum": "$vendas.valor_total"}
-                        }},
-                        {"$sort": {"total_gasto": -1}},
-                        {"$limit": 1}
-                    ]), None)
-                    
+                    cliente_top = visao["cliente_top"]
                     if cliente_top:
                         st.metric(
                             "Cliente Top",
-                            cliente_top["nome"],
-                            delta=f"R$ {cliente_top['total_gasto']:,.2f}"
+                            cliente_top.get("nome", "Cliente removido"),
+                            delta=f"R$ {cliente_top['total_gasto']:,.2f} em {cliente_top['compras']} compras"
                         )
                     else:
                         st.metric("Cliente Top", "Nenhum")
                 
+                # 5. Ranking de clientes no período
+                if visao["clientes_top"]:
+                    st.subheader(f"🏆 Top {len(visao['clientes_top'])} Clientes do Período")
+                    # reindex: sem clientes encontrados o $first omite "nome" em todas as linhas
+                    df_top = pd.DataFrame(visao["clientes_top"]).reindex(columns=["nome", "compras", "total_gasto"])
+                    df_top["nome"] = df_top["nome"].fillna("Cliente removido")
+                    df_top["ticket_medio"] = df_top["total_gasto"] / df_top["compras"]
+                    st.dataframe(
+                        df_top[["nome", "compras", "total_gasto", "ticket_medio"]],
+                        column_config={
+                            "nome": "Cliente",
+                            "compras": "Compras",
+                            "total_gasto": st.column_config.NumberColumn("Gasto no Período", format="R$ %.2f"),
+                            "ticket_medio": st.column_config.NumberColumn("Ticket Médio", format="R$ %.2f")
+                        },
+                        hide_index=True,
+                        use_container_width=True
+                    )
+                
             except Exception as e:
                 st.error(f"Erro ao gerar relatório: {str(e)}")
 
     with tab2:
         st.subheader("Análise de Produtos")
         
+        col1, col2 = st.columns(2)
+        with col1:
+            data_inicio_produtos = st.date_input(
+                "Data Início",
+                value=datetime.now() - timedelta(days=30),
+                key="produtos_inicio"
+            )
+        with col2:
+            data_fim_produtos = st.date_input(
+                "Data Fim",
+                value=datetime.now(),
+                key="produtos_fim"
+            )
+        
         if st.button("Atualizar Relatório de Produtos", key="btn_atualizar_produtos"):
             try:
                 # 1. Métricas de Produtos
                 st.subheader("📦 Métricas de Produtos")
                 
-                # Consultas principais
-                pipeline_estoque = [
-                    {"$match": {"ativo": True}},
-                    {"$group": {
-                        "_id": None,
-                        "total_estoque": {"$sum": "$estoque"},
-                        "valor_estoque": {"$sum": {"$multiply": ["$estoque", "$preco_venda"]}},
-                        "custo_estoque": {"$sum": {"$multiply": ["$estoque", "$custo_producao"]}}
-                    }}
-                ]
-                
-                estoque_data = next(produtos_col.aggregate(pipeline_estoque), {
-                    "total_estoque": 0,
-                    "valor_estoque": 0,
-                    "custo_estoque": 0
-                })
-                
-                # Vendas de produtos
-                pipeline_vendas = [
-                    {"$lookup": {
-                        "from": "itens_venda",
-                        "localField": "_id",
-                        "foreignField": "produto_id",
-                        "as": "itens_venda"
-                    }},
-                    {"$project": {
-                        "nome": 1,
-                        "categoria": 1,
-                        "preco_venda": 1,
-                        "custo_producao": 1,
-                        "estoque": 1,
-                        "vendidos": {"$sum": "$itens_venda.quantidade"},
-                        "faturamento": {
-                            "$sum": {
-                                "$map": {
-                                    "input": "$itens_venda",
-                                    "as": "item",
-                                    "in": {"$multiply": ["$$item.quantidade", "$$item.preco_unitario"]}
-                                }
-                            }
-                        },
-                        "lucro": {
-                            "$sum": {
-                                "$map": {
-                                    "input": "$itens_venda",
-                                    "as": "item",
-                                    "in": {
-                                        "$multiply": [
-                                            {"$subtract": ["$$item.preco_unitario", "$custo_producao"]},
-                                            "$$item.quantidade"
-                                        ]
-                                    }
-                                }
-                            }
-                        }
-                    }},
-                    {"$sort": {"vendidos": -1}}
-                ]
-                
-                produtos_data = list(produtos_col.aggregate(pipeline_vendas))
+                dados_relatorio = relatorio_em_cache(
+                    db,
+                    "produtos",
+                    {"inicio": data_inicio_produtos, "fim": data_fim_produtos},
+                    ["produtos", "itens_venda", "vendas"],
+                    lambda: relatorio_produtos(db, data_inicio_produtos, data_fim_produtos)
+                )
+                estoque_data = dados_relatorio["estoque"]
+                produtos_data = dados_relatorio["produtos"]
                 
                 # Exibe métricas
                 col_p1, col_p2, col_p3, col_p4 = st.columns(4)
                 with col_p1:
-                    st.metric("Produtos Ativos", produtos_col.count_documents({"ativo": True}))
+                    st.metric("Produtos Ativos", dados_relatorio["produtos_ativos"])
                 with col_p2:
                     st.metric("Total em Estoque", estoque_data["total_estoque"])
                 with col_p3:
@@ -1980,29 +4123,16 @@ def modulo_relatorios(db):
                 # 1. Métricas de Clientes
                 st.subheader("👥 Métricas de Clientes")
                 
-                # Consultas principais
-                total_clientes = clientes_col.count_documents({})
-                clientes_ativos = clientes_col.count_documents({"status": "ativo"})
-                
-                pipeline_clientes = [
-                    {"$lookup": {
-                        "from": "vendas",
-                        "localField": "_id",
-                        "foreignField": "cliente_id",
-                        "as": "vendas"
-                    }},
-                    {"$project": {
-                        "nome": 1,
-                        "tipo": 1,
-                        "status": 1,
-                        "total_compras": {"$size": "$vendas"},
-                        "total_gasto": {"$sum": "$vendas.valor_total"},
-                        "ultima_compra": {"$max": "$vendas.data_venda"}
-                    }},
-                    {"$sort": {"total_gasto": -1}}
-                ]
-                
-                clientes_data = list(clientes_col.aggregate(pipeline_clientes))
+                dados_relatorio = relatorio_em_cache(
+                    db,
+                    "clientes",
+                    {"inicio": data_inicio_clientes, "fim": data_fim_clientes},
+                    ["clientes", "vendas"],
+                    lambda: relatorio_clientes(db, filtro_periodo_clientes)
+                )
+                total_clientes = dados_relatorio["total_clientes"]
+                clientes_ativos = dados_relatorio["clientes_ativos"]
+                clientes_data = dados_relatorio["clientes"]
                 
                 # Exibe métricas
                 col_c1, col_c2, col_c3, col_c4 = st.columns(4)
@@ -2011,10 +4141,18 @@ def modulo_relatorios(db):
                 with col_c2:
                     st.metric("Clientes Ativos", clientes_ativos)
                 with col_c3:
-                    clientes_compraram = len([c for c in clientes_data if c["total_compras"] > 0])
-                    st.metric("Clientes que Compraram", clientes_compraram)
+                    clientes_compraram = len(clientes_data)
+                    st.metric("Clientes que Compraram no Período", clientes_compraram)
                 with col_c4:
-                    st.metric("Taxa de Retenção", f"{(clientes_compraram/clientes_ativos*100 if clientes_ativos > 0 else 0):.1f}%")
+                    st.metric(
+                        "Taxa de Retenção no Período",
+                        f"{(clientes_compraram/clientes_ativos*100 if clientes_ativos > 0 else 0):.1f}%",
+                        help="Clientes com compras no período selecionado ÷ clientes ativos hoje"
+                    )
+                st.caption(
+                    "Compras e retenção consideram apenas as vendas do período selecionado, "
+                    "não todo o histórico do cliente."
+                )
                 
                 # 2. Segmentação de Clientes
                 st.subheader("📊 Segmentação de Clientes")
@@ -2047,44 +4185,62 @@ def modulo_relatorios(db):
                     # 3. Clientes VIP
                     st.subheader("🏆 Clientes VIP (Top 10)")
                     
-                    clientes_vip = df_clientes[df_clientes['total_compras'] > 0].sort_values('total_gasto', ascending=False).head(10)
-                    
-                    if not clientes_vip.empty:
-                        st.dataframe(
-                            clientes_vip[['nome', 'tipo', 'total_compras', 'total_gasto']],
-                            column_config={
-                                "total_compras": "Compras",
-                                "total_gasto": st.column_config.NumberColumn("Faturamento", format="R$ %.2f")
-                            },
-                            hide_index=True,
-                            use_container_width=True
-                        )
-                    else:
-                        st.info("Nenhum cliente com compras no período.")
-                    
-                    # 4. Clientes Inativos
-                    st.subheader("💤 Clientes Inativos (Sem compras nos últimos 90 dias)")
-                    
-                    limite_inatividade = datetime.now() - timedelta(days=90)
-                    clientes_inativos = df_clientes[
-                        (df_clientes['ultima_compra'].isna()) | 
-                        (df_clientes['ultima_compra'] < limite_inatividade)
-                    ]
-                    
-                    if not clientes_inativos.empty:
-                        st.dataframe(
-                            clientes_inativos[['nome', 'tipo', 'ultima_compra']],
-                            column_config={
-                                "ultima_compra": st.column_config.DatetimeColumn("Última Compra", format="DD/MM/YYYY")
-                            },
-                            hide_index=True,
-                            use_container_width=True
+                    # Já ordenado por total_gasto no servidor
+                    st.dataframe(
+                        df_clientes.head(10)[['nome', 'tipo', 'total_compras', 'total_gasto']],
+                        column_config={
+                            "total_compras": "Compras",
+                            "total_gasto": st.column_config.NumberColumn("Faturamento", format="R$ %.2f")
+                        },
+                        hide_index=True,
+                        use_container_width=True
+                    )
+                else:
+                    st.info("Nenhum cliente com compras no período.")
+                
+                # 4. Maiores clientes de todo o histórico (bloco estatisticas mantido no checkout)
+                st.subheader("💎 Maiores Clientes (todo o histórico)")
+                
+                if dados_relatorio["maiores_clientes"]:
+                    st.dataframe(
+                        pd.DataFrame(dados_relatorio["maiores_clientes"]).reindex(columns=[
+                            'nome', 'tipo', 'compras', 'total_gasto', 'ticket_medio',
+                            'intervalo_medio_dias', 'primeira_compra', 'ultima_compra'
+                        ]),
+                        column_config={
+                            "compras": "Compras",
+                            "total_gasto": st.column_config.NumberColumn("Total Gasto", format="R$ %.2f"),
+                            "ticket_medio": st.column_config.NumberColumn("Ticket Médio", format="R$ %.2f"),
+                            "intervalo_medio_dias": st.column_config.NumberColumn("Intervalo Médio (dias)", format="%.1f"),
+                            "primeira_compra": st.column_config.DatetimeColumn("Primeira Compra", format="DD/MM/YYYY"),
+                            "ultima_compra": st.column_config.DatetimeColumn("Última Compra", format="DD/MM/YYYY")
+                        },
+                        hide_index=True,
+                        use_container_width=True
+                    )
+                else:
+                    st.info("Nenhum cliente com estatísticas registradas.")
+                
+                # 5. Clientes Inativos
+                st.subheader(f"💤 Clientes Inativos (Sem compras nos últimos {DIAS_INATIVIDADE} dias)")
+                
+                if dados_relatorio["inativos"]:
+                    if dados_relatorio["total_inativos"] > LIMITE_CLIENTES_INATIVOS:
+                        st.caption(
+                            f"Exibindo os {LIMITE_CLIENTES_INATIVOS} há mais tempo sem comprar "
+                            f"de {dados_relatorio['total_inativos']} clientes inativos."
                         )
-                    else:
-                        st.success("Todos os clientes fizeram compras recentemente!")
-                    
+                    clientes_inativos = pd.DataFrame(dados_relatorio["inativos"])
+                    st.dataframe(
+                        clientes_inativos.reindex(columns=['nome', 'tipo', 'ultima_compra']),
+                        column_config={
+                            "ultima_compra": st.column_config.DatetimeColumn("Última Compra", format="DD/MM/YYYY")
+                        },
+                        hide_index=True,
+                        use_container_width=True
+                    )
                 else:
-                    st.info("Nenhum dado disponível sobre clientes.")
+                    st.success("Todos os clientes fizeram compras recentemente!")
                 
             except Exception as e:
                 st.error(f"Erro ao gerar relatório: {str(e)}")
@@ -2110,6 +4266,9 @@ def main():
         st.error("Não foi possível conectar ao banco de dados. Verifique sua conexão com a internet e as credenciais do MongoDB.")
         return
     
+    # Provisiona os índices uma vez por processo
+    indices = inicializar_indices(db)
+    
     # Verifica autenticação antes de mostrar qualquer conteúdo
     if not st.session_state.autenticado:
         pagina_login(db)
@@ -2148,7 +4307,38 @@ def main():
             st.rerun()
         
         st.markdown(f"**Data/Hora:** {datetime.now().strftime('%d/%m/%Y %H:%M')}")
-    
+
+        # Diagnóstico do processo (apenas administradores)
+        if st.session_state.usuario_atual['nivel_acesso'] == 'admin':
+            with st.expander("⚙️ Diagnóstico"):
+                conexao = estatisticas_conexao()
+                st.caption(f"🔌 Clientes MongoDB criados: {conexao['clientes_criados']}")
+                st.caption(f"🤝 Handshakes realizados: {conexao['handshakes']}")
+                st.caption(f"🔁 Reconexões: {conexao['reconexoes']}")
+                st.caption(f"🗂️ Índices: {len(indices['criados'])} criados, {len(indices['existentes'])} já existentes")
+                for divergente in indices["divergentes"]:
+                    st.caption(f"⚠️ Opções divergentes (python main.py indices --recriar): {divergente}")
+                for erro in indices["erros"]:
+                    st.caption(f"❌ {erro}")
+                
+                cache = estatisticas_cache_relatorios()
+                st.caption(
+                    f"🗃️ Cache de relatórios: {cache['taxa_acerto']:.0f}% de acertos "
+                    f"({cache['acertos']} acertos, {cache['falhas']} falhas, {cache['despejos']} despejos)"
+                )
+                st.caption(
+                    f"🔄 Invalidação por versoes_colecoes, relida a cada {CACHE_VERSOES_INTERVALO} s "
+                    "(inclui escritas da linha de comando)"
+                )
+                if cache["entradas"]:
+                    st.dataframe(pd.DataFrame(cache["entradas"]), hide_index=True)
+                
+                opcoes = estatisticas_cache_opcoes()
+                st.caption(
+                    f"📋 Opções de seleção: {opcoes['mapas']} mapas, {opcoes['taxa_acerto']:.0f}% de acertos "
+                    f"({opcoes['acertos']} acertos, {opcoes['falhas']} falhas; TTL {CACHE_OPCOES_TTL} s)"
+                )
+
     # Navegação
     if 'pagina_atual' in st.session_state and st.session_state.pagina_atual == "alterar_senha":
         alterar_senha(db)
@@ -2165,5 +4355,801 @@ def main():
     elif menu == "👨‍💼 Usuários":
         modulo_usuarios(db)
 
+# =============================================
+# BENCHMARKS
+# =============================================
+
+NOME_BANCO_BENCHMARK = "saridulces_benchmark"
+
+def banco_benchmark(db):
+    """Banco descartável dos benchmarks: recriado a cada execução, nunca o de produção"""
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+    bench = db.client.get_database(NOME_BANCO_BENCHMARK)
+    garantir_indices(bench)
+    return bench
+
+def medir_latencia(funcao, repeticoes):
+    """Executa funcao() `repeticoes` vezes e retorna (mediana, p95) em ms"""
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = pytime.perf_counter()
+        funcao()
+        tempos.append((pytime.perf_counter() - inicio) * 1000)
+    tempos.sort()
+    return statistics.median(tempos), tempos[min(len(tempos) - 1, int(len(tempos) * 0.95))]
+
+def benchmark_checkout(db, args):
+    """Latência de registrar_venda para carrinhos de 1, 10 e 50 itens, nos dois esquemas de itens"""
+    bench = banco_benchmark(db)
+    produtos = [
+        {
+            "nome": f"Produto {i:02d}",
+            "categoria": "Doce",
+            "preco_venda": 10.0,
+            "custo_producao": 4.0,
+            "estoque": 1_000_000,
+            "ativo": True
+        }
+        for i in range(50)
+    ]
+    bench.produtos.insert_many(produtos)
+    cliente_id = bench.clientes.insert_one({
+        "nome": "Cliente Benchmark",
+        "tipo": "consumidor_final",
+        "status": "ativo",
+        "compras_realizadas": 0,
+        "total_gasto": 0.0
+    }).inserted_id
+    
+    print(f"{'esquema':<10} | {'itens':>5} | {'mediana ms':>10} | {'p95 ms':>10}")
+    cenarios = [
+        (esquema, embutir, tamanho)
+        for esquema, embutir in (("itens_venda", False), ("embutido", True))
+        for tamanho in (1, 10, 50)
+    ]
+    for esquema, embutir, tamanho in cenarios:
+        itens = [
+            {
+                "produto_id": str(p["_id"]),
+                "nome": p["nome"],
+                "quantidade": 1,
+                "preco_unitario": p["preco_venda"],
+                "custo_unitario": p["custo_producao"],
+                "subtotal": p["preco_venda"]
+            }
+            for p in produtos[:tamanho]
+        ]
+        
+        def vender():
+            registrar_venda(bench, {
+                "cliente_id": cliente_id,
+                "data_venda": datetime.now(),
+                "valor_total": 10.0 * tamanho,
+                "lucro_total": 6.0 * tamanho,
+                "status": "concluída",
+                "itens_count": tamanho,
+                "metodo_pagamento": "pix",
+                "detalhes_pagamento": {},
+                "tipo_entrega": "retirada_na_loja",
+                "custo_entrega": 0.0
+            }, itens, "consumidor_final", embutir=embutir)
+        
+        mediana, p95 = medir_latencia(vender, args.repeticoes)
+        print(f"{esquema:<10} | {tamanho:>5} | {mediana:>10.1f} | {p95:>10.1f}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def benchmark_cancelamento(db, args):
+    """Latência de cancelar_vendas para seleções de 1, 10 e 50 vendas de 10 itens"""
+    bench = banco_benchmark(db)
+    produtos = [
+        {"nome": f"Produto {i:02d}", "preco_venda": 10.0, "custo_producao": 4.0, "estoque": 10_000_000, "ativo": True}
+        for i in range(50)
+    ]
+    bench.produtos.insert_many(produtos)
+    clientes = bench.clientes.insert_many([
+        {"nome": f"Cliente {i:02d}", "tipo": "consumidor_final", "status": "ativo",
+         "compras_realizadas": 0, "total_gasto": 0.0}
+        for i in range(20)
+    ]).inserted_ids
+    aleatorio = random.Random(42)
+    
+    def nova_venda():
+        itens = [
+            {"produto_id": str(p["_id"]), "nome": p["nome"], "quantidade": 1,
+             "preco_unitario": 10.0, "custo_unitario": 4.0, "subtotal": 10.0}
+            for p in aleatorio.sample(produtos, 10)
+        ]
+        return registrar_venda(bench, {
+            "cliente_id": aleatorio.choice(clientes),
+            "data_venda": datetime.now() - timedelta(days=aleatorio.randrange(30)),
+            "valor_total": 100.0,
+            "lucro_total": 60.0,
+            "status": "concluída",
+            "itens_count": 10,
+            "metodo_pagamento": aleatorio.choice(["pix", "dinheiro"]),
+            "detalhes_pagamento": {},
+            "tipo_entrega": "retirada_na_loja",
+            "custo_entrega": 0.0
+        }, itens, "consumidor_final")["_id"]
+    
+    print(f"{'vendas':>6} | {'mediana ms':>10} | {'p95 ms':>10}")
+    for tamanho in (1, 10, 50):
+        lotes = iter([[nova_venda() for _ in range(tamanho)] for _ in range(args.repeticoes)])
+        mediana, p95 = medir_latencia(lambda: cancelar_vendas(bench, next(lotes)), args.repeticoes)
+        print(f"{tamanho:>6} | {mediana:>10.1f} | {p95:>10.1f}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def benchmark_relatorio_produtos(db, args):
+    """Relatório de produtos com 1M de itens: $lookup por produto vs. itens do período agrupados"""
+    bench = banco_benchmark(db)
+    total_itens = max(args.documentos, 1_000_000)
+    itens_por_venda = 10
+    produtos = bench.produtos.insert_many([
+        {"nome": f"Produto {i:03d}", "categoria": "Doce", "preco_venda": 10.0,
+         "custo_producao": 4.0, "estoque": 100, "ativo": True}
+        for i in range(200)
+    ]).inserted_ids
+    aleatorio = random.Random(42)
+    inicio_ano = datetime.now() - timedelta(days=365)
+    
+    for inicio in range(0, total_itens // itens_por_venda, 5_000):
+        vendas, itens = [], []
+        for i in range(inicio, min(inicio + 5_000, total_itens // itens_por_venda)):
+            venda_id = ObjectId()
+            vendas.append({
+                "_id": venda_id,
+                "cliente_id": ObjectId(),
+                "data_venda": inicio_ano + timedelta(seconds=aleatorio.randrange(365 * 86400)),
+                "valor_total": 100.0,
+                "lucro_total": 60.0,
+                "status": "concluída",
+                "metodo_pagamento": "pix"
+            })
+            itens.extend(
+                {"venda_id": venda_id, "produto_id": produto_id, "quantidade": 1,
+                 "preco_unitario": 10.0, "custo_unitario": 4.0, "subtotal": 10.0}
+                for produto_id in aleatorio.sample(produtos, itens_por_venda)
+            )
+        bench.vendas.insert_many(vendas)
+        bench.itens_venda.insert_many(itens)
+    
+    # Pipeline anterior: cada produto recebe no $lookup todos os itens já vendidos
+    pipeline_anterior = [
+        {"$lookup": {"from": "itens_venda", "localField": "_id", "foreignField": "produto_id", "as": "itens_venda"}},
+        {"$project": {
+            "vendidos": {"$sum": "$itens_venda.quantidade"},
+            "faturamento": {"$sum": {"$map": {
+                "input": "$itens_venda", "as": "item",
+                "in": {"$multiply": ["$$item.quantidade", "$$item.preco_unitario"]}
+            }}}
+        }},
+        {"$sort": {"vendidos": -1}}
+    ]
+    
+    print(f"{total_itens} itens em {total_itens // itens_por_venda} vendas, 200 produtos")
+    print(f"{'consulta':<22} | {'mediana ms':>10} | {'p95 ms':>10}")
+    repeticoes = min(args.repeticoes, 5)
+    try:
+        mediana, p95 = medir_latencia(lambda: list(bench.produtos.aggregate(pipeline_anterior)), repeticoes)
+        print(f"{'$lookup por produto':<22} | {mediana:>10.1f} | {p95:>10.1f}")
+    except OperationFailure as e:
+        print(f"{'$lookup por produto':<22} | falhou: {e}")
+    for dias in (30, 365):
+        hoje = date.today()
+        mediana, p95 = medir_latencia(
+            lambda: relatorio_produtos(bench, hoje - timedelta(days=dias), hoje), repeticoes
+        )
+        print(f"{f'agrupado ({dias} dias)':<22} | {mediana:>10.1f} | {p95:>10.1f}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def benchmark_clientes_top(db, args):
+    """Top-N clientes em um ano de vendas: $lookup de todas as vendas por cliente vs. vendas do período agrupadas"""
+    bench = banco_benchmark(db)
+    total_vendas = max(args.documentos, 200_000)
+    clientes = bench.clientes.insert_many([
+        {"nome": f"Cliente {i:05d}", "tipo": "consumidor_final", "status": "ativo"}
+        for i in range(5_000)
+    ]).inserted_ids
+    aleatorio = random.Random(42)
+    inicio_ano = datetime.now() - timedelta(days=365)
+    for inicio in range(0, total_vendas, 10_000):
+        bench.vendas.insert_many([
+            {
+                "cliente_id": aleatorio.choice(clientes),
+                "data_venda": inicio_ano + timedelta(seconds=aleatorio.randrange(365 * 86400)),
+                "valor_total": float(aleatorio.randrange(10, 500)),
+                "status": "concluída",
+                "metodo_pagamento": "pix"
+            }
+            for _ in range(inicio, min(inicio + 10_000, total_vendas))
+        ])
+    
+    print(f"{total_vendas} vendas, {len(clientes)} clientes, top 10")
+    print(f"{'período':>8} | {'consulta':<22} | {'mediana ms':>10} | {'p95 ms':>10}")
+    repeticoes = min(args.repeticoes, 5)
+    for dias in (30, 365):
+        hoje = date.today()
+        filtro_periodo, _, _ = filtros_visao_geral(hoje - timedelta(days=dias), hoje)
+        # Pipeline anterior: todas as vendas de cada cliente no $lookup, gasto de todo o histórico
+        anterior = [
+            {"$lookup": {"from": "vendas", "localField": "_id", "foreignField": "cliente_id", "as": "vendas"}},
+            {"$match": {"vendas.data_venda": filtro_periodo["data_venda"]}},
+            {"$project": {"nome": 1, "total_gasto": {"$sum": "$vendas.valor_total"}}},
+            {"$sort": {"total_gasto": -1}},
+            {"$limit": 10}
+        ]
+        for rotulo, funcao in [
+            ("$lookup por cliente", lambda: list(bench.clientes.aggregate(anterior))),
+            ("vendas do período", lambda: list(bench.vendas.aggregate(
+                [{"$match": filtro_periodo}] + estagios_clientes_top(10)
+            )))
+        ]:
+            mediana, p95 = medir_latencia(funcao, repeticoes)
+            print(f"{dias:>8} | {rotulo:<22} | {mediana:>10.1f} | {p95:>10.1f}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def _medir_leitura(colecao, projecao):
+    """Lê a coleção como BSON bruto: retorna (bytes recebidos, ms de busca, ms de decodificação)"""
+    bruta = colecao.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    
+    inicio = pytime.perf_counter()
+    documentos = list(bruta.find({}, projecao).sort("nome", 1))
+    tempo_busca = (pytime.perf_counter() - inicio) * 1000
+    
+    inicio = pytime.perf_counter()
+    for documento in documentos:
+        bson.decode(documento.raw)
+    tempo_decodificacao = (pytime.perf_counter() - inicio) * 1000
+    
+    return sum(len(d.raw) for d in documentos), tempo_busca, tempo_decodificacao
+
+def benchmark_projecoes(db, args):
+    """Bytes transferidos e tempo de decodificação das listas com e sem projeção"""
+    bench = banco_benchmark(db)
+    total = args.documentos
+    texto = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 8
+    
+    bench.clientes.insert_many([
+        {
+            "nome": f"Cliente {i:06d}",
+            "data_nascimento": datetime(1990, 1, 1),
+            "cpf": f"{i:011d}",
+            "contato": {"celular": f"(11) 9{i:04d}-0000", "email": f"cliente{i}@exemplo.com"},
+            "endereco": texto,
+            "observacoes": texto * 2,
+            "data_cadastro": datetime.now(),
+            "ultima_atualizacao": datetime.now(),
+            "status": "ativo",
+            "tipo": "consumidor_final",
+            "compras_realizadas": 0,
+            "total_gasto": 0.0
+        }
+        for i in range(total)
+    ])
+    bench.produtos.insert_many([
+        {
+            "nome": f"Produto {i:06d}",
+            "codigo": f"SKU{i:06d}",
+            "categoria": "Doce",
+            "descricao": texto,
+            "ingredientes": texto,
+            "preco_venda": 10.0,
+            "custo_producao": 4.0,
+            "estoque": 100,
+            "data_cadastro": datetime.now(),
+            "ultima_atualizacao": datetime.now(),
+            "ativo": True,
+            "destaque": False
+        }
+        for i in range(total)
+    ])
+    bench.usuarios.insert_many([
+        {
+            "nome": f"Usuário {i:06d}",
+            "username": f"usuario{i}",
+            "email": f"usuario{i}@empresa.com",
+            "password_hash": hashlib.sha256(str(i).encode()).hexdigest(),
+            "nivel_acesso": "operador",
+            "data_criacao": datetime.now(),
+            "ultimo_login": None,
+            "ativo": True
+        }
+        for i in range(total)
+    ])
+    
+    print(f"{total} documentos por coleção")
+    print(f"{'lista':<10} | {'projeção':<8} | {'KB':>9} | {'busca ms':>9} | {'decode ms':>9}")
+    for nome, colecao, projecao in [
+        ("clientes", bench.clientes, PROJECAO_LISTA_CLIENTES),
+        ("produtos", bench.produtos, PROJECAO_LISTA_PRODUTOS),
+        ("usuarios", bench.usuarios, PROJECAO_LISTA_USUARIOS)
+    ]:
+        for rotulo, proj in [("não", None), ("sim", projecao)]:
+            tamanho, busca, decodificacao = _medir_leitura(colecao, proj)
+            print(f"{nome:<10} | {rotulo:<8} | {tamanho / 1024:>9.0f} | {busca:>9.1f} | {decodificacao:>9.1f}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+PRENOMES_BENCHMARK = ["Maria", "José", "João", "Ana", "Antônio", "Francisca", "Luíza", "Conceição", "Paulo", "Márcia"]
+SOBRENOMES_BENCHMARK = ["Silva", "Santos", "Oliveira", "Souza", "Araújo", "Gonçalves", "Lima", "Pereira", "Ferreira", "Brandão"]
+
+def benchmark_busca(db, args):
+    """Latência da busca: $regex sem âncora vs. tokens_busca indexado, e sugestões do checkout"""
+    bench = banco_benchmark(db)
+    total = max(args.documentos, 100_000)
+    aleatorio = random.Random(42)
+    
+    for inicio in range(0, total, 10_000):
+        lote = []
+        for i in range(inicio, min(inicio + 10_000, total)):
+            nome = f"{aleatorio.choice(PRENOMES_BENCHMARK)} {aleatorio.choice(SOBRENOMES_BENCHMARK)} {i:06d}"
+            lote.append({
+                "nome": nome,
+                "contato": {"celular": f"(11) 9{i:04d}-0000"},
+                "status": "ativo",
+                "tipo": "consumidor_final",
+                **campos_busca(nome, f"(11) 9{i:04d}-0000")
+            })
+        bench.clientes.insert_many(lote)
+    
+    print(f"{total} clientes")
+    print(f"{'termo':<16} | {'consulta':<8} | {'mediana ms':>10} | {'p95 ms':>10}")
+    for termo in ["conceicao", "Araújo", "mar bran", "012345", "(11) 90123"]:
+        for rotulo, filtro in [
+            ("regex", {"nome": {"$regex": termo, "$options": "i"}}),
+            ("tokens", filtro_busca(termo))
+        ]:
+            mediana, p95 = medir_latencia(
+                lambda: pagina_por_nome(bench.clientes, filtro, PROJECAO_LISTA_CLIENTES, None, 50),
+                args.repeticoes
+            )
+            print(f"{termo:<16} | {rotulo:<8} | {mediana:>10.1f} | {p95:>10.1f}")
+        mediana, p95 = medir_latencia(
+            lambda: sugestoes_busca(bench.clientes, termo, {"status": "ativo"}, PROJECAO_CLIENTES_VENDA),
+            args.repeticoes
+        )
+        print(f"{termo:<16} | {'checkout':<8} | {mediana:>10.1f} | {p95:>10.1f}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def benchmark_codigo(db, args):
+    """Latência da leitura por SKU (leitor de código de barras) com 50k produtos"""
+    bench = banco_benchmark(db)
+    total = max(args.documentos, 50_000)
+    bench.produtos.insert_many([
+        {
+            "nome": f"Produto {i:06d}",
+            "codigo": f"789{i:010d}",
+            "categoria": "Doce",
+            "preco_venda": 10.0,
+            "custo_producao": 4.0,
+            "estoque": 100,
+            "ativo": True
+        }
+        for i in range(total)
+    ])
+    aleatorio = random.Random(42)
+    
+    def ler_codigo():
+        codigo = f"789{aleatorio.randrange(total):010d}"
+        return bench.produtos.find_one({**filtro_codigo(codigo), "ativo": True}, PROJECAO_PRODUTOS_VENDA)
+    
+    mediana, p95 = medir_latencia(ler_codigo, args.repeticoes)
+    print(f"{total} produtos")
+    print(f"leitura por código: mediana {mediana:.1f} ms | p95 {p95:.1f} ms (meta: < 50 ms)")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def benchmark_opcoes(db, args):
+    """Tempo de rotular todas as opções de um selectbox: next() linear vs. mapa_opcoes"""
+    bench = banco_benchmark(db)
+    rotulo = lambda p: f"{p['nome']} | Estoque: {p['estoque']} | R$ {p['preco_venda']:.2f}"
+    amostra = 200
+    
+    print(f"{'opções':>7} | {'next() ms':>12} | {'montagem ms':>11} | {'mapa.get ms':>11}")
+    for total in (1_000, 10_000, 50_000):
+        bench.produtos.delete_many({})
+        bench.produtos.insert_many([
+            {"nome": f"Produto {i:06d}", "estoque": 100, "preco_venda": 10.0, "custo_producao": 4.0, "ativo": True}
+            for i in range(total)
+        ])
+        invalidar_colecoes(bench, "produtos")
+        produtos = list(bench.produtos.find({}, PROJECAO_PRODUTOS_VENDA).sort("nome", 1))
+        opcoes = [str(p["_id"]) for p in produtos]
+        
+        # format_func antigo: mede uma amostra e extrapola para todas as opções
+        indices = random.Random(42).sample(range(total), amostra)
+        inicio = pytime.perf_counter()
+        for i in indices:
+            next(rotulo(p) for p in produtos if str(p["_id"]) == opcoes[i])
+        linear = (pytime.perf_counter() - inicio) * 1000 * total / amostra
+        
+        inicio = pytime.perf_counter()
+        mapa = mapa_opcoes(bench, "benchmark", "produtos", {}, PROJECAO_PRODUTOS_VENDA, rotulo)
+        montagem = (pytime.perf_counter() - inicio) * 1000
+        
+        mediana, _ = medir_latencia(
+            lambda: [mapa.get(o) for o in mapa_opcoes(bench, "benchmark", "produtos", {}, PROJECAO_PRODUTOS_VENDA, rotulo)],
+            args.repeticoes
+        )
+        print(f"{total:>7} | {linear:>12.0f} | {montagem:>11.1f} | {mediana:>11.1f}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def benchmark_massa(db, args):
+    """Ações em massa sobre 500 linhas: escrita/contagem por linha vs. $in único"""
+    bench = banco_benchmark(db)
+    total = max(args.documentos, 500)
+    clientes = bench.clientes.insert_many([
+        {"nome": f"Cliente {i:06d}", "status": "ativo", "tipo": "consumidor_final"}
+        for i in range(total)
+    ]).inserted_ids
+    # Metade dos clientes com 20 vendas cada, para o guarda de exclusão
+    bench.vendas.insert_many([
+        {"cliente_id": cliente_id, "data_venda": datetime.now(), "valor_total": 10.0, "status": "concluída"}
+        for cliente_id in clientes[::2]
+        for _ in range(20)
+    ])
+    selecionados = [str(i) for i in clientes[:500]]
+    
+    def inativar_por_linha():
+        for cliente_id in selecionados:
+            bench.clientes.update_one({"_id": ObjectId(cliente_id)}, {"$set": {"status": "inativo"}})
+    
+    def guarda_por_linha():
+        for cliente_id in selecionados:
+            bench.vendas.count_documents({"cliente_id": {"$in": [ObjectId(cliente_id), cliente_id]}})
+    
+    print(f"500 linhas selecionadas de {total} clientes")
+    print(f"{'ação':<12} | {'consulta':<9} | {'mediana ms':>10} | {'p95 ms':>10}")
+    for acao, por_linha, em_massa in [
+        ("inativação", inativar_por_linha,
+         lambda: atualizar_em_massa(bench.clientes, selecionados, {"status": "inativo"})),
+        ("guarda", guarda_por_linha,
+         lambda: ids_referenciados(bench.vendas, "cliente_id", selecionados))
+    ]:
+        for rotulo, funcao in [("por linha", por_linha), ("$in", em_massa)]:
+            mediana, p95 = medir_latencia(funcao, args.repeticoes)
+            print(f"{acao:<12} | {rotulo:<9} | {mediana:>10.1f} | {p95:>10.1f}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def benchmark_historico(db, args):
+    """Latência de páginas do histórico de vendas: skip() vs. cursor (data_venda, _id)"""
+    bench = banco_benchmark(db)
+    total = max(args.documentos, 200_000)
+    inicio_periodo = datetime.now() - timedelta(days=3 * 365)
+    for inicio in range(0, total, 10_000):
+        bench.vendas.insert_many([
+            {
+                "cliente_id": ObjectId(),
+                "data_venda": inicio_periodo + timedelta(minutes=i * 8),
+                "valor_total": 10.0,
+                "metodo_pagamento": "pix" if i % 3 else "dinheiro",
+                "status": "concluída",
+                "itens_count": 1
+            }
+            for i in range(inicio, min(inicio + 10_000, total))
+        ])
+    filtro = {"data_venda": {"$gte": inicio_periodo, "$lte": datetime.now() + timedelta(days=3 * 365)}}
+    tamanho = 50
+    
+    print(f"{total} vendas, páginas de {tamanho}")
+    print(f"{'página':>7} | {'skip ms':>9} | {'cursor ms':>9}")
+    for pagina in (1, 100, total // tamanho // 2, total // tamanho - 1):
+        deslocamento = (pagina - 1) * tamanho
+        anterior = list(
+            bench.vendas.find(filtro, {"data_venda": 1}).sort([("data_venda", -1), ("_id", -1)])
+            .skip(max(deslocamento - 1, 0)).limit(1)
+        )
+        cursor = (anterior[0]["data_venda"], anterior[0]["_id"]) if deslocamento and anterior else None
+        
+        com_skip, _ = medir_latencia(
+            lambda: list(
+                bench.vendas.find(filtro, PROJECAO_HISTORICO_VENDAS)
+                .sort([("data_venda", -1), ("_id", -1)]).skip(deslocamento).limit(tamanho)
+            ),
+            args.repeticoes
+        )
+        com_cursor, _ = medir_latencia(
+            lambda: pagina_por_data(bench.vendas, filtro, PROJECAO_HISTORICO_VENDAS, cursor, tamanho),
+            args.repeticoes
+        )
+        print(f"{pagina:>7} | {com_skip:>9.1f} | {com_cursor:>9.1f}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def benchmark_entregas_pendentes(db, args):
+    """Vendas sem entrega: $nin com todas as entregas vs. índice parcial de entrega_agendada"""
+    bench = banco_benchmark(db)
+    total = max(args.documentos, 100_000)
+    inicio_periodo = datetime.now() - timedelta(days=2 * 365)
+    for inicio in range(0, total, 10_000):
+        resultado = bench.vendas.insert_many([
+            {
+                "cliente_id": ObjectId(),
+                "data_venda": inicio_periodo + timedelta(minutes=i * 10),
+                "valor_total": 10.0,
+                "status": "concluída",
+                "tipo_entrega": "entrega_ao_cliente",
+                # Quase todas já entregues; as últimas 20 aguardam agendamento
+                "entrega_agendada": i < total - 20
+            }
+            for i in range(inicio, min(inicio + 10_000, total))
+        ])
+        bench.entregas.insert_many([
+            {"venda_id": venda_id, "status": "entregue", "data_entrega": datetime.now()}
+            for venda_id in resultado.inserted_ids[:total - 20 - inicio]
+        ])
+    
+    def com_nin():
+        return list(bench.vendas.find({
+            "status": "concluída",
+            "tipo_entrega": "entrega_ao_cliente",
+            "_id": {"$nin": [e["venda_id"] for e in bench.entregas.find({}, {"venda_id": 1})]}
+        }).sort("data_venda", -1).limit(LIMITE_VENDAS_SEM_ENTREGA))
+    
+    def com_flag():
+        return list(bench.vendas.find(filtro_vendas_sem_entrega()).sort("data_venda", -1).limit(LIMITE_VENDAS_SEM_ENTREGA))
+    
+    print(f"{total} vendas com entrega, {bench.entregas.count_documents({})} entregas")
+    print(f"{'consulta':<20} | {'mediana ms':>10} | {'p95 ms':>10} | {'vendas':>6}")
+    repeticoes = min(args.repeticoes, 5)
+    for rotulo, funcao in [("$nin de entregas", com_nin), ("entrega_agendada", com_flag)]:
+        mediana, p95 = medir_latencia(funcao, repeticoes)
+        print(f"{rotulo:<20} | {mediana:>10.1f} | {p95:>10.1f} | {len(funcao()):>6}")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+
+def verificar_transacoes(db):
+    """Checkout, cancelamento e entregas de ponta a ponta no banco descartável.
+    
+    Exige um replica set (transações) e usa o cliente da aplicação, com a
+    mesma preferência de leitura. Retorna a lista de problemas encontrados.
+    """
+    bench = banco_benchmark(db)
+    problemas = []
+    produto_id = bench.produtos.insert_one(
+        {"nome": "Produto Teste", "preco_venda": 10.0, "custo_producao": 4.0, "estoque": 10, "ativo": True}
+    ).inserted_id
+    cliente_id = bench.clientes.insert_one({
+        "nome": "Cliente Teste", "tipo": "consumidor_final", "status": "ativo",
+        "compras_realizadas": 0, "total_gasto": 0.0
+    }).inserted_id
+    
+    venda = registrar_venda(bench, {
+        "cliente_id": cliente_id,
+        "data_venda": datetime.now(),
+        "valor_total": 20.0,
+        "lucro_total": 12.0,
+        "status": "concluída",
+        "itens_count": 1,
+        "metodo_pagamento": "pix",
+        "detalhes_pagamento": {},
+        "tipo_entrega": "retirada_na_loja",
+        "custo_entrega": 0.0
+    }, [{"produto_id": str(produto_id), "nome": "Produto Teste", "quantidade": 2,
+         "preco_unitario": 10.0, "custo_unitario": 4.0, "subtotal": 20.0}], "consumidor_final")
+    if bench.produtos.find_one({"_id": produto_id})["estoque"] != 8:
+        problemas.append("checkout: estoque não foi baixado")
+    
+    resumo = cancelar_vendas(bench, [venda["_id"]])
+    if resumo["canceladas"] != 1:
+        problemas.append(f"cancelamento: {resumo['canceladas']} vendas canceladas, esperado 1")
+    if bench.vendas.find_one({"_id": venda["_id"]})["status"] != "cancelada":
+        problemas.append("cancelamento: venda não ficou cancelada")
+    if bench.produtos.find_one({"_id": produto_id})["estoque"] != 10:
+        problemas.append("cancelamento: estoque não foi devolvido")
+    if bench.clientes.find_one({"_id": cliente_id}).get("compras_realizadas") != 0:
+        problemas.append("cancelamento: compras do cliente não foram estornadas")
+    if sum(d.get("vendas", 0) for d in bench.vendas_diarias.find()) != 0:
+        problemas.append("cancelamento: consolidado diário não foi estornado")
+    
+    # Cliente anterior ao bloco estatisticas: a venda soma aos totais de topo
+    legado_id = bench.clientes.insert_one({
+        "nome": "Cliente Legado", "tipo": "consumidor_final", "status": "ativo",
+        "compras_realizadas": 3, "total_gasto": 90.0, "ultima_compra": datetime.now() - timedelta(days=30)
+    }).inserted_id
+    registrar_venda(bench, {
+        "cliente_id": legado_id,
+        "data_venda": datetime.now(),
+        "valor_total": 10.0,
+        "lucro_total": 6.0,
+        "status": "concluída",
+        "itens_count": 1,
+        "metodo_pagamento": "pix",
+        "detalhes_pagamento": {},
+        "tipo_entrega": "retirada_na_loja",
+        "custo_entrega": 0.0
+    }, [{"produto_id": str(produto_id), "nome": "Produto Teste", "quantidade": 1,
+         "preco_unitario": 10.0, "custo_unitario": 4.0, "subtotal": 10.0}], "consumidor_final")
+    legado = bench.clientes.find_one({"_id": legado_id})
+    if (legado.get("compras_realizadas"), legado.get("total_gasto")) != (4, 100.0):
+        problemas.append("checkout: totais anteriores do cliente sem estatisticas foram perdidos")
+    
+    # Entrega: agendar e cancelar ressincronizam vendas.entrega_agendada
+    venda = registrar_venda(bench, {
+        "cliente_id": cliente_id,
+        "data_venda": datetime.now(),
+        "valor_total": 10.0,
+        "lucro_total": 6.0,
+        "status": "concluída",
+        "itens_count": 1,
+        "metodo_pagamento": "pix",
+        "detalhes_pagamento": {},
+        "tipo_entrega": "entrega_ao_cliente",
+        "custo_entrega": 0.0
+    }, [{"produto_id": str(produto_id), "nome": "Produto Teste", "quantidade": 1,
+         "preco_unitario": 10.0, "custo_unitario": 4.0, "subtotal": 10.0}], "consumidor_final")
+    entrega = agendar_entrega(bench, {
+        "venda_id": venda["_id"], "data_entrega": datetime.now(), "status": "agendada", "custo_entrega": 5.0
+    })
+    if bench.vendas.find_one({"_id": venda["_id"]}).get("entrega_agendada") is not True:
+        problemas.append("entrega: venda não foi marcada como agendada")
+    atualizar_status_entregas(bench, [entrega["_id"]], {"status": "cancelada"})
+    if bench.vendas.find_one({"_id": venda["_id"]}).get("entrega_agendada") is not False:
+        problemas.append("entrega: cancelamento não liberou a venda para nova entrega")
+    
+    db.client.drop_database(NOME_BANCO_BENCHMARK)
+    return problemas
+
+BENCHMARKS = {
+    "checkout": benchmark_checkout,
+    "projecoes": benchmark_projecoes,
+    "busca": benchmark_busca,
+    "codigo": benchmark_codigo,
+    "opcoes": benchmark_opcoes,
+    "massa": benchmark_massa,
+    "historico": benchmark_historico,
+    "cancelamento": benchmark_cancelamento,
+    "relatorio-produtos": benchmark_relatorio_produtos,
+    "clientes-top": benchmark_clientes_top,
+    "entregas-pendentes": benchmark_entregas_pendentes
+}
+
+# =============================================
+# MANUTENÇÃO (LINHA DE COMANDO)
+# =============================================
+
+def executar_manutencao(argumentos):
+    """Tarefas administrativas: python main.py <comando> [opções]"""
+    parser = argparse.ArgumentParser(prog="main.py", description="Manutenção do Sari Dulces iGEST")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+    
+    cmd_indices = comandos.add_parser("indices", help="Cria os índices declarados em INDICES")
+    cmd_indices.add_argument("--check", action="store_true", help="Apenas lista consultas sem índice")
+    cmd_indices.add_argument(
+        "--recriar", action="store_true",
+        help="Remove e recria índices cujas opções (unique, filtro parcial) divergem da declaração"
+    )
+    
+    cmd_chaves = comandos.add_parser("migrar-chaves", help="Converte chaves estrangeiras string em ObjectId")
+    cmd_chaves.add_argument("--lote", type=int, default=500, help="Documentos por lote")
+    cmd_chaves.add_argument("--verificar", action="store_true", help="Apenas verifica chaves e junções")
+    
+    cmd_rollup = comandos.add_parser("rollup-vendas", help="Reconstrói o consolidado vendas_diarias")
+    cmd_rollup.add_argument("--inicio", type=date.fromisoformat, help="Data inicial (AAAA-MM-DD)")
+    cmd_rollup.add_argument("--fim", type=date.fromisoformat, help="Data final (AAAA-MM-DD)")
+    
+    cmd_mov = comandos.add_parser("migrar-movimentacoes", help="Move produtos.movimentacoes para movimentacoes_estoque")
+    cmd_mov.add_argument("--lote", type=int, default=100, help="Produtos por lote")
+    
+    cmd_itens = comandos.add_parser("migrar-itens", help="Embute itens_venda em vendas.itens (ITENS_EMBUTIDOS)")
+    cmd_itens.add_argument("--lote", type=int, default=500, help="Vendas por lote")
+    
+    cmd_busca = comandos.add_parser("backfill-busca", help="Grava tokens_busca (nome, celular, CPF) em clientes e produtos")
+    cmd_busca.add_argument("--lote", type=int, default=1000, help="Documentos por lote")
+    cmd_busca.add_argument("--recalcular", action="store_true", help="Recalcula também documentos já preenchidos")
+    
+    cmd_entregas = comandos.add_parser("backfill-entregas", help="Grava vendas.entrega_agendada a partir das entregas")
+    cmd_entregas.add_argument("--lote", type=int, default=1000, help="Vendas por lote")
+    cmd_entregas.add_argument("--recalcular", action="store_true", help="Recalcula também vendas já preenchidas")
+    
+    cmd_estat = comandos.add_parser("reconciliar-clientes", help="Recalcula clientes.estatisticas a partir das vendas")
+    cmd_estat.add_argument("--lote", type=int, default=500, help="Clientes por lote")
+    
+    comandos.add_parser("verificar-transacoes", help=f"Checkout, cancelamento e entregas de ponta a ponta em {NOME_BANCO_BENCHMARK}")
+    
+    cmd_bench = comandos.add_parser("benchmark", help=f"Mede latência no banco descartável {NOME_BANCO_BENCHMARK}")
+    cmd_bench.add_argument("alvo", choices=sorted(BENCHMARKS))
+    cmd_bench.add_argument("--repeticoes", type=int, default=20, help="Execuções por medição")
+    cmd_bench.add_argument("--documentos", type=int, default=10000, help="Documentos gerados por coleção")
+    
+    args = parser.parse_args(argumentos)
+    db = get_database()
+    
+    if args.comando == "indices":
+        if not args.check:
+            relatorio = garantir_indices(db, args.recriar)
+            for nome in relatorio["criados"]:
+                print(f"✅ criado: {nome}")
+            for nome in relatorio["recriados"]:
+                print(f"🔁 recriado: {nome}")
+            for nome in relatorio["existentes"]:
+                print(f"✔️ já existente: {nome}")
+            for divergente in relatorio["divergentes"]:
+                print(f"⚠️ opções divergentes (use --recriar): {divergente}")
+            for erro in relatorio["erros"]:
+                print(f"❌ erro: {erro}")
+            if relatorio["divergentes"] or relatorio["erros"]:
+                sys.exit(1)
+        
+        sem_indice = consultas_sem_indice(db)
+        if sem_indice:
+            print("⚠️ Consultas sem índice:")
+            for consulta in sem_indice:
+                print(f"  - {consulta}")
+            sys.exit(1)
+        print("✅ Todas as consultas monitoradas usam índice.")
+    
+    elif args.comando == "migrar-chaves":
+        if not args.verificar:
+            for chave, resultado in migrar_chaves_estrangeiras(db, args.lote).items():
+                print(f"✅ {chave}: {resultado['convertidos']} convertidos, {resultado['invalidos']} inválidos")
+        
+        problemas = verificar_chaves_estrangeiras(db)
+        if problemas:
+            print("⚠️ Problemas encontrados:")
+            for problema in problemas:
+                print(f"  - {problema}")
+            sys.exit(1)
+        print("✅ Todas as chaves são ObjectId, resolvem e usam índice.")
+    
+    elif args.comando == "rollup-vendas":
+        # Os upserts do checkout dependem do índice único dia_pagamento_tipo
+        relatorio = garantir_indices(db)
+        problemas = [p for p in relatorio["divergentes"] + relatorio["erros"] if p.startswith("vendas_diarias")]
+        if problemas:
+            for problema in problemas:
+                print(f"❌ {problema}")
+            sys.exit(1)
+        resultado = reconstruir_vendas_diarias(db, args.inicio, args.fim)
+        print(f"✅ vendas_diarias: {resultado['removidos']} removidos, {resultado['gerados']} gerados")
+    
+    elif args.comando == "migrar-movimentacoes":
+        resultado = migrar_movimentacoes(db, args.lote)
+        print(f"✅ {resultado['produtos']} produtos e {resultado['movimentacoes']} movimentações migrados")
+    
+    elif args.comando == "migrar-itens":
+        try:
+            resultado = migrar_itens_embutidos(db, args.lote)
+        except ValueError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        print(f"✅ {resultado['vendas']} vendas e {resultado['itens']} itens migrados")
+        if not ITENS_EMBUTIDOS:
+            print("⚠️ ITENS_EMBUTIDOS está desativado: novas vendas continuarão gravando em itens_venda.")
+    
+    elif args.comando == "backfill-busca":
+        for colecao, atualizados in preencher_campos_busca(db, args.lote, args.recalcular).items():
+            print(f"✅ {colecao}: {atualizados} documentos atualizados")
+    
+    elif args.comando == "backfill-entregas":
+        atualizadas = preencher_entrega_agendada(db, args.lote, args.recalcular)
+        print(f"✅ vendas: {atualizadas} com entrega_agendada atualizada")
+    
+    elif args.comando == "reconciliar-clientes":
+        resultado = reconciliar_estatisticas_clientes(db, args.lote)
+        print(f"✅ {resultado['verificados']} clientes verificados, {resultado['corrigidos']} corrigidos")
+    
+    elif args.comando == "verificar-transacoes":
+        problemas = verificar_transacoes(db)
+        if problemas:
+            print("⚠️ Problemas encontrados:")
+            for problema in problemas:
+                print(f"  - {problema}")
+            sys.exit(1)
+        print("✅ Checkout, cancelamento e entregas concluídos nas transações.")
+    
+    elif args.comando == "benchmark":
+        BENCHMARKS[args.alvo](db, args)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        executar_manutencao(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file